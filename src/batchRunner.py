@@ -0,0 +1,214 @@
+"""
+runs generation jobs from a JSONL file without Qt, e.g. overnight on a server without a display
+
+usage: python batchRunner.py jobs.jsonl [--results results.jsonl] [--cache-dir models] [--save-path .]
+
+one job per line, every key except "prompt" is optional:
+{"prompt": "a cat", "negative_prompt": "", "width": 512, "height": 512, "num_inference_steps": 20,
+ "guidance_scale": 7.5, "sampler": "DPMSolverMultistepScheduler", "model": "runwayml/stable-diffusion-v1-5",
+ "count": 1, "rows": 1, "cols": 1, "loras": [], "fuse_lora": false, "fused_lora_cache": false, "seed": null, "torch_dtype": "16", "safety_checker": false}
+
+a result line is written for each image (or for each failed job)
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from functools import partial
+
+# this must not import qtpy, so it can start fast and run without a display
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from gridGenerator import generate_grid
+from imageEncoder import get_encoder, DEFAULT_ENCODER
+from imageWriter import ImageWriterPool
+from script import generate_image, image_to_grid, save_image, write_image
+
+JOB_DEFAULTS = {
+    'negative_prompt': '',
+    'width': 512,
+    'height': 512,
+    'num_inference_steps': 20,
+    'guidance_scale': 7.5,
+    'sampler': 'DPMSolverMultistepScheduler',
+    'model': 'runwayml/stable-diffusion-v1-5',
+    'count': 1,
+    'rows': 1,
+    'cols': 1,
+    # lora path or [lora path, scale]
+    'loras': [],
+    'fuse_lora': False,
+    # the model is saved with the LoRAs fused in (cache_dir/fused) and loaded like that by later runs
+    'fused_lora_cache': False,
+    'seed': None,
+    'torch_dtype': '16',
+    'safety_checker': False,
+}
+
+
+def read_jobs(f):
+    """
+    :return: generator of (line number, job)
+    """
+    for i, line in enumerate(f, 1):
+        line = line.strip()
+        if line == '':
+            continue
+        try:
+            params = json.loads(line)
+            if not isinstance(params, dict):
+                raise ValueError('a job must be a JSON object')
+            job = dict(JOB_DEFAULTS)
+            job.update(params)
+            if 'prompt' not in job:
+                raise ValueError('"prompt" is missing')
+        except ValueError as e:
+            # one broken line shouldn't stop the whole night
+            print(f'Line {i} is skipped: {e}', file=sys.stderr)
+            continue
+        yield i, job
+
+
+def get_group_key(job):
+    # like loraManager.normalize_loras, which imports torch: "a" and ["a", 1] are the same LoRA and the key can be sorted
+    loras = tuple((lora, 1.0) if isinstance(lora, str) else (lora[0], float(lora[1])) for lora in job['loras'])
+    return (job['model'], str(job['torch_dtype']), bool(job['safety_checker']), loras,
+            bool(job['fuse_lora']), bool(job['fused_lora_cache']))
+
+
+def group_jobs(jobs, window=256):
+    """
+    read up to "window" jobs ahead and run the jobs of the same model (and LoRAs) together,
+    so each model is loaded once per window while the file is still streamed
+    """
+    while True:
+        chunk = list(itertools.islice(jobs, window))
+        if len(chunk) == 0:
+            break
+        chunk.sort(key=lambda x: get_group_key(x[1]))
+        for key, group in itertools.groupby(chunk, key=lambda x: get_group_key(x[1])):
+            yield key, list(group)
+
+
+class BatchRunner:
+    def __init__(self, cache_dir='models', save_path='.', output_encoder=DEFAULT_ENCODER, max_batch_size=8):
+        super(BatchRunner, self).__init__()
+        self.__initVal(cache_dir, save_path, output_encoder, max_batch_size)
+
+    def __initVal(self, cache_dir, save_path, output_encoder, max_batch_size):
+        # torch is only needed after the arguments are parsed
+        from stableDiffusionClass import StableDiffusionWrapper
+
+        self.__wrapper = StableDiffusionWrapper()
+        self.__cache_dir = cache_dir
+        self.__save_path = save_path
+        self.__encoder = get_encoder(output_encoder)
+        # grids with more images are denoised in sub-batches of this size
+        self.__max_batch_size = max_batch_size
+
+    def __load(self, job):
+        import torch
+
+        torch_dtype = torch.float16 if str(job['torch_dtype']) == '16' else torch.float32
+        self.__wrapper.init_wrapper(job['model'], self.__cache_dir, torch_dtype, job['safety_checker'], job['sampler'],
+                                    job['loras'] if job['fused_lora_cache'] else None)
+        self.__wrapper.set_loras(job['loras'], job['fuse_lora'])
+
+    def __run_job(self, job, writer):
+        import torch
+
+        pipeline_args = self.__wrapper.forward_embeddings_through_text_encoder({
+            'prompt': job['prompt'],
+            'negative_prompt': job['negative_prompt'],
+            'width': job['width'],
+            'height': job['height'],
+            'num_inference_steps': job['num_inference_steps'],
+            'guidance_scale': job['guidance_scale'],
+            'num_images_per_prompt': job['rows'] * job['cols'],
+        })
+        pipeline = self.__wrapper.get_pipeline()
+
+        tile_count = job['rows'] * job['cols']
+        if tile_count > self.__max_batch_size:
+            yield from self.__run_grid_job(job, pipeline, pipeline_args, writer)
+            return
+
+        for i in range(job['count']):
+            if job['seed'] is not None:
+                pipeline_args['generator'] = torch.Generator(pipeline.device).manual_seed(job['seed'] + i)
+            start = time.perf_counter()
+            images = generate_image(pipeline, as_array=True, **pipeline_args)
+            elapsed = time.perf_counter() - start
+            if len(images) > 1:
+                images = [image_to_grid(images, rows=job['rows'], cols=job['cols'])]
+                suffix = f"({job['rows']}x{job['cols']} grid)"
+            else:
+                suffix = ''
+            filename = save_image(images, prompt=job['prompt'], model_id=job['model'], save_path=self.__save_path,
+                                  suffix=suffix, writer=writer, encoder=self.__encoder)
+            yield {'filename': filename, 'seed': None if job['seed'] is None else job['seed'] + i, 'seconds': round(elapsed, 3)}
+
+    def __run_grid_job(self, job, pipeline, pipeline_args, writer):
+        del pipeline_args['num_images_per_prompt']
+        tile_count = job['rows'] * job['cols']
+        for i in range(job['count']):
+            # tile j of the i-th grid has the seed "seed" + j
+            seed = None if job['seed'] is None else job['seed'] + i * tile_count
+            canvas, seed, stats = generate_grid(pipeline, job['rows'], job['cols'], self.__max_batch_size, seed=seed, **pipeline_args)
+            filename = save_image([canvas.get_array()], prompt=job['prompt'], model_id=job['model'], save_path=self.__save_path,
+                                  suffix=f"({job['rows']}x{job['cols']} grid)", writer=writer, encoder=self.__encoder)
+            yield {'filename': filename, 'seed': seed, 'seconds': stats['seconds'], 'batches': stats['batches']}
+
+    def run(self, jobs, results_f):
+        writer = ImageWriterPool(partial(write_image, encoder=self.__encoder))
+        try:
+            for key, group in group_jobs(jobs):
+                try:
+                    self.__load(group[0][1])
+                except Exception as e:
+                    for line_number, job in group:
+                        self.__write_result(results_f, {'line': line_number, 'model': job['model'], 'error': str(e)})
+                    continue
+                for line_number, job in group:
+                    try:
+                        for result in self.__run_job(job, writer):
+                            self.__write_result(results_f, {'line': line_number, 'model': job['model'], 'prompt': job['prompt'], **result})
+                    except Exception as e:
+                        self.__write_result(results_f, {'line': line_number, 'model': job['model'], 'error': str(e)})
+        finally:
+            writer.close()
+
+    def __write_result(self, results_f, result):
+        results_f.write(json.dumps(result) + '\n')
+        results_f.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run Stable Diffusion jobs from a JSONL file without the GUI')
+    parser.add_argument('jobs', help='JSONL file, "-" for stdin')
+    parser.add_argument('--results', default='results.jsonl', help='JSONL file of the results (appended), "-" for stdout')
+    parser.add_argument('--cache-dir', default='models')
+    parser.add_argument('--save-path', default='.')
+    parser.add_argument('--output-format', default=DEFAULT_ENCODER)
+    parser.add_argument('--max-batch-size', type=int, default=8, help='grids with more images are made in sub-batches of this size')
+    parser.add_argument('--offline', action='store_true', help='use only the models and LoRAs in the cache directory')
+    args = parser.parse_args()
+
+    if args.offline:
+        from huggingface_gui.huggingFaceModelResolver import set_allow_network
+
+        set_allow_network(False)
+
+    jobs_f = sys.stdin if args.jobs == '-' else open(args.jobs, encoding='utf-8')
+    results_f = sys.stdout if args.results == '-' else open(args.results, 'a', encoding='utf-8')
+    try:
+        runner = BatchRunner(cache_dir=args.cache_dir, save_path=args.save_path, output_encoder=args.output_format,
+                             max_batch_size=args.max_batch_size)
+        runner.run(read_jobs(jobs_f), results_f)
+    finally:
+        if jobs_f is not sys.stdin:
+            jobs_f.close()
+        if results_f is not sys.stdout:
+            results_f.close()
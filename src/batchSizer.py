@@ -0,0 +1,64 @@
+class BatchSizer:
+    """
+    finds the number of generations to pack into one pipeline call
+
+    it starts from 1 and doubles the size while images/sec keeps getting better by min_gain,
+    then it stays at the best measured size (max_size is the memory budget in generations)
+    """
+    def __init__(self, max_size, min_gain=1.05):
+        super(BatchSizer, self).__init__()
+        self.__initVal(max_size, min_gain)
+
+    def __initVal(self, max_size, min_gain):
+        self.__max_size = max(1, max_size)
+        self.__min_gain = min_gain
+
+        self.__size = 1
+        self.__best_size = 1
+        self.__settled = self.__max_size == 1
+        # the first call pays one-time warm-up costs, it would make packing look better than it is
+        self.__warmup = True
+
+        # size: [images, seconds]
+        self.__measurements = {}
+
+    def get_size(self):
+        return self.__size
+
+    def __get_throughput(self, size):
+        images, elapsed = self.__measurements[size]
+        return images / elapsed if elapsed > 0 else 0.0
+
+    def report(self, size, images, elapsed):
+        if self.__warmup:
+            self.__warmup = False
+            return
+
+        measurement = self.__measurements.setdefault(size, [0, 0.0])
+        measurement[0] += images
+        measurement[1] += elapsed
+
+        # calls with fewer generations than asked (the last ones of the run) don't say anything about the size
+        if self.__settled or size != self.__size:
+            return
+
+        if size == self.__best_size or self.__get_throughput(size) >= self.__get_throughput(self.__best_size) * self.__min_gain:
+            self.__best_size = size
+            self.__size = min(size * 2, self.__max_size)
+            self.__settled = self.__size == size
+        else:
+            self.__size = self.__best_size
+            self.__settled = True
+
+    def report_out_of_memory(self, size):
+        self.__max_size = max(1, size - 1)
+        self.__best_size = min(self.__best_size, self.__max_size)
+        self.__size = self.__best_size
+        self.__settled = True
+
+    def get_stats(self):
+        return {
+            'size': self.__size,
+            'settled': self.__settled,
+            'images_per_sec': {size: round(self.__get_throughput(size), 3) for size in sorted(self.__measurements.keys())}
+        }
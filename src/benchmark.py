@@ -0,0 +1,518 @@
+"""
+benchmarks for the performance sensitive parts of the generation path
+
+usage: python benchmark.py <name> [options]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# modules which must not be imported before the window is shown
+HEAVY_MODULES = ['torch', 'diffusers', 'transformers']
+
+
+def _measure(fn, repeat):
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def benchmark_text_encoder(model_id, cache_dir='models', chunk_counts=range(1, 9), repeat=5):
+    """
+    compare the old way of encoding a long prompt (text encoder called once per chunk, separately for the prompt
+    and the negative prompt, with autograd) with the batched encoder
+    """
+    import torch
+    from diffusers import StableDiffusionPipeline
+
+    from promptEncoder import encode_chunks
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    torch_dtype = torch.float16 if device == 'cuda' else torch.float32
+    pipeline = StableDiffusionPipeline.from_pretrained(model_id, cache_dir=cache_dir, torch_dtype=torch_dtype, safety_checker=None)
+    text_encoder = pipeline.text_encoder.to(device)
+    max_length = pipeline.tokenizer.model_max_length
+    vocab_size = pipeline.tokenizer.vocab_size
+
+    def sync():
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    print(f'{"chunks":>6} {"per chunk (ms)":>15} {"batched (ms)":>13} {"speedup":>8}')
+    for chunk_count in chunk_counts:
+        prompt_ids = torch.randint(0, vocab_size, (chunk_count, max_length))
+        negative_ids = torch.randint(0, vocab_size, (chunk_count, max_length))
+
+        def per_chunk():
+            input_ids = prompt_ids.view(1, -1).to(device)
+            negative_input_ids = negative_ids.view(1, -1).to(device)
+            prompt_embeds = []
+            negative_prompt_embeds = []
+            for i in range(0, input_ids.shape[-1], max_length):
+                prompt_embeds.append(text_encoder(input_ids[:, i: i + max_length])[0])
+                negative_prompt_embeds.append(text_encoder(negative_input_ids[:, i: i + max_length])[0])
+            torch.cat(prompt_embeds, dim=1)
+            torch.cat(negative_prompt_embeds, dim=1)
+            sync()
+
+        def batched():
+            encode_chunks(text_encoder, [prompt_ids, negative_ids], device)
+            sync()
+
+        per_chunk_time = _measure(per_chunk, repeat)
+        batched_time = _measure(batched, repeat)
+        print(f'{chunk_count:>6} {per_chunk_time * 1000:>15.1f} {batched_time * 1000:>13.1f} {per_chunk_time / batched_time:>7.2f}x')
+
+
+def benchmark_encoders(image_dir, repeat=3):
+    """
+    encode ms/image and bytes/image of every output format preset on the images in image_dir
+    """
+    import glob
+    import io
+    import os
+
+    from PIL import Image
+
+    from imageEncoder import ENCODERS
+
+    filenames = [f for f in glob.glob(os.path.join(image_dir, '*'))
+                 if os.path.splitext(f)[1].lower() in ('.png', '.jpg', '.jpeg', '.webp', '.bmp')]
+    if len(filenames) == 0:
+        raise Exception(f'No images in {image_dir}')
+    images = []
+    for filename in filenames:
+        with Image.open(filename) as img:
+            images.append(img.convert('RGB'))
+
+    print(f'{len(images)} images')
+    print(f'{"preset":<20} {"ms/image":>9} {"bytes/image":>12}')
+    for name, encoder in ENCODERS.items():
+        sizes = []
+
+        def encode():
+            sizes.clear()
+            for img in images:
+                f = io.BytesIO()
+                encoder.encode(img, f)
+                sizes.append(f.tell())
+
+        elapsed = _measure(encode, repeat)
+        print(f'{name:<20} {elapsed / len(images) * 1000:>9.1f} {sum(sizes) // len(sizes):>12}')
+
+
+def benchmark_packing(model_id, cache_dir='models', generation_count=8, pack_sizes=(1, 2, 4, 8), num_inference_steps=20, width=512, height=512):
+    """
+    images/sec of generation_count single image generations, run one per pipeline call (pack size 1) and packed
+    """
+    import torch
+
+    from script import generate_image
+    from stableDiffusionClass import StableDiffusionWrapper
+
+    wrapper = StableDiffusionWrapper()
+    torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+    wrapper.init_wrapper(model_id, cache_dir, torch_dtype, False, 'DPMSolverMultistepScheduler')
+    pipeline_args = wrapper.forward_embeddings_through_text_encoder({
+        'prompt': 'a photo of an astronaut riding a horse on mars',
+        'negative_prompt': 'low quality',
+        'width': width,
+        'height': height,
+        'num_inference_steps': num_inference_steps,
+    })
+    pipeline = wrapper.get_pipeline()
+
+    # warm-up
+    generate_image(pipeline, num_images_per_prompt=1, **pipeline_args)
+
+    print(f'{"pack size":>9} {"images/sec":>11}')
+    for pack_size in pack_sizes:
+        start = time.perf_counter()
+        remaining = generation_count
+        while remaining > 0:
+            count = min(pack_size, remaining)
+            generate_image(pipeline, num_images_per_prompt=count, **pipeline_args)
+            remaining -= count
+        elapsed = time.perf_counter() - start
+        print(f'{pack_size:>9} {generation_count / elapsed:>11.3f}')
+
+
+def parse_importtime(stderr):
+    """
+    parse the output of python -X importtime
+
+    :return: {top level module: cumulative microseconds}
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # nested imports are indented
+        if not name.startswith('  '):
+            modules[name.strip()] = int(cumulative)
+    return modules
+
+
+def check_startup(module='main', budget_ms=900.0):
+    """
+    import the GUI module with -X importtime and fail when it takes longer than budget_ms
+    or when one of HEAVY_MODULES is imported before the window is shown
+
+    :return: True if it passed
+    """
+    env = dict(os.environ)
+    env.setdefault('QT_API', 'pyqt5')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(result.stderr)
+        return False
+
+    modules = parse_importtime(result.stderr)
+    total_ms = sum(modules.values()) / 1000
+    print(f'import {module}: {total_ms:.1f} ms (budget {budget_ms:.1f} ms)')
+    for name, cumulative in sorted(modules.items(), key=lambda x: -x[1])[:10]:
+        print(f'{cumulative / 1000:>10.1f} ms  {name}')
+
+    all_modules = set(line.split('|')[-1].strip().split('.')[0] for line in result.stderr.splitlines() if line.startswith('import time:'))
+    heavy_modules = [name for name in HEAVY_MODULES if name in all_modules]
+    if heavy_modules:
+        print('imported at startup:', ', '.join(heavy_modules))
+    return total_ms <= budget_ms and not heavy_modules
+
+
+def benchmark_download(file_count=8, file_size_mb=32, worker_counts=(1, 4, 8), fail_after_mb=8):
+    """
+    download a made-up pipeline from the local hub stand-in with different numbers of workers,
+    then once more with every file dropped in the middle and resumed
+    """
+    import shutil
+    import tempfile
+    import threading
+
+    from localHub import serve
+    from huggingface_gui.huggingFaceDownloader import HuggingFaceDownloader
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        repo_path = os.path.join(tmp_dir, 'hub', 'local', 'tiny-pipeline')
+        os.makedirs(repo_path)
+        with open(os.path.join(repo_path, 'model_index.json'), 'w') as f:
+            f.write('{}')
+        for i in range(file_count):
+            os.makedirs(os.path.join(repo_path, f'component{i}'))
+            with open(os.path.join(repo_path, f'component{i}', 'config.json'), 'w') as f:
+                f.write('{}')
+            with open(os.path.join(repo_path, f'component{i}', 'diffusion_pytorch_model.safetensors'), 'wb') as f:
+                f.write(os.urandom(file_size_mb * 1024 ** 2))
+
+        def download(workers, fail_after=None):
+            server = serve(os.path.join(tmp_dir, 'hub'), port=0, fail_after=fail_after)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            endpoint = f'http://127.0.0.1:{server.server_address[1]}'
+            cache_dir = os.path.join(tmp_dir, f'cache{workers}_{fail_after}')
+            downloader = HuggingFaceDownloader(cache_dir, endpoint=endpoint, max_workers=workers)
+            try:
+                start = time.perf_counter()
+                attempts = 0
+                while True:
+                    attempts += 1
+                    try:
+                        downloader.download('local/tiny-pipeline')
+                        break
+                    except Exception as e:
+                        if attempts > file_count + 1:
+                            raise
+                return time.perf_counter() - start, attempts
+            finally:
+                server.shutdown()
+
+        total_mb = file_count * file_size_mb
+        print(f'{"workers":>7} {"seconds":>8} {"MB/s":>8}')
+        for workers in worker_counts:
+            elapsed, _ = download(workers)
+            print(f'{workers:>7} {elapsed:>8.2f} {total_mb / elapsed:>8.1f}')
+
+        elapsed, attempts = download(max(worker_counts), fail_after=fail_after_mb * 1024 ** 2)
+        print(f'dropped after {fail_after_mb} MB and resumed: {elapsed:.2f} sec, {attempts} attempts')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def benchmark_checkpoint(checkpoint, cache_dir='models', torch_dtype='16', repeat=3):
+    """
+    load time of a single file checkpoint against the directory it is converted to
+    """
+    import torch
+    from diffusers import StableDiffusionPipeline
+
+    from huggingface_gui.huggingFaceCheckpointConverter import convert_checkpoint
+
+    dtype = torch.float16 if torch_dtype == '16' else torch.float32
+    converted_path = os.path.join(cache_dir, convert_checkpoint(checkpoint, cache_dir, torch_dtype))
+
+    single_file = _measure(lambda: StableDiffusionPipeline.from_single_file(checkpoint, cache_dir=cache_dir, torch_dtype=dtype), repeat)
+    converted = _measure(lambda: StableDiffusionPipeline.from_pretrained(converted_path, torch_dtype=dtype), repeat)
+    print(f'single file: {single_file:.2f} sec, converted: {converted:.2f} sec, {single_file / converted:.1f}x')
+
+
+def benchmark_grid(grid_sizes=(4, 8), width=512, height=512, repeat=5):
+    """
+    decoder output to a grid: PIL images pasted one by one (the old path) against one uint8 batch and a reshape
+    """
+    import numpy as np
+    from PIL import Image
+
+    from script import image_to_grid
+
+    def paste_grid(images, rows, cols):
+        w, h = images[0].size
+        grid = Image.new('RGB', size=(cols * w, rows * h))
+        for i, img in enumerate(images):
+            grid.paste(img, box=(i % cols * w, i // cols * h))
+        return grid
+
+    print(f'{"grid":>5} {"PIL paste":>10} {"reshape":>10}')
+    for size in grid_sizes:
+        # decoded images after the conversion to uint8, which both paths do (the array path on the device)
+        decoded = np.random.randint(0, 256, (size * size, height, width, 3), dtype=np.uint8)
+
+        def pil_path():
+            # numpy_to_pil of diffusers, then the paste loop
+            return paste_grid([Image.fromarray(image) for image in decoded], size, size)
+
+        def array_path():
+            return image_to_grid(decoded, size, size)
+
+        assert np.array_equal(np.asarray(pil_path()), array_path())
+        pil_time = _measure(pil_path, repeat)
+        array_time = _measure(array_path, repeat)
+        print(f'{size}x{size:<3} {pil_time * 1000:>8.1f}ms {array_time * 1000:>8.1f}ms  {pil_time / array_time:.1f}x')
+
+
+def benchmark_chunked_grid(model_id, cache_dir='models', grid_sizes=(2, 4, 8), max_batch_size=4, num_inference_steps=20):
+    """
+    peak CUDA memory and time of rows x cols grids made in sub-batches, the peak should stay the same for every size
+    """
+    import torch
+
+    from gridGenerator import generate_grid
+    from stableDiffusionClass import StableDiffusionWrapper
+
+    wrapper = StableDiffusionWrapper()
+    torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+    wrapper.init_wrapper(model_id, cache_dir, torch_dtype, False, 'DPMSolverMultistepScheduler')
+    pipeline_args = wrapper.forward_embeddings_through_text_encoder({
+        'prompt': 'a photo of an astronaut riding a horse on mars',
+        'negative_prompt': 'low quality',
+        'num_inference_steps': num_inference_steps,
+    })
+    pipeline = wrapper.get_pipeline()
+
+    print(f'{"grid":>5} {"seconds":>8} {"peak CUDA":>10} {"memmap":>7}')
+    for size in grid_sizes:
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        canvas, seed, stats = generate_grid(pipeline, size, size, max_batch_size, seed=0, **pipeline_args)
+        peak = torch.cuda.max_memory_allocated() / 1024 ** 3 if torch.cuda.is_available() else 0.0
+        print(f'{size}x{size:<3} {stats["seconds"]:>8.1f} {peak:>8.2f}GB {str(stats["memmap"]):>7}')
+
+
+def check_offline(repeat=100):
+    """
+    resolve a model, a LoRA repo and a local LoRA file from a cache made with the local hub stand-in,
+    with every socket call failing, and a model which isn't in the cache has to fail fast
+
+    :return: True if it passed
+    """
+    import shutil
+    import socket
+    import tempfile
+    import threading
+
+    from localHub import serve
+    from huggingface_gui.huggingFaceCacheIndex import get_cache_index
+    from huggingface_gui.huggingFaceDownloader import HuggingFaceDownloader
+    from huggingface_gui.huggingFaceModelResolver import HuggingFaceModelResolver, ModelNotFoundOffline, set_allow_network
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        hub_root = os.path.join(tmp_dir, 'hub')
+        files = {
+            'org/model/model_index.json': b'{"_class_name": "StableDiffusionPipeline", "unet": ["diffusers", "UNet2DConditionModel"]}',
+            'org/model/unet/config.json': b'{}',
+            'org/model/unet/diffusion_pytorch_model.safetensors': os.urandom(1024),
+            'org/lora/pytorch_lora_weights.safetensors': os.urandom(1024),
+            'org/lora/README.md': b'lora',
+        }
+        for filename, data in files.items():
+            path = os.path.join(hub_root, *filename.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        local_lora = os.path.join(tmp_dir, 'local.safetensors')
+        with open(local_lora, 'wb') as f:
+            f.write(os.urandom(1024))
+
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        server = serve(hub_root, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            downloader = HuggingFaceDownloader(cache_dir, endpoint=f'http://127.0.0.1:{server.server_address[1]}')
+            for repo_id in ('org/model', 'org/lora'):
+                downloader.download(repo_id)
+                get_cache_index(cache_dir).update_repo(repo_id)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        def no_network(*args, **kwargs):
+            raise OSError('network access while offline')
+
+        patched = [(socket, 'create_connection'), (socket, 'getaddrinfo'), (socket.socket, 'connect')]
+        originals = [getattr(obj, name) for obj, name in patched]
+        for obj, name in patched:
+            setattr(obj, name, no_network)
+        set_allow_network(False)
+        try:
+            resolver = HuggingFaceModelResolver(cache_dir)
+            checks = [
+                ('model', lambda: resolver.resolve_model('org/model'),
+                 lambda x: os.path.isfile(os.path.join(x, 'model_index.json'))),
+                ('lora repo', lambda: resolver.resolve_lora('org/lora'),
+                 lambda x: x.endswith('pytorch_lora_weights.safetensors')),
+                ('local lora', lambda: resolver.resolve_lora(local_lora), lambda x: x == local_lora),
+            ]
+            passed = True
+            for name, resolve, check in checks:
+                result = resolve()
+                elapsed = _measure(resolve, repeat)
+                ok = check(result)
+                passed = passed and ok
+                print(f'{name:<12} {elapsed * 1000:>8.3f} ms  {"ok" if ok else "wrong: " + result}')
+
+            start = time.perf_counter()
+            try:
+                resolver.resolve_model('org/missing')
+                print('missing model was resolved')
+                passed = False
+            except ModelNotFoundOffline as e:
+                print(f'{"missing":<12} {(time.perf_counter() - start) * 1000:>8.3f} ms  ok ({e})')
+            return passed
+        finally:
+            set_allow_network(True)
+            for (obj, name), original in zip(patched, originals):
+                setattr(obj, name, original)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def benchmark_lora(model_id, lora_paths, cache_dir='models', repeat=5):
+    """
+    time of switching the active LoRAs once they are loaded as adapters, against reloading the model with them
+    """
+    import torch
+
+    from stableDiffusionClass import StableDiffusionWrapper
+
+    wrapper = StableDiffusionWrapper()
+    torch_dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+    wrapper.init_wrapper(model_id, cache_dir, torch_dtype, False, 'DPMSolverMultistepScheduler')
+
+    combinations = [[]] + [[lora_path] for lora_path in lora_paths] + [[(lora_path, 0.5) for lora_path in lora_paths]]
+    # every adapter is loaded (and its state dict cached) before anything is measured
+    for loras in combinations:
+        wrapper.set_loras(loras)
+
+    def switch(fuse):
+        for loras in combinations:
+            wrapper.set_loras(loras, fuse)
+
+    for fuse in (False, True):
+        elapsed = _measure(lambda: switch(fuse), repeat) / len(combinations)
+        print(f'switch{" (fused)" if fuse else ""}: {elapsed * 1000:.1f} ms')
+
+    def reload():
+        fresh = StableDiffusionWrapper()
+        fresh.init_wrapper(model_id, cache_dir, torch_dtype, False, 'DPMSolverMultistepScheduler')
+        fresh.set_loras(lora_paths)
+
+    print(f'reload with LoRAs: {_measure(reload, 1) * 1000:.1f} ms')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stable Diffusion GUI benchmarks')
+    subparsers = parser.add_subparsers(dest='name', required=True)
+
+    text_encoder_parser = subparsers.add_parser('text_encoder', help='per chunk vs batched long prompt encoding')
+    text_encoder_parser.add_argument('--model', required=True)
+    text_encoder_parser.add_argument('--cache-dir', default='models')
+    text_encoder_parser.add_argument('--repeat', type=int, default=5)
+
+    encoders_parser = subparsers.add_parser('encoders', help='encode time and size of the output format presets')
+    encoders_parser.add_argument('--images', required=True, help='directory of sample outputs')
+    encoders_parser.add_argument('--repeat', type=int, default=3)
+
+    packing_parser = subparsers.add_parser('packing', help='images/sec with and without batch packing')
+    packing_parser.add_argument('--model', required=True)
+    packing_parser.add_argument('--cache-dir', default='models')
+    packing_parser.add_argument('--count', type=int, default=8)
+
+    startup_parser = subparsers.add_parser('startup', help='import time of the GUI, exits with 1 on regression')
+    startup_parser.add_argument('--module', default='main')
+    startup_parser.add_argument('--budget-ms', type=float, default=900.0)
+
+    download_parser = subparsers.add_parser('download', help='parallel and resumed model download from a local hub stand-in')
+    download_parser.add_argument('--file-count', type=int, default=8)
+    download_parser.add_argument('--file-size-mb', type=int, default=32)
+
+    checkpoint_parser = subparsers.add_parser('checkpoint', help='load time of a checkpoint before and after the conversion')
+    checkpoint_parser.add_argument('checkpoint', help='url or path of the single file checkpoint')
+    checkpoint_parser.add_argument('--cache-dir', default='models')
+    checkpoint_parser.add_argument('--torch-dtype', default='16', choices=['16', '32'])
+
+    lora_parser = subparsers.add_parser('lora', help='switching LoRA adapters against reloading the model')
+    lora_parser.add_argument('--model', required=True)
+    lora_parser.add_argument('--lora', action='append', required=True, help='lora path, can be given more than once')
+    lora_parser.add_argument('--cache-dir', default='models')
+    lora_parser.add_argument('--repeat', type=int, default=5)
+
+    grid_parser = subparsers.add_parser('grid', help='grid assembly of PIL images against one uint8 batch')
+    grid_parser.add_argument('--size', type=int, action='append', help='rows (= cols) of the grid, 4 and 8 by default')
+    grid_parser.add_argument('--repeat', type=int, default=5)
+
+    chunked_grid_parser = subparsers.add_parser('chunked_grid', help='peak memory of grids made in sub-batches')
+    chunked_grid_parser.add_argument('--model', required=True)
+    chunked_grid_parser.add_argument('--cache-dir', default='models')
+    chunked_grid_parser.add_argument('--max-batch-size', type=int, default=4)
+
+    offline_parser = subparsers.add_parser('offline', help='model and LoRA resolution with the network blocked, exits with 1 on failure')
+    offline_parser.add_argument('--repeat', type=int, default=100)
+
+    args = parser.parse_args()
+
+    if args.name == 'text_encoder':
+        benchmark_text_encoder(args.model, cache_dir=args.cache_dir, repeat=args.repeat)
+    elif args.name == 'encoders':
+        benchmark_encoders(args.images, repeat=args.repeat)
+    elif args.name == 'packing':
+        benchmark_packing(args.model, cache_dir=args.cache_dir, generation_count=args.count)
+    elif args.name == 'startup':
+        sys.exit(0 if check_startup(args.module, args.budget_ms) else 1)
+    elif args.name == 'download':
+        benchmark_download(args.file_count, args.file_size_mb)
+    elif args.name == 'checkpoint':
+        benchmark_checkpoint(args.checkpoint, args.cache_dir, args.torch_dtype)
+    elif args.name == 'lora':
+        benchmark_lora(args.model, args.lora, cache_dir=args.cache_dir, repeat=args.repeat)
+    elif args.name == 'offline':
+        sys.exit(0 if check_offline(args.repeat) else 1)
+    elif args.name == 'grid':
+        benchmark_grid(args.size or (4, 8), repeat=args.repeat)
+    elif args.name == 'chunked_grid':
+        benchmark_chunked_grid(args.model, cache_dir=args.cache_dir, max_batch_size=args.max_batch_size)
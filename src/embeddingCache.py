@@ -0,0 +1,104 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import torch
+
+
+class EmbeddingCache:
+    """
+    LRU cache of text encoder outputs limited by the size of the cached tensors
+
+    entries put with persist=True are written to disk_dir as well, so they survive restarts
+    (it is meant for negative prompts, which rarely change)
+    """
+    def __init__(self, max_size=256 * 1024 ** 2, disk_dir=None):
+        super(EmbeddingCache, self).__init__()
+        self.__initVal(max_size, disk_dir)
+
+    def __initVal(self, max_size, disk_dir):
+        self.__max_size = max_size
+        self.__disk_dir = disk_dir
+        self.__entries = OrderedDict()
+        self.__size = 0
+
+        self.__hits = 0
+        self.__disk_hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    def set_disk_dir(self, disk_dir):
+        self.__disk_dir = disk_dir
+
+    def set_max_size(self, max_size):
+        self.__max_size = max_size
+        self.__evict()
+
+    def __get_filename(self, key):
+        return os.path.join(self.__disk_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pt')
+
+    def get(self, key, device=None):
+        embeds = self.__entries.get(key)
+        if embeds is not None:
+            self.__hits += 1
+            self.__entries.move_to_end(key)
+            return embeds
+
+        if self.__disk_dir:
+            filename = self.__get_filename(key)
+            if os.path.exists(filename):
+                try:
+                    # only tensors are in it, a tampered file in the cache directory can't run code
+                    embeds = torch.load(filename, map_location='cpu', weights_only=True)
+                    embeds = embeds.to(device) if device else embeds
+                    self.__disk_hits += 1
+                    self.__put_in_memory(key, embeds)
+                    return embeds
+                except Exception as e:
+                    # broken file, it will be overwritten by the next put
+                    print(e)
+
+        self.__misses += 1
+        return None
+
+    def put(self, key, embeds, persist=False):
+        embeds = embeds.detach()
+        self.__put_in_memory(key, embeds)
+
+        if persist and self.__disk_dir:
+            os.makedirs(self.__disk_dir, exist_ok=True)
+            filename = self.__get_filename(key)
+            tmp_filename = filename + '.tmp'
+            torch.save(embeds.cpu(), tmp_filename)
+            os.replace(tmp_filename, filename)
+
+    def __put_in_memory(self, key, embeds):
+        if key in self.__entries:
+            self.__size -= self.__get_tensor_size(self.__entries.pop(key))
+        self.__entries[key] = embeds
+        self.__size += self.__get_tensor_size(embeds)
+        self.__evict()
+
+    def __evict(self):
+        while self.__size > self.__max_size and len(self.__entries) > 1:
+            _, evicted = self.__entries.popitem(last=False)
+            self.__size -= self.__get_tensor_size(evicted)
+            self.__evictions += 1
+
+    def __get_tensor_size(self, embeds):
+        return embeds.numel() * embeds.element_size()
+
+    def clear(self):
+        self.__entries.clear()
+        self.__size = 0
+
+    def get_stats(self):
+        return {
+            'hits': self.__hits,
+            'disk_hits': self.__disk_hits,
+            'misses': self.__misses,
+            'evictions': self.__evictions,
+            'entries': len(self.__entries),
+            'size': self.__size,
+            'max_size': self.__max_size
+        }
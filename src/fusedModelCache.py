@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+from loraManager import resolve_lora_file
+
+FUSED_DIR = 'fused'
+MANIFEST_FILENAME = 'fused.json'
+# the components LoRAs change, the others are loaded from the base model
+FUSED_COMPONENTS = ('unet', 'text_encoder', 'text_encoder_2')
+
+# (realpath, size, mtime) -> sha256, LoRA files are hashed once per session
+file_hashes = {}
+
+
+def get_file_hash(filename):
+    """
+    :return: sha256 of the file, blobs of the HuggingFace cache are already named by it
+    """
+    path = os.path.realpath(filename)
+    if os.path.basename(os.path.dirname(path)) == 'blobs' and re.fullmatch(r'[0-9a-f]{64}', os.path.basename(path)):
+        return os.path.basename(path)
+
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in file_hashes:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 ** 2), b''):
+                h.update(chunk)
+        file_hashes[key] = h.hexdigest()
+    return file_hashes[key]
+
+
+def get_model_revision(model_path):
+    """
+    :param model_path: snapshot directory of a hub model or a local diffusers directory
+    :return: commit hash of the snapshot, or a signature of the files of a local directory
+    """
+    model_path = os.path.abspath(model_path)
+    if os.path.basename(os.path.dirname(model_path)) == 'snapshots':
+        return os.path.basename(model_path)
+
+    files = []
+    for root, dirs, filenames in os.walk(model_path):
+        dirs.sort()
+        for filename in sorted(filenames):
+            stat = os.stat(os.path.join(root, filename))
+            files.append([os.path.relpath(os.path.join(root, filename), model_path), stat.st_size, stat.st_mtime_ns])
+    return 'local-' + hashlib.sha1(json.dumps(files).encode('utf-8')).hexdigest()
+
+
+class FusedModelCache:
+    """
+    UNet and text encoders with a LoRA set fused in, saved as safetensors in cache_dir/fused/<key>
+
+    the key is a hash of the base model revision, the LoRA files (by sha256), the scales and the dtype,
+    so an entry can't be used once any of them changes; older entries of the same model, LoRAs and scales are deleted
+    """
+    def __init__(self, cache_dir):
+        super(FusedModelCache, self).__init__()
+        self.__initVal(cache_dir)
+
+    def __initVal(self, cache_dir):
+        self.__root = os.path.join(cache_dir, FUSED_DIR)
+        self.__cache_dir = cache_dir
+
+    def get_manifest(self, model_id, model_path, loras, torch_dtype):
+        """
+        :param loras: ((lora_path, scale), ...)
+        :return: key, manifest
+        """
+        manifest = {
+            'model_id': model_id,
+            'revision': get_model_revision(model_path),
+            'torch_dtype': str(torch_dtype),
+            'loras': [{'path': lora_path, 'sha256': get_file_hash(resolve_lora_file(lora_path, self.__cache_dir)), 'scale': scale}
+                      for lora_path, scale in loras],
+        }
+        key = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+        return key, manifest
+
+    def get_path(self, key):
+        """
+        :return: directory of the entry, None if there is no complete entry
+        """
+        path = os.path.join(self.__root, key)
+        if os.path.isfile(os.path.join(path, MANIFEST_FILENAME)):
+            return path
+        return None
+
+    def save(self, key, manifest, pipeline):
+        """
+        :param pipeline: pipeline with the LoRAs fused and unloaded, the weights are saved as they are
+        :return: directory of the entry
+        """
+        path = os.path.join(self.__root, key)
+        # written next to it first, an interrupted save is never taken for an entry
+        tmp_path = path + '.incomplete'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+        components = []
+        for name in FUSED_COMPONENTS:
+            component = getattr(pipeline, name, None)
+            if component is not None:
+                component.save_pretrained(os.path.join(tmp_path, name), safe_serialization=True)
+                components.append(name)
+
+        with open(os.path.join(tmp_path, MANIFEST_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump({**manifest, 'components': components, 'created': time.time()}, f, indent=2)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+        self.prune(key, manifest)
+        return path
+
+    def load_manifest(self, key):
+        with open(os.path.join(self.__root, key, MANIFEST_FILENAME), encoding='utf-8') as f:
+            return json.load(f)
+
+    def prune(self, key, manifest):
+        """
+        delete the entries of the same model, dtype, LoRA paths and scales which were made from other inputs
+        (another revision of the model or other LoRA files), an entry with other scales is still valid
+        """
+        loras = [[lora['path'], float(lora['scale'])] for lora in manifest['loras']]
+        for name in os.listdir(self.__root):
+            if name == key or name.endswith('.incomplete'):
+                continue
+            try:
+                other = self.load_manifest(name)
+            except (OSError, ValueError):
+                continue
+            if (other.get('model_id') == manifest['model_id'] and other.get('torch_dtype') == manifest['torch_dtype']
+                    and [[lora.get('path'), float(lora.get('scale', 1.0))] for lora in other.get('loras', [])] == loras):
+                print('stale fused model is deleted:', name)
+                shutil.rmtree(os.path.join(self.__root, name), ignore_errors=True)
+
+    def get_entries(self):
+        """
+        :return: [(key, manifest), ...]
+        """
+        if not os.path.isdir(self.__root):
+            return []
+        entries = []
+        for name in sorted(os.listdir(self.__root)):
+            try:
+                entries.append((name, self.load_manifest(name)))
+            except (OSError, ValueError):
+                pass
+        return entries
@@ -0,0 +1,105 @@
+import random
+import tempfile
+import time
+
+from memoryGovernor import get_memory_governor
+from script import generate_image
+
+# canvases bigger than this are memory-mapped temporary files instead of RAM
+MEMMAP_THRESHOLD = 512 * 1024 ** 2
+
+
+class GridCanvas:
+    """
+    preallocated uint8 (rows * height, cols * width, 3) grid which the tiles are written into as they are made,
+    cells which don't get a tile stay black
+    """
+    def __init__(self, rows, cols, height, width, memmap_threshold=MEMMAP_THRESHOLD, memmap_dir=None):
+        super(GridCanvas, self).__init__()
+        self.__initVal(rows, cols, height, width, memmap_threshold, memmap_dir)
+
+    def __initVal(self, rows, cols, height, width, memmap_threshold, memmap_dir):
+        import numpy as np
+
+        self.__rows = rows
+        self.__cols = cols
+        self.__height = height
+        self.__width = width
+
+        shape = (rows * height, cols * width, 3)
+        if rows * cols * height * width * 3 > memmap_threshold:
+            # the file is deleted by the OS once the mapping is gone (the writer may still hold it after this)
+            self.__canvas = np.memmap(tempfile.TemporaryFile(dir=memmap_dir), dtype=np.uint8, mode='w+', shape=shape)
+        else:
+            self.__canvas = np.zeros(shape, dtype=np.uint8)
+
+    def put(self, index, tiles):
+        """
+        :param index: cell of the first tile, row by row
+        :param tiles: uint8 ndarray of (batch, height, width, 3)
+        """
+        for i, tile in enumerate(tiles, index):
+            row, col = divmod(i, self.__cols)
+            self.__canvas[row * self.__height:(row + 1) * self.__height, col * self.__width:(col + 1) * self.__width] = tile
+
+    def get_array(self):
+        return self.__canvas
+
+    def is_memmap(self):
+        return hasattr(self.__canvas, 'filename')
+
+
+def get_tile_seeds(seed, count):
+    """
+    tile i always gets seed + i, whatever the sub-batch size is, so a tile can be made again on its own
+    """
+    return [seed + i for i in range(count)]
+
+
+def generate_grid(pipeline, rows, cols, max_batch_size, seed=None, tile_count=None, memmap_dir=None, **pipeline_args):
+    """
+    denoise the tiles of a rows x cols grid in sub-batches of at most max_batch_size images, each one written into
+    the canvas right away, so the peak memory of the pipeline doesn't grow with the grid
+
+    a sub-batch which runs out of memory is tried again at half the size
+
+    :param seed: seed of the first tile, a random one if it is None
+    :param tile_count: tiles to make, rows * cols if it is None
+    :param pipeline_args: arguments of the pipeline call except num_images_per_prompt and generator
+    :return: canvas, seed, stats {"batch_size", "batches", "seconds", "memmap"}
+    """
+    import torch
+
+    width = pipeline_args.get('width') or pipeline.unet.config.sample_size * pipeline.vae_scale_factor
+    height = pipeline_args.get('height') or pipeline.unet.config.sample_size * pipeline.vae_scale_factor
+    tile_count = rows * cols if tile_count is None else min(tile_count, rows * cols)
+    seed = random.randrange(2 ** 32) if seed is None else seed
+    seeds = get_tile_seeds(seed, tile_count)
+
+    canvas = GridCanvas(rows, cols, height, width, memmap_dir=memmap_dir)
+    batch_size = max(1, max_batch_size)
+    batches = 0
+    elapsed = 0.0
+    index = 0
+    while index < tile_count:
+        count = min(batch_size, tile_count - index)
+        # the embeddings are for one image, the pipeline repeats them num_images_per_prompt times
+        generators = [torch.Generator(pipeline.device).manual_seed(s) for s in seeds[index:index + count]]
+        start = time.perf_counter()
+        try:
+            tiles = generate_image(pipeline, as_array=True, num_images_per_prompt=count, generator=generators, **pipeline_args)
+        except Exception as e:
+            # torch.cuda.OutOfMemoryError
+            if type(e).__name__ == 'OutOfMemoryError' and batch_size > 1:
+                batch_size = max(1, count // 2)
+                print('out of memory, grid sub-batch size:', batch_size)
+                get_memory_governor().collect()
+                continue
+            raise
+        elapsed += time.perf_counter() - start
+        canvas.put(index, tiles)
+        del tiles
+        index += count
+        batches += 1
+
+    return canvas, seed, {'batch_size': batch_size, 'batches': batches, 'seconds': round(elapsed, 3), 'memmap': canvas.is_memmap()}
@@ -0,0 +1,335 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+REPO_TYPES = {'models': 'model', 'datasets': 'dataset', 'spaces': 'space'}
+# single file checkpoints which were converted to diffusers directories, converted/<name> is the model id of them
+CONVERTED_DIR = 'converted'
+INDEX_FILENAME = '.model_index.json'
+INDEX_VERSION = 1
+# last used time is saved at most once a minute per model, init_wrapper is called before every generation
+LAST_USED_SAVE_INTERVAL = 60
+
+
+def get_repo_folder_name(repo_id, repo_type='model'):
+    if repo_id.startswith(CONVERTED_DIR + '/'):
+        return repo_id
+    return f'{repo_type}s--' + repo_id.replace('/', '--')
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class HuggingFaceCacheIndex:
+    """
+    repos, revisions and sizes of the HuggingFace cache directory, saved next to the repos
+
+    a repo is scanned again only when the mtime of its directory, blobs, snapshots, refs (or of a ref) changed,
+    so the cache directory isn't walked blob by blob like scan_cache_dir does every time
+    """
+    def __init__(self, cache_dir):
+        super(HuggingFaceCacheIndex, self).__init__()
+        self.__initVal(cache_dir)
+
+    def __initVal(self, cache_dir):
+        self.__cache_dir = cache_dir
+        self.__filename = os.path.join(cache_dir, INDEX_FILENAME)
+        # the install thread and the GUI thread use the same index
+        self.__lock = threading.RLock()
+        self.__repos = {}
+        # repo_id -> timestamp of the last time it was loaded, it isn't touched by rescans
+        self.__last_used = {}
+        self.__load()
+
+    def __load(self):
+        try:
+            with open(self.__filename, encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('version') == INDEX_VERSION:
+                self.__repos = index['repos']
+                self.__last_used = index.get('last_used', {})
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def __save(self):
+        tmp_filename = self.__filename + '.tmp'
+        try:
+            with open(tmp_filename, 'w', encoding='utf-8') as f:
+                json.dump({'version': INDEX_VERSION, 'repos': self.__repos, 'last_used': self.__last_used}, f)
+            os.replace(tmp_filename, self.__filename)
+        except OSError as e:
+            # a read-only cache directory still works, it is just scanned every time
+            print('cache index is not saved:', e)
+
+    def __get_signature(self, repo_path):
+        refs_path = os.path.join(repo_path, 'refs')
+        signature = [get_mtime(os.path.join(repo_path, name)) for name in ('', 'blobs', 'snapshots', 'refs')]
+        if os.path.isdir(refs_path):
+            for root, dirs, files in os.walk(refs_path):
+                signature.extend(get_mtime(os.path.join(root, filename)) for filename in sorted(files))
+        return signature
+
+    def __scan_converted(self, folder_name, repo_path):
+        if not os.path.isfile(os.path.join(repo_path, 'model_index.json')):
+            return None
+        size = 0
+        for root, dirs, files in os.walk(repo_path):
+            size += sum(os.stat(os.path.join(root, filename)).st_size for filename in files)
+        return {
+            'repo_id': folder_name,
+            'repo_type': 'model',
+            'signature': self.__get_signature(repo_path),
+            'revisions': [],
+            'size': size,
+        }
+
+    def __scan_repo(self, folder_name, repo_path):
+        if folder_name.startswith(CONVERTED_DIR + '/'):
+            return self.__scan_converted(folder_name, repo_path)
+        repo_type, repo_id = folder_name.split('--', 1)
+        snapshots_path = os.path.join(repo_path, 'snapshots')
+        if not os.path.isdir(snapshots_path):
+            # not a repo, or a download which didn't get far enough
+            return None
+
+        refs = {}
+        refs_path = os.path.join(repo_path, 'refs')
+        for root, dirs, files in os.walk(refs_path):
+            for filename in files:
+                with open(os.path.join(root, filename), encoding='utf-8') as f:
+                    refs.setdefault(f.read().strip(), []).append(os.path.relpath(os.path.join(root, filename), refs_path).replace(os.sep, '/'))
+
+        # files in snapshots are symlinks to the blobs (or copies of them if symlinks are not supported)
+        size = 0
+        blobs_path = os.path.join(repo_path, 'blobs')
+        if os.path.isdir(blobs_path):
+            with os.scandir(blobs_path) as it:
+                size += sum(entry.stat().st_size for entry in it if entry.is_file())
+
+        revisions = []
+        with os.scandir(snapshots_path) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                revision_blobs = {}
+                for root, dirs, files in os.walk(entry.path):
+                    for filename in files:
+                        path = os.path.join(root, filename)
+                        if not os.path.islink(path):
+                            size += os.stat(path).st_size
+                        revision_blobs[os.path.realpath(path)] = os.stat(path).st_size
+                revisions.append({'commit_hash': entry.name, 'refs': sorted(refs.get(entry.name, [])),
+                                  'size': sum(revision_blobs.values())})
+
+        return {
+            'repo_id': repo_id.replace('--', '/'),
+            'repo_type': REPO_TYPES.get(repo_type, repo_type),
+            'signature': self.__get_signature(repo_path),
+            'revisions': sorted(revisions, key=lambda x: x['commit_hash']),
+            'size': size,
+        }
+
+    def refresh(self):
+        """
+        rescan the repos which were changed, added or removed since the last refresh
+        """
+        with self.__lock:
+            is_changed = False
+            folder_names = set()
+            if os.path.isdir(self.__cache_dir):
+                with os.scandir(self.__cache_dir) as it:
+                    for entry in it:
+                        if entry.is_dir() and entry.name.split('--', 1)[0] in REPO_TYPES and '--' in entry.name:
+                            folder_names.add(entry.name)
+            converted_path = os.path.join(self.__cache_dir, CONVERTED_DIR)
+            if os.path.isdir(converted_path):
+                with os.scandir(converted_path) as it:
+                    for entry in it:
+                        # .incomplete is a conversion which is still running (or was interrupted)
+                        if entry.is_dir() and not entry.name.endswith('.incomplete'):
+                            folder_names.add(f'{CONVERTED_DIR}/{entry.name}')
+
+            for folder_name in list(self.__repos.keys()):
+                if folder_name not in folder_names:
+                    del self.__repos[folder_name]
+                    is_changed = True
+
+            for folder_name in folder_names:
+                repo = self.__repos.get(folder_name)
+                repo_path = os.path.join(self.__cache_dir, folder_name)
+                if repo is not None and repo['signature'] == self.__get_signature(repo_path):
+                    continue
+                is_changed |= self.__update_repo(folder_name, repo_path)
+
+            if is_changed:
+                self.__save()
+
+    def __update_repo(self, folder_name, repo_path):
+        try:
+            repo = self.__scan_repo(folder_name, repo_path)
+        except OSError as e:
+            print(f'{folder_name} is not indexed:', e)
+            repo = None
+        if repo is None:
+            return self.__repos.pop(folder_name, None) is not None
+        self.__repos[folder_name] = repo
+        return True
+
+    def update_repo(self, repo_id, repo_type='model'):
+        """
+        scan one repo right after it is installed
+        """
+        with self.__lock:
+            folder_name = get_repo_folder_name(repo_id, repo_type)
+            if self.__update_repo(folder_name, os.path.join(self.__cache_dir, folder_name)):
+                self.__save()
+
+    def remove_repo(self, repo_id, repo_type='model'):
+        """
+        delete every revision of the repo
+
+        :return: freed size in bytes
+        """
+        removed, freed_size = self.remove_repos([repo_id], repo_type)
+        if len(removed) == 0:
+            raise Exception(f'{repo_id} is not deleted.')
+        return freed_size
+
+    def remove_repos(self, repo_ids, repo_type='model'):
+        """
+        delete every revision of the repos, the index is saved once at the end
+        a repo which can't be deleted is skipped
+
+        :return: (repo ids which were deleted, freed size in bytes)
+        """
+        with self.__lock:
+            removed = []
+            freed_size = 0
+            for repo_id in repo_ids:
+                folder_name = get_repo_folder_name(repo_id, repo_type)
+                try:
+                    shutil.rmtree(os.path.join(self.__cache_dir, folder_name))
+                except OSError as e:
+                    print(f'{repo_id} is not deleted:', e)
+                    # it may be partly deleted
+                    self.__update_repo(folder_name, os.path.join(self.__cache_dir, folder_name))
+                    continue
+                repo = self.__repos.pop(folder_name, None)
+                self.__last_used.pop(repo_id, None)
+                freed_size += repo['size'] if repo else 0
+                removed.append(repo_id)
+            self.__save()
+            return removed, freed_size
+
+    def record_use(self, repo_id):
+        """
+        call it when the model is loaded, the least recently used models are evicted first
+        """
+        with self.__lock:
+            now = time.time()
+            is_saved = now - self.__last_used.get(repo_id, 0.0) >= LAST_USED_SAVE_INTERVAL
+            self.__last_used[repo_id] = now
+            if is_saved:
+                self.__save()
+
+    def get_last_used(self, repo_id):
+        """
+        :return: timestamp of the last load, the latest access time of the blobs if it wasn't loaded since the index was made
+        """
+        with self.__lock:
+            last_used = self.__last_used.get(repo_id)
+        return last_used if last_used is not None else self.get_last_accessed(repo_id)
+
+    def get_eviction_candidates(self, quota, keep=()):
+        """
+        the least recently used models which have to go for the total size to fit in quota
+        only the models loaded by this app (see record_use) are evicted, the others may be used by something else
+
+        :param quota: bytes, 0 for no quota
+        :param keep: repo ids which must not be deleted (e.g. the current model)
+        :return: [repo, ...]
+        """
+        with self.__lock:
+            total_size = self.get_total_size()
+            if quota <= 0 or total_size <= quota:
+                return []
+            candidates = [dict(repo) for repo in self.__repos.values() if repo['repo_type'] == 'model'
+                          and repo['repo_id'] in self.__last_used and repo['repo_id'] not in keep]
+            candidates.sort(key=lambda x: self.__last_used[x['repo_id']])
+
+            evicted = []
+            for repo in candidates:
+                if total_size <= quota:
+                    break
+                evicted.append(repo)
+                total_size -= repo['size']
+            return evicted
+
+    def evict(self, quota, keep=()):
+        """
+        delete the least recently used models until the total size fits in quota, see get_eviction_candidates
+
+        :return: repo ids which were deleted
+        """
+        with self.__lock:
+            evicted = [repo['repo_id'] for repo in self.get_eviction_candidates(quota, keep)]
+            if len(evicted) == 0:
+                return []
+            evicted, freed_size = self.remove_repos(evicted)
+            print(f'evicted {len(evicted)} model(s) for the quota, freed {freed_size} bytes:', evicted)
+            return evicted
+
+    def get_repos(self, repo_type=None):
+        with self.__lock:
+            return [dict(repo) for repo in self.__repos.values() if repo_type is None or repo['repo_type'] == repo_type]
+
+    def get_repo(self, repo_id, repo_type='model'):
+        with self.__lock:
+            repo = self.__repos.get(get_repo_folder_name(repo_id, repo_type))
+            return dict(repo) if repo else None
+
+    def get_last_accessed(self, repo_id, repo_type='model'):
+        """
+        the latest access time of the blobs of the repo like scan_cache_dir does, it isn't indexed because reading changes it
+
+        :return: timestamp, 0.0 if it is not found
+        """
+        folder_name = get_repo_folder_name(repo_id, repo_type)
+        last_accessed = 0.0
+        # converted checkpoints have no blobs, the files are in the directory itself
+        for name in ('blobs', 'snapshots', ''):
+            path = os.path.join(self.__cache_dir, folder_name, name)
+            for root, dirs, files in os.walk(path):
+                for filename in files:
+                    try:
+                        last_accessed = max(last_accessed, os.stat(os.path.join(root, filename)).st_atime)
+                    except OSError:
+                        pass
+            if last_accessed:
+                break
+        return last_accessed
+
+    def get_total_size(self):
+        with self.__lock:
+            return sum(repo['size'] for repo in self.__repos.values())
+
+
+cache_indexes = {}
+cache_indexes_lock = threading.Lock()
+
+
+def get_cache_index(cache_dir):
+    """
+    the index of cache_dir, every caller of the same directory shares it
+    """
+    key = os.path.normcase(os.path.abspath(cache_dir))
+    with cache_indexes_lock:
+        if key not in cache_indexes:
+            cache_indexes[key] = HuggingFaceCacheIndex(cache_dir)
+        return cache_indexes[key]
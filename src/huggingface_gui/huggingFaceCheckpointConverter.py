@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import time
+import urllib.parse
+
+from .huggingFaceCacheIndex import CONVERTED_DIR
+
+CONVERSION_INFO_FILENAME = 'conversion.json'
+
+
+def get_converted_model_id(checkpoint, torch_dtype='16'):
+    """
+    :param checkpoint: url or path of the single file checkpoint
+    :return: model id of the converted directory, e.g. converted/v1-5-pruned-fp16
+    """
+    filename = os.path.basename(urllib.parse.urlparse(checkpoint).path.rstrip('/'))
+    name = os.path.splitext(filename)[0] or 'checkpoint'
+    for char in r'\/:*?"<>| ':
+        name = name.replace(char, '_')
+    return f'{CONVERTED_DIR}/{name}-fp{torch_dtype}'
+
+
+def convert_checkpoint(checkpoint, cache_dir, torch_dtype='16'):
+    """
+    convert the single file checkpoint to a diffusers directory of safetensors once,
+    from_pretrained memory-maps it instead of parsing and converting the checkpoint on every load
+
+    :param torch_dtype: '16' or '32' like the setting
+    :return: model id of the converted directory, which init_wrapper loads from cache_dir
+    """
+    import torch
+    from diffusers import StableDiffusionPipeline
+
+    model_id = get_converted_model_id(checkpoint, torch_dtype)
+    converted_path = os.path.join(cache_dir, model_id)
+    if os.path.isfile(os.path.join(converted_path, 'model_index.json')):
+        return model_id
+
+    dtype = torch.float16 if str(torch_dtype) == '16' else torch.float32
+
+    start = time.perf_counter()
+    pipeline = StableDiffusionPipeline.from_single_file(checkpoint, cache_dir=cache_dir, torch_dtype=dtype)
+    single_file_load_time = time.perf_counter() - start
+
+    # written next to it first, so an interrupted conversion never looks like a converted model
+    tmp_path = converted_path + '.incomplete'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    pipeline.save_pretrained(tmp_path, safe_serialization=True)
+    del pipeline
+
+    start = time.perf_counter()
+    StableDiffusionPipeline.from_pretrained(tmp_path, torch_dtype=dtype)
+    converted_load_time = time.perf_counter() - start
+
+    info = {
+        'checkpoint': checkpoint,
+        'torch_dtype': str(torch_dtype),
+        'single_file_load_time': round(single_file_load_time, 3),
+        'converted_load_time': round(converted_load_time, 3),
+    }
+    with open(os.path.join(tmp_path, CONVERSION_INFO_FILENAME), 'w', encoding='utf-8') as f:
+        json.dump(info, f, indent=2)
+    os.replace(tmp_path, converted_path)
+
+    print(f'{checkpoint} is converted to {model_id}, load time: {single_file_load_time:.2f} sec -> {converted_load_time:.2f} sec')
+    return model_id
@@ -0,0 +1,231 @@
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from .huggingFaceCacheIndex import get_repo_folder_name
+
+DEFAULT_ENDPOINT = 'https://huggingface.co'
+CHUNK_SIZE = 1024 ** 2
+
+# files of a diffusers pipeline which from_pretrained doesn't need
+IGNORE_PATTERNS = ['*.ckpt', '*.msgpack', '*.h5', '*.onnx', '*.onnx_data', '*.pb', '*.md', '.gitattributes', '*.png', '*.jpg']
+WEIGHT_EXTS = ('.safetensors', '.bin')
+
+
+class DownloadCancelled(Exception):
+    pass
+
+
+def get_endpoint():
+    return os.environ.get('HF_ENDPOINT', DEFAULT_ENDPOINT).rstrip('/')
+
+
+def select_files(siblings):
+    """
+    pick the files from_pretrained loads: the folders in model_index.json, safetensors over bin,
+    no variants (e.g. fp16, non_ema) and no single file checkpoints
+
+    :param siblings: "siblings" of the revision api
+    """
+    filenames = [sibling['rfilename'] for sibling in siblings]
+    filenames = [filename for filename in filenames if not any(fnmatch.fnmatch(os.path.basename(filename), p) for p in IGNORE_PATTERNS)]
+    if 'model_index.json' not in filenames:
+        # not a diffusers pipeline (e.g. a LoRA), everything is downloaded
+        return filenames
+
+    selected = ['model_index.json']
+    folders = {}
+    for filename in filenames:
+        if '/' in filename:
+            folders.setdefault(filename.split('/')[0], []).append(filename)
+    for folder, folder_filenames in folders.items():
+        weights = [filename for filename in folder_filenames if filename.endswith(WEIGHT_EXTS)
+                   # variants look like diffusion_pytorch_model.fp16.safetensors
+                   and os.path.basename(filename).count('.') == 1]
+        has_safetensors = any(filename.endswith('.safetensors') for filename in weights)
+        for filename in folder_filenames:
+            if filename.endswith(WEIGHT_EXTS):
+                if filename in weights and (filename.endswith('.safetensors') or not has_safetensors):
+                    selected.append(filename)
+            else:
+                selected.append(filename)
+    return selected
+
+
+def get_git_blob_id(data):
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+def update_hash_from_file(h, filename):
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h
+
+
+class HuggingFaceDownloader:
+    """
+    downloads the files of a repo straight into the HuggingFace cache layout (blobs, snapshots, refs)
+    several files at once, an interrupted file is resumed from its .incomplete blob with a Range request
+    every blob is checked against the hash of the hub (sha256 for lfs files, git blob id for the rest) before it is renamed
+    """
+    def __init__(self, cache_dir, endpoint=None, token=None, max_workers=8):
+        super(HuggingFaceDownloader, self).__init__()
+        self.__initVal(cache_dir, endpoint, token, max_workers)
+
+    def __initVal(self, cache_dir, endpoint, token, max_workers):
+        self.__cache_dir = cache_dir
+        self.__endpoint = (endpoint or get_endpoint()).rstrip('/')
+        self.__token = token or os.environ.get('HF_TOKEN')
+        self.__max_workers = max_workers
+
+        self.__lock = threading.Lock()
+        self.__downloaded_size = 0
+        self.__total_size = 0
+
+    def __open(self, url, headers=None):
+        request = urllib.request.Request(url, headers=headers or {})
+        if self.__token:
+            request.add_header('Authorization', f'Bearer {self.__token}')
+        return urllib.request.urlopen(request, timeout=60)
+
+    def get_revision_info(self, repo_id, revision='main'):
+        """
+        :return: {"sha": commit hash, "siblings": [{"rfilename", "size", "blobId", "lfs"}, ...]}
+        """
+        url = f'{self.__endpoint}/api/models/{repo_id}/revision/{urllib.parse.quote(revision, safe="")}?blobs=true'
+        with self.__open(url) as response:
+            return json.loads(response.read())
+
+    def download(self, repo_id, revision='main', progress_callback=None, is_cancelled=lambda: False):
+        """
+        :param progress_callback: called with (downloaded bytes, total bytes) from the download threads
+        :return: snapshot directory
+        """
+        info = self.get_revision_info(repo_id, revision)
+        commit_hash = info['sha']
+        siblings = {sibling['rfilename']: sibling for sibling in info['siblings']}
+        filenames = select_files(info['siblings'])
+
+        repo_path = os.path.join(self.__cache_dir, get_repo_folder_name(repo_id))
+        snapshot_path = os.path.join(repo_path, 'snapshots', commit_hash)
+        os.makedirs(os.path.join(repo_path, 'blobs'), exist_ok=True)
+
+        # files with the same content share a blob, it is downloaded once
+        blobs = {}
+        lfs_blob_names = set()
+        for filename in filenames:
+            sibling = siblings[filename]
+            lfs = sibling.get('lfs')
+            # the blob is named by the etag of the file, which is the sha256 for lfs files and the git blob id for the rest
+            blob_name = lfs['sha256'] if lfs else sibling['blobId']
+            size = lfs['size'] if lfs else sibling.get('size', 0)
+            blobs.setdefault((blob_name, size), []).append(filename)
+            if lfs:
+                lfs_blob_names.add(blob_name)
+
+        self.__downloaded_size = 0
+        self.__total_size = sum(size for _, size in blobs.keys())
+        for blob_name, size in blobs.keys():
+            # what is already there counts as downloaded
+            blob_path = os.path.join(repo_path, 'blobs', blob_name)
+            if os.path.exists(blob_path):
+                self.__downloaded_size += size
+            elif os.path.exists(blob_path + '.incomplete'):
+                self.__downloaded_size += os.path.getsize(blob_path + '.incomplete')
+        if progress_callback:
+            progress_callback(self.__downloaded_size, self.__total_size)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.__max_workers) as executor:
+            futures = [executor.submit(self.__download_blob, repo_id, commit_hash, repo_path, filenames, blob_name, size,
+                                       blob_name in lfs_blob_names, progress_callback, is_cancelled)
+                       for (blob_name, size), filenames in blobs.items()]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        # refs are written last, a repo without them isn't complete
+        ref_path = os.path.join(repo_path, 'refs', revision)
+        os.makedirs(os.path.dirname(ref_path), exist_ok=True)
+        if revision != commit_hash:
+            with open(ref_path, 'w', encoding='utf-8') as f:
+                f.write(commit_hash)
+        print(f'{repo_id}: {len(filenames)} files, {self.__total_size} bytes in {time.perf_counter() - start:.1f} sec')
+        return snapshot_path
+
+    def __download_blob(self, repo_id, commit_hash, repo_path, filenames, blob_name, size, is_lfs, progress_callback, is_cancelled):
+        blob_path = os.path.join(repo_path, 'blobs', blob_name)
+        incomplete_path = blob_path + '.incomplete'
+        offset = os.path.getsize(incomplete_path) if os.path.exists(incomplete_path) else 0
+        # sha256 of lfs files is made while they are written, the rest are small and read again at the end
+        sha256 = None
+        # "offset == size" means it was interrupted after the whole file was written, before the rename
+        if not os.path.exists(blob_path) and not (size and offset == size):
+            url = f'{self.__endpoint}/{repo_id}/resolve/{commit_hash}/{urllib.parse.quote(filenames[0])}'
+            headers = {'Range': f'bytes={offset}-'} if offset else {}
+
+            with self.__open(url, headers) as response:
+                if offset and response.status != 206:
+                    # the server doesn't resume, start over
+                    self.__add_progress(-offset, progress_callback)
+                    offset = 0
+                if is_lfs:
+                    sha256 = update_hash_from_file(hashlib.sha256(), incomplete_path) if offset else hashlib.sha256()
+                with open(incomplete_path, 'ab' if offset else 'wb') as f:
+                    while True:
+                        if is_cancelled():
+                            raise DownloadCancelled('Download cancelled.')
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        if sha256 is not None:
+                            sha256.update(chunk)
+                        self.__add_progress(len(chunk), progress_callback)
+
+        if not os.path.exists(blob_path):
+            if size and os.path.getsize(incomplete_path) != size:
+                raise Exception(f'{filenames[0]} is {os.path.getsize(incomplete_path)} bytes, expected {size} bytes')
+            if is_lfs:
+                digest = (sha256 or update_hash_from_file(hashlib.sha256(), incomplete_path)).hexdigest()
+            else:
+                with open(incomplete_path, 'rb') as f:
+                    digest = get_git_blob_id(f.read())
+            if digest != blob_name:
+                # a resumed file with a broken beginning can't be fixed, it is downloaded again next time
+                os.remove(incomplete_path)
+                raise Exception(f'{filenames[0]} is corrupted, its hash is {digest}, expected {blob_name}')
+            os.replace(incomplete_path, blob_path)
+
+        for filename in filenames:
+            self.__link(blob_path, os.path.join(repo_path, 'snapshots', commit_hash, filename))
+
+    def __add_progress(self, size, progress_callback):
+        with self.__lock:
+            self.__downloaded_size += size
+            downloaded_size = self.__downloaded_size
+        if progress_callback:
+            progress_callback(downloaded_size, self.__total_size)
+
+    def __link(self, blob_path, snapshot_file_path):
+        if os.path.lexists(snapshot_file_path):
+            return
+        os.makedirs(os.path.dirname(snapshot_file_path), exist_ok=True)
+        try:
+            # relative like huggingface_hub does, so the cache directory can be moved
+            os.symlink(os.path.relpath(blob_path, os.path.dirname(snapshot_file_path)), snapshot_file_path)
+        except OSError:
+            # windows without developer mode
+            shutil.copyfile(blob_path, snapshot_file_path)
@@ -1,10 +1,13 @@
 import importlib
 import os
 
-from huggingface_hub import scan_cache_dir, RepoCard
-from transformers import AutoConfig, TRANSFORMERS_CACHE
+from huggingface_hub.constants import HUGGINGFACE_HUB_CACHE
 
-from diffusers import StableDiffusionPipeline
+from .huggingFaceCacheIndex import get_cache_index
+from .huggingFaceCheckpointConverter import convert_checkpoint
+from .huggingFaceDownloader import HuggingFaceDownloader
+
+# transformers and diffusers are imported in the methods which need them, they take seconds to import
 
 def format_size(num: int) -> str:
     """Format size in bytes into a human-readable string.
@@ -19,6 +22,13 @@ def format_size(num: int) -> str:
     return f"{num_f:.1f}Y"
 
 
+def format_gib(num: int) -> str:
+    """
+    size in GiB (1024 ** 3 bytes), the unit of the cache quota and the pipeline cache size
+    """
+    return f'{num / 1024 ** 3:.2f} GiB'
+
+
 class HuggingFaceModelClass:
     """
     to search HuggingFaceModel information
@@ -28,58 +38,93 @@ class HuggingFaceModelClass:
         self.__initVal()
 
     def __initVal(self):
-        self.__cache_dir = TRANSFORMERS_CACHE
+        self.__cache_dir = HUGGINGFACE_HUB_CACHE
+        # shared with every other user of the same cache directory, it is refreshed instead of scan_cache_dir
+        self.__cache_index = get_cache_index(self.__cache_dir)
         self.__text_2_image_only = False
 
     def setCacheDir(self, cache_dir):
         self.__cache_dir = cache_dir
+        self.__cache_index = get_cache_index(self.__cache_dir)
+
+    def getCacheIndex(self):
+        return self.__cache_index
 
     def setText2ImageOnly(self, f: bool):
         self.__text_2_image_only = f
 
     def getModels(self, certain_models=None):
-        models = [{"id": i.repo_id}
-                    for i in scan_cache_dir(cache_dir=self.__cache_dir).repos]
+        self.__cache_index.refresh()
+        models = [{"id": i['repo_id']}
+                    for i in self.__cache_index.get_repos()]
         if certain_models is None:
             return models
         else:
             return list(filter(lambda x: x['id'] in certain_models, models)) if len(
                 certain_models) > 0 else certain_models
 
-    def installHuggingFaceModel(self, name, model_type='Model'):
+    def installHuggingFaceModel(self, name, model_type='Model', progress_callback=None, is_cancelled=lambda: False, torch_dtype='16'):
+        """
+        :param progress_callback: called with (downloaded bytes, total bytes) while a model is downloaded
+        :param torch_dtype: '16' or '32', dtype which a checkpoint is converted to
+        """
         try:
             if model_type == 'Model':
-                StableDiffusionPipeline.from_pretrained(name, cache_dir=self.__cache_dir)
+                # the files are put in the cache directly, the pipeline isn't loaded just to download it
+                HuggingFaceDownloader(self.__cache_dir).download(name, progress_callback=progress_callback, is_cancelled=is_cancelled)
+                self.__cache_index.update_repo(name)
+                # the installed model comes first
+                return self.getModels([name])
             elif model_type == 'Checkpoint':
-                StableDiffusionPipeline.from_single_file(name, cache_dir=self.__cache_dir)
+                # converted once, then it is loaded like any other diffusers model
+                model_id = convert_checkpoint(name, self.__cache_dir, torch_dtype)
+                self.__cache_index.update_repo(model_id)
+                return self.getModels([model_id])
             return self.getModels()
         except Exception as e:
             raise Exception(e)
 
     def is_model_exists(self, model_name):
-        cache_dir_result = scan_cache_dir(cache_dir=self.__cache_dir)
-        for i in cache_dir_result.repos:
-            if model_name == i.repo_id:
-                return True
-        return False
+        self.__cache_index.refresh()
+        return any(model_name == i['repo_id'] for i in self.__cache_index.get_repos())
 
     def removeHuggingFaceModel(self, model_name: str) -> str:
-        try:
-            commit_hashes = []
-            cache_dir_result = scan_cache_dir(cache_dir=self.__cache_dir)
-            for i in cache_dir_result.repos:
-                if model_name == i.repo_id:
-                    for j in i.revisions:
-                        commit_hashes.append(j.commit_hash)
-            delete_strategy = cache_dir_result.delete_revisions(*commit_hashes)
-            print("Will free " + delete_strategy.expected_freed_size_str)
-            delete_strategy.execute()
-            return model_name
-        except Exception as e:
-            print(e)
-            return ''
+        return ''.join(self.removeHuggingFaceModels([model_name]))
+
+    def removeHuggingFaceModels(self, model_names: list) -> list:
+        """
+        delete the models in one go
+
+        :return: names of the models which were deleted
+        """
+        # every revision is deleted, so the whole repo directory goes
+        removed, freed_size = self.__cache_index.remove_repos(model_names)
+        print("Freed " + format_size(freed_size))
+        return removed
+
+    def getEvictionCandidates(self, quota: int, keep=()) -> list:
+        """
+        :return: [(model name, size), ...] of the models which evictModels would delete
+        """
+        self.__cache_index.refresh()
+        return [(repo['repo_id'], repo['size']) for repo in self.__cache_index.get_eviction_candidates(quota, keep)]
+
+    def evictModels(self, quota: int, keep=()) -> list:
+        """
+        delete the least recently used models until the cache directory fits in quota bytes
+
+        :return: names of the models which were deleted
+        """
+        self.__cache_index.refresh()
+        return self.__cache_index.evict(quota, keep)
+
+    def getTotalSize(self) -> int:
+        self.__cache_index.refresh()
+        return self.__cache_index.get_total_size()
 
     def __retrieveModelClassByNameDynamically(self, model_name: str):
+        from transformers import AutoConfig
+
         config = AutoConfig.from_pretrained(model_name, cache_dir=self.__cache_dir)
         class_name = config.architectures[0]
         # Import the module dynamically
@@ -1,26 +1,50 @@
-from qtpy.QtCore import QThread, Signal, Qt
-from qtpy.QtWidgets import QWidget, QLineEdit, QHBoxLayout, QPushButton, QVBoxLayout, QLabel, QMessageBox, QFormLayout
+import threading
+import time
 
-from .huggingFaceModelClass import HuggingFaceModelClass
+from qtpy.QtCore import QThread, Signal, Qt, QSettings
+from qtpy.QtWidgets import QWidget, QLineEdit, QHBoxLayout, QPushButton, QVBoxLayout, QLabel, QMessageBox, QFormLayout, \
+    QProgressBar
+
+from .huggingFaceModelClass import HuggingFaceModelClass, format_size
 from src.disableWheelComboBox import DisableWheelComboBox
 
 
 class InstallModelThread(QThread):
     installFinished = Signal(dict)
     installFailed = Signal(str)
+    # downloaded bytes, total bytes, object because int signals are 32 bit
+    installProgress = Signal(object, object)
 
     def __init__(self, hf_class: HuggingFaceModelClass, model_name_to_install: str, model_type: str):
         super(InstallModelThread, self).__init__()
         self.__hf_class = hf_class
         self.__model_name_to_install = model_name_to_install
         self.__model_type = model_type
+        self.__cancel_event = threading.Event()
+        self.__last_progress_time = 0.0
+
+    def cancel(self):
+        # the downloaded part is kept, installing it again resumes it
+        self.__cancel_event.set()
+
+    def __onProgress(self, downloaded_size, total_size):
+        # called from the download threads for every chunk, the GUI is updated 10 times a second at most
+        now = time.perf_counter()
+        if now - self.__last_progress_time >= 0.1 or downloaded_size == total_size:
+            self.__last_progress_time = now
+            self.installProgress.emit(downloaded_size, total_size)
 
     def run(self):
         try:
-            if self.__model_name_to_install in [model['id'] for model in self.__hf_class.getModels()]:
+            if self.__hf_class.is_model_exists(self.__model_name_to_install):
                 raise Exception('Model already exists.')
             else:
-                result = self.__hf_class.installHuggingFaceModel(self.__model_name_to_install, self.__model_type)
+                # a checkpoint is converted to the dtype of the settings
+                torch_dtype = QSettings('config.ini', QSettings.IniFormat).value('torch_dtype', '16', type=str)
+                result = self.__hf_class.installHuggingFaceModel(self.__model_name_to_install, self.__model_type,
+                                                                 progress_callback=self.__onProgress,
+                                                                 is_cancelled=self.__cancel_event.is_set,
+                                                                 torch_dtype=torch_dtype)
                 print('thread result: ', result)
                 self.installFinished.emit(result[0])
         except Exception as e:
@@ -37,6 +61,7 @@ class HuggingFaceModelInstallWidget(QWidget):
 
     def __initVal(self, hf_class):
         self.__hf_class = hf_class
+        self.__install_start_time = 0.0
 
     def __initUi(self):
         self.__newModelLineEdit = QLineEdit()
@@ -66,8 +91,18 @@ class HuggingFaceModelInstallWidget(QWidget):
 
         self.__loadingLbl = QLabel()
 
+        self.__progressBar = QProgressBar()
+        self.__progressBar.setRange(0, 1000)
+        self.__progressBar.setTextVisible(False)
+
+        self.__cancelBtn = QPushButton('Stop')
+        self.__cancelBtn.setToolTip('The downloaded files are kept, Use resumes the download')
+        self.__cancelBtn.clicked.connect(self.__cancelInstall)
+
         lay = QHBoxLayout()
         lay.addWidget(self.__loadingLbl)
+        lay.addWidget(self.__progressBar)
+        lay.addWidget(self.__cancelBtn)
         lay.setAlignment(Qt.AlignLeft)
         lay.setContentsMargins(0, 0, 0, 0)
 
@@ -94,12 +129,31 @@ class HuggingFaceModelInstallWidget(QWidget):
         self.__t.finished.connect(self.__t.deleteLater)
         self.__t.installFinished.connect(self.__installFinished)
         self.__t.installFailed.connect(self.__installFailed)
+        self.__t.installProgress.connect(self.__installProgress)
         self.__t.start()
 
+    def __cancelInstall(self):
+        self.__t.cancel()
+        self.__cancelBtn.setEnabled(False)
+
     def thread_started(self):
         self.__loadingLbl.setText('Installing...')
+        self.__progressBar.setValue(0)
+        # busy indicator until the size of the files is known (and for checkpoints)
+        self.__progressBar.setMaximum(0)
+        self.__cancelBtn.setEnabled(True)
         self.__bottomWidget.setVisible(True)
         self.__installBtn.setEnabled(False)
+        self.__install_start_time = time.perf_counter()
+
+    def __installProgress(self, downloaded_size, total_size):
+        if total_size <= 0:
+            return
+        self.__progressBar.setMaximum(1000)
+        self.__progressBar.setValue(int(downloaded_size / total_size * 1000))
+        elapsed = time.perf_counter() - self.__install_start_time
+        speed = f' ({format_size(downloaded_size / elapsed)}B/s)' if elapsed > 0 else ''
+        self.__loadingLbl.setText(f'Installing... {format_size(downloaded_size)}B / {format_size(total_size)}B{speed}')
 
     def thread_finished(self):
         self.__bottomWidget.setVisible(False)
@@ -0,0 +1,120 @@
+import os
+
+from .huggingFaceCacheIndex import get_cache_index, get_repo_folder_name
+from .huggingFaceDownloader import HuggingFaceDownloader
+
+LORA_EXTS = ('.safetensors', '.bin', '.pt', '.ckpt')
+
+# the network is used only when it is allowed here and HF_HUB_OFFLINE isn't set
+allow_network = True
+
+
+class ModelNotFoundOffline(Exception):
+    pass
+
+
+def set_allow_network(f):
+    global allow_network
+    allow_network = f
+
+
+def is_network_allowed():
+    return allow_network and os.environ.get('HF_HUB_OFFLINE', '').lower() not in ('1', 'true', 'yes', 'on')
+
+
+def find_weight_file(folder):
+    """
+    :return: the weight file of a LoRA folder, safetensors first, None if there is none
+    """
+    filenames = []
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        filenames.extend(os.path.join(root, filename) for filename in sorted(files) if filename.endswith(LORA_EXTS))
+    if len(filenames) == 0:
+        return None
+    # the ones in the top folder first
+    filenames.sort(key=lambda x: (not x.endswith('.safetensors'), os.path.dirname(x) != folder))
+    return filenames[0]
+
+
+class HuggingFaceModelResolver:
+    """
+    turns model ids, LoRA repos and local paths into local paths from the cache directory and its index only,
+    the hub is contacted only if the model isn't in the cache and the network is allowed
+
+    diffusers and huggingface_hub ask the hub for the latest revision first, which takes seconds and
+    can hang on machines without internet
+    """
+    def __init__(self, cache_dir):
+        super(HuggingFaceModelResolver, self).__init__()
+        self.__cache_dir = cache_dir
+
+    def get_snapshot_path(self, repo_id, revision='main'):
+        """
+        :return: snapshot directory of the revision in the cache, None if it isn't there
+        """
+        repo_path = os.path.join(self.__cache_dir, get_repo_folder_name(repo_id))
+        commit_hashes = []
+
+        repo = get_cache_index(self.__cache_dir).get_repo(repo_id)
+        if repo:
+            commit_hashes.extend(r['commit_hash'] for r in repo['revisions'] if revision in r['refs'] or r['commit_hash'] == revision)
+        # the index is behind if the repo was downloaded by something else
+        ref_path = os.path.join(repo_path, 'refs', revision)
+        if os.path.isfile(ref_path):
+            with open(ref_path, encoding='utf-8') as f:
+                commit_hashes.append(f.read().strip())
+        commit_hashes.append(revision)
+
+        for commit_hash in commit_hashes:
+            snapshot_path = os.path.join(repo_path, 'snapshots', commit_hash)
+            if os.path.isdir(snapshot_path):
+                return snapshot_path
+        return None
+
+    def resolve_model(self, model_id, allow_network=None):
+        """
+        :param model_id: repo id, converted/<name> or a local diffusers directory
+        :return: directory with model_index.json
+        """
+        for path in (model_id, os.path.join(self.__cache_dir, model_id)):
+            if os.path.isfile(os.path.join(path, 'model_index.json')):
+                return path
+
+        snapshot_path = self.get_snapshot_path(model_id)
+        if snapshot_path and os.path.isfile(os.path.join(snapshot_path, 'model_index.json')):
+            return snapshot_path
+
+        snapshot_path = self.__download(model_id, allow_network)
+        if not os.path.isfile(os.path.join(snapshot_path, 'model_index.json')):
+            raise ValueError(f'{model_id} is not a diffusers model')
+        return snapshot_path
+
+    def resolve_lora(self, lora_path, allow_network=None):
+        """
+        :param lora_path: local weight file, local folder or repo id
+        :return: weight file
+        """
+        if os.path.isfile(lora_path):
+            return lora_path
+
+        folders = [lora_path] if os.path.isdir(lora_path) else []
+        snapshot_path = self.get_snapshot_path(lora_path)
+        if snapshot_path:
+            folders.append(snapshot_path)
+        for folder in folders:
+            filename = find_weight_file(folder)
+            if filename:
+                return filename
+
+        filename = find_weight_file(self.__download(lora_path, allow_network))
+        if filename is None:
+            raise ValueError(f'No LoRA weight file in {lora_path}')
+        return filename
+
+    def __download(self, repo_id, allow_network):
+        if not (is_network_allowed() if allow_network is None else allow_network):
+            raise ModelNotFoundOffline(f'{repo_id} is not in {self.__cache_dir} and the network is not allowed')
+        snapshot_path = HuggingFaceDownloader(self.__cache_dir).download(repo_id)
+        get_cache_index(self.__cache_dir).update_repo(repo_id)
+        return snapshot_path
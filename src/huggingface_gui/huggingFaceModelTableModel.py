@@ -0,0 +1,172 @@
+import threading
+import time
+
+from qtpy.QtCore import Qt, QAbstractTableModel, QModelIndex, QThread, Signal, QUrl, QEvent
+from qtpy.QtGui import QDesktopServices, QPalette
+from qtpy.QtWidgets import QStyledItemDelegate, QApplication
+
+from .huggingFaceCacheIndex import CONVERTED_DIR
+from .huggingFaceModelClass import format_size
+
+NAME_COLUMN = 0
+SIZE_COLUMN = 1
+LAST_USED_COLUMN = 2
+VISIT_COLUMN = 3
+HEADER_LABELS = ['Name', 'Size', 'Last Used', 'Visit']
+
+
+class HuggingFaceModelTableModel(QAbstractTableModel):
+    """
+    model ids of the table, size and last used are filled in later by ModelInfoThread
+    """
+    def __init__(self, parent=None):
+        super(HuggingFaceModelTableModel, self).__init__(parent)
+        self.__initVal()
+
+    def __initVal(self):
+        # [model_id, size, last_used], None until the info is loaded
+        self.__rows = []
+        self.__row_by_id = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.__rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(HEADER_LABELS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return HEADER_LABELS[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        model_id, size, last_used = self.__rows[index.row()]
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == NAME_COLUMN:
+                return model_id
+            elif column == SIZE_COLUMN:
+                return '...' if size is None else format_size(size)
+            elif column == LAST_USED_COLUMN:
+                if last_used is None:
+                    return '...'
+                return time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used)) if last_used else '-'
+            elif column == VISIT_COLUMN:
+                return '' if self.__isConverted(model_id) else 'Link'
+        elif role == Qt.UserRole:
+            # raw value to sort by
+            if column == NAME_COLUMN:
+                return model_id.lower()
+            elif column == SIZE_COLUMN:
+                return -1 if size is None else size
+            elif column == LAST_USED_COLUMN:
+                return -1.0 if last_used is None else last_used
+            elif column == VISIT_COLUMN:
+                return '' if self.__isConverted(model_id) else f'https://huggingface.co/{model_id}'
+        elif role == Qt.ToolTipRole and column == VISIT_COLUMN:
+            return 'Converted from a checkpoint' if self.__isConverted(model_id) else f'https://huggingface.co/{model_id}'
+        elif role == Qt.TextAlignmentRole:
+            return int(Qt.AlignCenter)
+        return None
+
+    def __isConverted(self, model_id):
+        return model_id.startswith(CONVERTED_DIR + '/')
+
+    def setModels(self, models: list):
+        self.beginResetModel()
+        self.__rows = [[model['id'] if isinstance(model, dict) else model, None, None] for model in models]
+        self.__row_by_id = {row[0]: i for i, row in enumerate(self.__rows)}
+        self.endResetModel()
+
+    def addModels(self, models: list):
+        model_ids = [model['id'] if isinstance(model, dict) else model for model in models]
+        model_ids = [model_id for model_id in model_ids if model_id not in self.__row_by_id]
+        if len(model_ids) == 0:
+            return
+        self.beginInsertRows(QModelIndex(), len(self.__rows), len(self.__rows) + len(model_ids) - 1)
+        for model_id in model_ids:
+            self.__row_by_id[model_id] = len(self.__rows)
+            self.__rows.append([model_id, None, None])
+        self.endInsertRows()
+
+    def removeModels(self, model_ids: list):
+        rows = sorted((self.__row_by_id[model_id] for model_id in model_ids if model_id in self.__row_by_id), reverse=True)
+        for row in rows:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.__rows[row]
+            self.endRemoveRows()
+        if rows:
+            self.__row_by_id = {row[0]: i for i, row in enumerate(self.__rows)}
+
+    def getModelIds(self):
+        return [row[0] for row in self.__rows]
+
+    def getModelId(self, row):
+        return self.__rows[row][0]
+
+    def getRow(self, model_id):
+        return self.__row_by_id.get(model_id, -1)
+
+    def setModelInfos(self, infos: list):
+        """
+        :param infos: [(model_id, size, last_used), ...]
+        """
+        rows = []
+        for model_id, size, last_used in infos:
+            row = self.__row_by_id.get(model_id)
+            if row is not None:
+                self.__rows[row][1] = size
+                self.__rows[row][2] = last_used
+                rows.append(row)
+        if rows:
+            # one signal per batch, not per row
+            self.dataChanged.emit(self.index(min(rows), SIZE_COLUMN), self.index(max(rows), LAST_USED_COLUMN))
+
+
+class ModelInfoThread(QThread):
+    """
+    reads the size and the last used time of the models without blocking the GUI
+    """
+    infosLoaded = Signal(list)
+
+    def __init__(self, cache_index, model_ids, batch_size=256):
+        super(ModelInfoThread, self).__init__()
+        self.__cache_index = cache_index
+        self.__model_ids = model_ids
+        self.__batch_size = batch_size
+        self.__cancel_event = threading.Event()
+
+    def cancel(self):
+        self.__cancel_event.set()
+
+    def run(self):
+        infos = []
+        for model_id in self.__model_ids:
+            if self.__cancel_event.is_set():
+                return
+            repo = self.__cache_index.get_repo(model_id)
+            infos.append((model_id, repo['size'] if repo else 0, self.__cache_index.get_last_used(model_id)))
+            if len(infos) == self.__batch_size:
+                self.infosLoaded.emit(infos)
+                infos = []
+        if infos:
+            self.infosLoaded.emit(infos)
+
+
+class LinkDelegate(QStyledItemDelegate):
+    """
+    draws the cell like a hyperlink and opens the url of Qt.UserRole when it is clicked, without a widget per row
+    """
+    def initStyleOption(self, option, index):
+        super(LinkDelegate, self).initStyleOption(option, index)
+        option.font.setUnderline(True)
+        option.palette.setColor(QPalette.Text, QApplication.palette().color(QPalette.Link))
+        option.palette.setColor(QPalette.HighlightedText, QApplication.palette().color(QPalette.Link))
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton and index.data(Qt.UserRole):
+            QDesktopServices.openUrl(QUrl(index.data(Qt.UserRole)))
+            return True
+        return super(LinkDelegate, self).editorEvent(event, model, option, index)
@@ -1,65 +1,128 @@
-import typing
+from qtpy.QtCore import Qt, QSortFilterProxyModel, Signal
+from qtpy.QtWidgets import QTableView, QHeaderView, QAbstractItemView
 
-from qtpy.QtCore import Qt, QUrl
-from qtpy.QtGui import QDesktopServices
-from qtpy.QtWidgets import QTableWidget, QHeaderView, QAbstractItemView, QTableWidgetItem, QLabel
+from .huggingFaceModelTableModel import HuggingFaceModelTableModel, ModelInfoThread, LinkDelegate, NAME_COLUMN, \
+    SIZE_COLUMN, LAST_USED_COLUMN, VISIT_COLUMN
 
 
-class HuggingFaceModelTableWidget(QTableWidget):
+class HuggingFaceModelTableWidget(QTableView):
+    # model id of the current row, empty string if there is no current row
+    currentModelChanged = Signal(str)
+
     def __init__(self):
         super(HuggingFaceModelTableWidget, self).__init__()
         self.__initVal()
         self.__initUi()
 
     def __initVal(self):
-        self.__header_labels = {v: i for (i, v) in enumerate(['Name', 'Visit'])}
+        self.__model = HuggingFaceModelTableModel(self)
+        self.__proxy_model = QSortFilterProxyModel(self)
+        self.__proxy_model.setSourceModel(self.__model)
+        self.__proxy_model.setSortRole(Qt.UserRole)
+        self.__proxy_model.setFilterKeyColumn(NAME_COLUMN)
+        self.__proxy_model.setFilterCaseSensitivity(Qt.CaseInsensitive)
+
+        self.__cache_index = None
+        self.__info_threads = []
 
     def __initUi(self):
-        self.setHorizontalHeaderLabels(self.__header_labels.keys())
-        self.resizeColumnsToContents()
+        self.setModel(self.__proxy_model)
+        self.setItemDelegateForColumn(VISIT_COLUMN, LinkDelegate(self))
         self.verticalHeader().setVisible(False)
+        # fixed row height, so the view doesn't measure every row
+        self.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
         self.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.setSortingEnabled(True)
+        self.sortByColumn(NAME_COLUMN, Qt.AscendingOrder)
+
+        # the columns are not fitted to the contents, that would go through every row
+        header = self.horizontalHeader()
+        header.setSectionResizeMode(QHeaderView.Interactive)
+        header.setSectionResizeMode(NAME_COLUMN, QHeaderView.Stretch)
+        for column, width in ((SIZE_COLUMN, 80), (LAST_USED_COLUMN, 140), (VISIT_COLUMN, 50)):
+            header.resizeSection(column, width)
+
+        self.selectionModel().currentRowChanged.connect(self.__currentRowChanged)
 
-    def open_link(self, url):
-        QDesktopServices.openUrl(QUrl(url))
+    def __currentRowChanged(self, current, previous):
+        self.currentModelChanged.emit(self.getCurrentRowModelName())
 
-    def set_hyperlink(self, row, column, text):
-        label = QLabel(text)
-        label.setOpenExternalLinks(True)
-        label.setAlignment(Qt.AlignCenter)
-        self.setCellWidget(row, column, label)
+    def setCacheIndex(self, cache_index):
+        self.__cache_index = cache_index
+
+    def setModels(self, models: list):
+        self.__model.setModels(models)
+        self.__loadModelInfos(self.__model.getModelIds(), cancel=True)
+        if self.visibleRowCount() > 0:
+            self.setCurrentRow(0)
 
     def addModels(self, models: list):
-        for i in range(len(models)):
-            cur_table_idx = self.rowCount()
+        self.__model.addModels(models)
+        self.__loadModelInfos([model['id'] if isinstance(model, dict) else model for model in models])
+        if self.currentRow() == -1 and self.visibleRowCount() > 0:
+            self.setCurrentRow(0)
+
+    def removeModels(self, model_ids: list):
+        self.__model.removeModels(model_ids)
+
+    def refreshModelInfos(self):
+        self.__loadModelInfos(self.__model.getModelIds(), cancel=True)
+
+    def __loadModelInfos(self, model_ids, cancel=False):
+        if self.__cache_index is None or len(model_ids) == 0:
+            return
+        if cancel:
+            for t in self.__info_threads:
+                t.cancel()
+        t = ModelInfoThread(self.__cache_index, model_ids)
+        t.infosLoaded.connect(self.__model.setModelInfos)
+        t.finished.connect(self.__infoThreadFinished)
+        self.__info_threads.append(t)
+        t.start()
 
-            self.setRowCount(cur_table_idx+1)
-            model = models[i]
+    def __infoThreadFinished(self):
+        self.__info_threads = [t for t in self.__info_threads if not t.isFinished()]
 
-            model_id = model['id'] if isinstance(model, dict) else model
+    def setFilterText(self, text):
+        self.__proxy_model.setFilterFixedString(text)
 
-            # id
-            if self.__header_labels.get('Name', '') != '':
-                model_id_item = QTableWidgetItem(model_id)
-                model_id_item.setTextAlignment(Qt.AlignCenter)
-                self.setItem(cur_table_idx, self.__header_labels['Name'], model_id_item)
+    def rowCount(self):
+        """
+        number of the models, including the ones which are filtered out
+        """
+        return self.__model.rowCount()
 
-            # visit
-            if self.__header_labels.get('Visit', '') != '':
-                hyperlink_tag = f'<a href="https://huggingface.co/{model_id}">Link</a>'
-                self.set_hyperlink(cur_table_idx, self.__header_labels['Visit'], hyperlink_tag)
+    def visibleRowCount(self):
+        return self.__proxy_model.rowCount()
 
-            self.setCurrentCell(0, 0)
+    def currentRow(self):
+        return self.currentIndex().row()
 
-        self.resizeColumnsToContents()
-        self.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-        self.sortByColumn(0, Qt.AscendingOrder)
+    def setCurrentRow(self, row):
+        self.setCurrentIndex(self.__proxy_model.index(row, NAME_COLUMN))
 
-    def setHorizontalHeaderLabels(self, labels: typing.Iterable[str]) -> None:
-        self.__header_labels = {v: i for (i, v) in enumerate(labels)}
-        self.setColumnCount(len(self.__header_labels))
-        super(HuggingFaceModelTableWidget, self).setHorizontalHeaderLabels(self.__header_labels.keys())
+    def getModelName(self, row):
+        return self.__proxy_model.index(row, NAME_COLUMN).data(Qt.DisplayRole) or ''
 
     def getCurrentRowModelName(self):
-        return self.item(self.currentRow(), 0).text()
\ No newline at end of file
+        return self.getModelName(self.currentRow()) if self.currentRow() != -1 else ''
+
+    def getSelectedModelNames(self):
+        return [index.data(Qt.DisplayRole) for index in self.selectionModel().selectedRows(NAME_COLUMN)]
+
+    def selectModel(self, model_name):
+        """
+        make the row of "model_name" current
+
+        :return: False if it is not in the table (or filtered out)
+        """
+        source_row = self.__model.getRow(model_name)
+        if source_row == -1:
+            return False
+        index = self.__proxy_model.mapFromSource(self.__model.index(source_row, NAME_COLUMN))
+        if not index.isValid():
+            return False
+        self.setCurrentIndex(index)
+        self.scrollTo(index)
+        return True
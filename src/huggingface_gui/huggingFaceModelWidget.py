@@ -3,18 +3,59 @@ import sys
 
 from .huggingFacePathWidget import FindPathWidget
 
-from qtpy.QtCore import Qt, Signal, QSettings
+from qtpy.QtCore import Qt, Signal, QSettings, QThread
 from qtpy.QtGui import QIcon
 from qtpy.QtWidgets import QWidget, QApplication, QVBoxLayout, QLabel, QHBoxLayout, QSpacerItem, QSizePolicy, \
-    QPushButton, QDialog, QMessageBox
+    QPushButton, QDialog, QMessageBox, QLineEdit, QDoubleSpinBox
 
-from .huggingFaceModelClass import HuggingFaceModelClass
+from .huggingFaceModelClass import HuggingFaceModelClass, format_gib
 from .huggingFaceModelInputDialog import HuggingFaceModelInputDialog
 from .huggingFaceModelTableWidget import HuggingFaceModelTableWidget
 
 QApplication.setWindowIcon(QIcon('hf-logo.svg'))
 
 
+class CacheMaintenanceThread(QThread):
+    """
+    deletes the models, evicts the least recently used ones over the quota and sums up the size of the cache directory,
+    so none of it blocks the GUI
+    """
+    # sizes are bytes, which don't fit in a Qt int
+    maintenanceFinished = Signal(list, object)
+    # quota, [(model name, size), ...], error message or ''
+    evictionPlanned = Signal(object, list, str)
+
+    def __init__(self, hf_class: HuggingFaceModelClass, model_names_to_delete: list, quota: int, keep: list, plan_only=False):
+        """
+        :param plan_only: only find the models which the quota would evict (see evictionPlanned), nothing is deleted
+        """
+        super(CacheMaintenanceThread, self).__init__()
+        self.__hf_class = hf_class
+        self.__model_names_to_delete = model_names_to_delete
+        self.__quota = quota
+        self.__keep = keep
+        self.__plan_only = plan_only
+
+    def run(self):
+        if self.__plan_only:
+            try:
+                self.evictionPlanned.emit(self.__quota, self.__hf_class.getEvictionCandidates(self.__quota, self.__keep), '')
+            except Exception as e:
+                print(e)
+                self.evictionPlanned.emit(self.__quota, [], str(e))
+            return
+        deleted = []
+        try:
+            if self.__model_names_to_delete:
+                deleted.extend(self.__hf_class.removeHuggingFaceModels(self.__model_names_to_delete))
+            deleted.extend(self.__hf_class.evictModels(self.__quota, self.__keep))
+            total_size = self.__hf_class.getTotalSize()
+        except Exception as e:
+            print(e)
+            total_size = -1
+        self.maintenanceFinished.emit(deleted, total_size)
+
+
 class HuggingFaceModelWidget(QWidget):
     onModelAdded = Signal(str)
     onModelDeleted = Signal(str)
@@ -29,6 +70,14 @@ class HuggingFaceModelWidget(QWidget):
     def __initVal(self, certain_models):
         self.__certain_models = certain_models
 
+        self.__settings_ini = QSettings('config.ini', QSettings.IniFormat)
+        # GiB (1024 ** 3 bytes) like the pipeline cache size, 0 means no quota
+        if not self.__settings_ini.contains('cache_quota'):
+            self.__settings_ini.setValue('cache_quota', 0.0)
+        self.__cache_quota = self.__settings_ini.value('cache_quota', type=float)
+
+        self.__maintenance_threads = []
+
     def __initUi(self):
         self.setWindowTitle('HuggingFace Model Table')
 
@@ -60,18 +109,48 @@ class HuggingFaceModelWidget(QWidget):
         self.__hf_class.setText2ImageOnly(True)
 
         self.__modelTableWidget = HuggingFaceModelTableWidget()
-        self.__modelTableWidget.setHorizontalHeaderLabels(['Name', 'Visit'])
-        self.__modelTableWidget.currentCellChanged.connect(self.__currentCellChanged)
+        self.__modelTableWidget.currentModelChanged.connect(self.__currentModelChanged)
+
+        self.__filterLineEdit = QLineEdit()
+        self.__filterLineEdit.setPlaceholderText('Filter...')
+        self.__filterLineEdit.setClearButtonEnabled(True)
+        self.__filterLineEdit.textChanged.connect(self.__modelTableWidget.setFilterText)
 
         self.__totalSizeLbl = QLabel()
-        self.__totalSizeLbl.setAlignment(Qt.AlignRight)
+        self.__totalSizeLbl.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
+
+        self.__cacheQuotaSpinBox = QDoubleSpinBox()
+        self.__cacheQuotaSpinBox.setRange(0, 100000)
+        self.__cacheQuotaSpinBox.setDecimals(1)
+        self.__cacheQuotaSpinBox.setSuffix(' GiB')
+        self.__cacheQuotaSpinBox.setSpecialValueText('No limit')
+        self.__cacheQuotaSpinBox.setValue(self.__cache_quota)
+        self.__cacheQuotaSpinBox.setToolTip('The least recently used models are deleted when the cache directory gets bigger than this')
+        self.__cacheQuotaSpinBox.valueChanged.connect(self.__cacheQuotaChanged)
+
+        # models may be deleted, so the quota is taken only when it is applied and confirmed
+        self.__applyQuotaBtn = QPushButton('Apply')
+        self.__applyQuotaBtn.setEnabled(False)
+        self.__applyQuotaBtn.clicked.connect(self.__applyCacheQuota)
+
+        lay = QHBoxLayout()
+        lay.addWidget(self.__totalSizeLbl)
+        lay.addWidget(QLabel('Quota'))
+        lay.addWidget(self.__cacheQuotaSpinBox)
+        lay.addWidget(self.__applyQuotaBtn)
+        lay.setAlignment(Qt.AlignRight)
+        lay.setContentsMargins(0, 0, 0, 0)
+
+        bottomWidget = QWidget()
+        bottomWidget.setLayout(lay)
 
         self.setCacheDir(self.__cache_dir)
 
         lay = QVBoxLayout()
         lay.addWidget(menuWidget)
+        lay.addWidget(self.__filterLineEdit)
         lay.addWidget(self.__modelTableWidget)
-        lay.addWidget(self.__totalSizeLbl)
+        lay.addWidget(bottomWidget)
 
         self.setLayout(lay)
 
@@ -86,23 +165,97 @@ class HuggingFaceModelWidget(QWidget):
                 # add model in the table
                 self.__modelTableWidget.addModels([model])
                 self.onModelAdded.emit(model['id'])
+                # the new model may have pushed the cache directory over the quota
+                self.refreshCacheUsage(keep=[model['id']])
             except Exception as e:
                 QMessageBox.critical(self, "Error", str(e))
 
     def __deleteClicked(self):
-        model_name = self.__modelTableWidget.getCurrentRowModelName()
-        self.__hf_class.removeHuggingFaceModel(model_name)
-        cur_row = self.__modelTableWidget.currentRow()
-        self.__modelTableWidget.removeRow(cur_row)
-        self.__modelTableWidget.setCurrentCell(max(0, min(cur_row, self.__modelTableWidget.rowCount()-1)), 0)
+        # every selected model is deleted in one background job
+        model_names = self.__modelTableWidget.getSelectedModelNames() or [self.__modelTableWidget.getCurrentRowModelName()]
+        self.__delBtn.setEnabled(False)
+        self.__runMaintenance(model_names)
+
+    def __cacheQuotaChanged(self, v):
+        self.__applyQuotaBtn.setEnabled(v != self.__cache_quota)
+
+    def __applyCacheQuota(self):
+        # the cache directory is scanned for it, so it is done in the background
+        self.__applyQuotaBtn.setEnabled(False)
+        t = CacheMaintenanceThread(self.__hf_class, [], int(self.__cacheQuotaSpinBox.value() * 1024 ** 3), self.__getKeep([]),
+                                   plan_only=True)
+        t.evictionPlanned.connect(self.__evictionPlanned)
+        t.finished.connect(self.__maintenanceThreadFinished)
+        self.__maintenance_threads.append(t)
+        t.start()
+
+    def __evictionPlanned(self, quota, to_evict, error):
+        if error:
+            QMessageBox.critical(self, "Error", error)
+        elif to_evict:
+            names = '\n'.join(f'{model_name} ({format_gib(size)})' for model_name, size in to_evict)
+            reply = QMessageBox.question(self, 'Apply Quota',
+                                         f'These models will be deleted to free {format_gib(sum(size for _, size in to_evict))}:\n\n'
+                                         f'{names}\n\nContinue?',
+                                         QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if reply == QMessageBox.Yes:
+                self.__setCacheQuota(quota / 1024 ** 3)
+        else:
+            self.__setCacheQuota(quota / 1024 ** 3)
+        self.__applyQuotaBtn.setEnabled(self.__cacheQuotaSpinBox.value() != self.__cache_quota)
+
+    def __setCacheQuota(self, quota):
+        self.__cache_quota = quota
+        self.__settings_ini.setValue('cache_quota', self.__cache_quota)
+        self.refreshCacheUsage()
+
+    def refreshCacheUsage(self, keep=None):
+        """
+        sum up the size of the cache directory and evict the models over the quota in the background
+        call it after a model is loaded, so its last used time is taken into account
+        """
+        self.__runMaintenance([], keep)
+
+    def __getKeep(self, model_names_to_delete, keep=None):
+        keep = list(keep or [])
+        cur_model_name = self.__modelTableWidget.getCurrentRowModelName()
+        if cur_model_name and cur_model_name not in model_names_to_delete:
+            keep.append(cur_model_name)
+        return keep
+
+    def __runMaintenance(self, model_names_to_delete, keep=None):
+        keep = self.__getKeep(model_names_to_delete, keep)
+        self.__totalSizeLbl.setText('Calculating...')
+
+        t = CacheMaintenanceThread(self.__hf_class, model_names_to_delete, int(self.__cache_quota * 1024 ** 3), keep)
+        t.maintenanceFinished.connect(self.__maintenanceFinished)
+        t.finished.connect(self.__maintenanceThreadFinished)
+        self.__maintenance_threads.append(t)
+        t.start()
+
+    def __maintenanceFinished(self, deleted, total_size):
+        if deleted:
+            cur_row = max(0, self.__modelTableWidget.currentRow())
+            self.__modelTableWidget.removeModels(deleted)
+            self.__modelTableWidget.setCurrentRow(max(0, min(cur_row, self.__modelTableWidget.visibleRowCount()-1)))
+            for model_name in deleted:
+                self.onModelDeleted.emit(model_name)
         self.__delBtn.setEnabled(self.__modelTableWidget.rowCount() != 0)
-        self.onModelDeleted.emit(model_name)
 
-    def __currentCellChanged(self, currentRow, currentColumn, previousRow, previousColumn):
-        cur_item = self.__modelTableWidget.item(currentRow, 0)
-        if cur_item:
+        if total_size < 0:
+            self.__totalSizeLbl.setText('')
+        elif self.__cache_quota > 0:
+            self.__totalSizeLbl.setText(f'Total: {format_gib(total_size)} / {format_gib(int(self.__cache_quota * 1024 ** 3))}')
+        else:
+            self.__totalSizeLbl.setText(f'Total: {format_gib(total_size)}')
+        self.__modelTableWidget.refreshModelInfos()
+
+    def __maintenanceThreadFinished(self):
+        self.__maintenance_threads = [t for t in self.__maintenance_threads if not t.isFinished()]
+
+    def __currentModelChanged(self, cur_model_name):
+        if cur_model_name:
             self.__delBtn.setEnabled(True)
-            cur_model_name = cur_item.text()
             self.onModelSelected.emit(cur_model_name)
         else:
             self.__delBtn.setEnabled(False)
@@ -112,21 +265,18 @@ class HuggingFaceModelWidget(QWidget):
         os.makedirs(cache_dir, exist_ok=True)
 
         self.__cache_dir = cache_dir
-        self.__modelTableWidget.clearContents()
-        self.__modelTableWidget.setRowCount(0)
         self.__hf_class.setCacheDir(self.__cache_dir)
         models = self.__hf_class.getModels(self.__certain_models)
         if len(models) == 0:
             self.__delBtn.setEnabled(False)
-        self.__modelTableWidget.addModels(models)
+        # the rows are replaced at once, size and last used come in the background
+        self.__modelTableWidget.setCacheIndex(self.__hf_class.getCacheIndex())
+        self.__modelTableWidget.setModels(models)
+        self.refreshCacheUsage()
         self.onCacheDirSet.emit(cache_dir)
 
     def getCurrentModelName(self):
-        cur_item = self.__modelTableWidget.item(self.__modelTableWidget.currentRow(), 0)
-        cur_model_name = ''
-        if cur_item:
-            cur_model_name = cur_item.text()
-        return cur_model_name
+        return self.__modelTableWidget.getCurrentRowModelName()
 
     def getCurrentModelObject(self):
         """
@@ -149,9 +299,7 @@ class HuggingFaceModelWidget(QWidget):
         """
         select the row which has "model_name" as an Name
         """
-        items = self.__modelTableWidget.findItems(model_name, Qt.MatchExactly)
-        if len(items) > 0:
-            self.__modelTableWidget.setCurrentCell(items[0].row(), 0)
+        self.__modelTableWidget.selectModel(model_name)
 
     def getModelClass(self):
         return self.__hf_class
\ No newline at end of file
@@ -5,7 +5,6 @@ from qtpy.QtCore import Qt, QSettings
 from qtpy.QtCore import Signal
 from qtpy.QtWidgets import QLineEdit, QMenu, QAction
 from qtpy.QtWidgets import QWidget, QPushButton, QHBoxLayout, QFileDialog, QLabel
-from transformers import TRANSFORMERS_CACHE
 
 
 class FindPathLineEdit(QLineEdit):
@@ -0,0 +1,47 @@
+class ImageEncoder:
+    """
+    image format with the PIL save options of it
+    """
+    def __init__(self, ext, format, **save_kwargs):
+        super(ImageEncoder, self).__init__()
+        self.ext = ext
+        self.format = format
+        self.save_kwargs = save_kwargs
+
+    def encode(self, img, f):
+        """
+        :param img: PIL image or uint8 ndarray of (height, width, 3)
+        :param f: filename or file object
+        """
+        to_pil_image(img).save(f, format=self.format, **self.save_kwargs)
+
+
+def to_pil_image(img):
+    """
+    images stay ndarrays until they are encoded, this is the only place they become PIL images
+    """
+    if hasattr(img, 'save'):
+        return img
+    from PIL import Image
+
+    return Image.fromarray(img)
+
+
+# from the fastest to write to the smallest
+ENCODERS = {
+    'PNG (fast)': ImageEncoder('.png', 'PNG', compress_level=1),
+    'PNG (default)': ImageEncoder('.png', 'PNG', compress_level=6),
+    'PNG (small)': ImageEncoder('.png', 'PNG', compress_level=9),
+    'WebP (lossless)': ImageEncoder('.webp', 'WEBP', lossless=True, quality=50, method=2),
+    'WebP (quality 90)': ImageEncoder('.webp', 'WEBP', quality=90, method=4),
+    'JPEG (quality 95)': ImageEncoder('.jpg', 'JPEG', quality=95),
+    'Raw (uncompressed)': ImageEncoder('.bmp', 'BMP'),
+}
+
+DEFAULT_ENCODER = 'PNG (default)'
+
+
+def get_encoder(name=DEFAULT_ENCODER):
+    if name not in ENCODERS:
+        raise ValueError(f'Unknown output format: {name} (available: {", ".join(ENCODERS.keys())})')
+    return ENCODERS[name]
@@ -0,0 +1,65 @@
+import queue
+import threading
+
+
+class ImageWriterPool:
+    """
+    encodes and writes images on background threads, so the generation thread can start the next
+    denoising pass right away
+
+    the queue is bounded, submit() blocks while the writers are behind (backpressure)
+    flush() returns only after every submitted image was written and synced to disk
+    """
+    def __init__(self, write_fn, worker_count=2, max_pending=4):
+        super(ImageWriterPool, self).__init__()
+        self.__initVal(write_fn, worker_count, max_pending)
+
+    def __initVal(self, write_fn, worker_count, max_pending):
+        self.__write_fn = write_fn
+        self.__queue = queue.Queue(maxsize=max_pending)
+        self.__errors = []
+        self.__errors_lock = threading.Lock()
+        self.__closed = False
+        self.__workers = [threading.Thread(target=self.__work, daemon=True) for _ in range(worker_count)]
+        for worker in self.__workers:
+            worker.start()
+
+    def __work(self):
+        while True:
+            item = self.__queue.get()
+            try:
+                if item is None:
+                    break
+                self.__write_fn(*item)
+            except Exception as e:
+                with self.__errors_lock:
+                    self.__errors.append(e)
+            finally:
+                self.__queue.task_done()
+
+    def submit(self, image, filename):
+        self.__raise_error()
+        self.__queue.put((image, filename))
+
+    def __raise_error(self):
+        with self.__errors_lock:
+            if self.__errors:
+                e = self.__errors[0]
+                self.__errors.clear()
+                raise Exception(e)
+
+    def flush(self):
+        self.__queue.join()
+        self.__raise_error()
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        try:
+            self.flush()
+        finally:
+            for _ in self.__workers:
+                self.__queue.put(None)
+            for worker in self.__workers:
+                worker.join()
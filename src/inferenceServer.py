@@ -0,0 +1,364 @@
+"""
+local HTTP server in front of StableDiffusionWrapper
+
+usage: python inferenceServer.py [--port 7860] [--cache-dir ~/.cache/pyqt-stable-diffusion-gui] [--max-batch-size 8] [--max-wait 0.05] [--tiny]
+
+POST /generate {"prompt": "a cat", "negative_prompt": "", "model": "runwayml/stable-diffusion-v1-5",
+                "width": 512, "height": 512, "num_inference_steps": 20, "guidance_scale": 7.5,
+                "sampler": "DPMSolverMultistepScheduler", "count": 1, "seed": null, "timeout": 300}
+    -> {"images": [base64, ...], "format": ".png", "seeds": [...], "batch_size": 3, "seconds": 1.2}
+    -> 400 {"error": ...} if the body isn't valid (count 1-max batch size, width/height multiples of 8 up to 2048, steps 1-1000)
+GET /health, GET /metrics
+
+requests with the same model, resolution, steps, sampler and guidance which arrive within max_wait seconds of
+each other are generated in one pipeline call (micro-batching)
+--tiny serves a tiny randomly initialized pipeline as the model "tiny", to test it end-to-end on CPU
+"""
+import argparse
+import base64
+import io
+import json
+import math
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# this must not import qtpy, so it can run without a display
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from imageEncoder import get_encoder
+from script import generate_image
+
+REQUEST_DEFAULTS = {
+    'negative_prompt': '',
+    'model': 'runwayml/stable-diffusion-v1-5',
+    'width': 512,
+    'height': 512,
+    'num_inference_steps': 20,
+    'guidance_scale': 7.5,
+    'sampler': 'DPMSolverMultistepScheduler',
+    'count': 1,
+    'seed': None,
+    'timeout': 300,
+}
+
+# models, embeddings and load_profile.jsonl go here, not in the working directory of the server
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                 'pyqt-stable-diffusion-gui')
+
+# bigger ones are rejected before they reach the pipeline
+MAX_COUNT = 64
+MAX_SIZE = 2048
+MAX_STEPS = 1000
+
+
+def get_int(params, name, min_value, max_value, multiple=1):
+    v = params[name]
+    # bool is an int and 1.5 isn't one
+    if isinstance(v, bool) or not isinstance(v, (int, float)) or (isinstance(v, float) and not v.is_integer()):
+        raise ValueError(f'"{name}" must be an integer')
+    v = int(v)
+    if not min_value <= v <= max_value or v % multiple != 0:
+        raise ValueError(f'"{name}" must be between {min_value} and {max_value}' + (f' and a multiple of {multiple}' if multiple > 1 else ''))
+    return v
+
+
+def get_float(params, name, min_value=None):
+    v = params[name]
+    if isinstance(v, bool) or not isinstance(v, (int, float)) or not math.isfinite(v):
+        raise ValueError(f'"{name}" must be a number')
+    if min_value is not None and v <= min_value:
+        raise ValueError(f'"{name}" must be greater than {min_value}')
+    return float(v)
+
+
+class InferenceRequest:
+    def __init__(self, params, max_count=MAX_COUNT):
+        """
+        :param max_count: images of one request, the max batch size of the batcher, which runs the first request of
+        a batch whole whatever its count is
+        """
+        super(InferenceRequest, self).__init__()
+        if not isinstance(params, dict):
+            raise ValueError('The body must be a JSON object')
+        self.params = dict(REQUEST_DEFAULTS)
+        self.params.update(params)
+        self.__validate(min(max_count, MAX_COUNT))
+        if self.params['seed'] is None:
+            self.params['seed'] = random.randrange(2 ** 32)
+
+        self.created = time.perf_counter()
+        self.done = threading.Event()
+        self.cancelled = False
+        self.result = None
+        self.error = None
+
+    def __validate(self, max_count):
+        """
+        everything is checked here, so a bad request is a 400 and never fails the batch it would be merged into
+        """
+        p = self.params
+        if 'prompt' not in p:
+            raise ValueError('"prompt" is missing')
+        for name in ('prompt', 'negative_prompt', 'model', 'sampler'):
+            if not isinstance(p[name], str):
+                raise ValueError(f'"{name}" must be a string')
+        p['count'] = get_int(p, 'count', 1, max_count)
+        p['width'] = get_int(p, 'width', 64, MAX_SIZE, 8)
+        p['height'] = get_int(p, 'height', 64, MAX_SIZE, 8)
+        p['num_inference_steps'] = get_int(p, 'num_inference_steps', 1, MAX_STEPS)
+        p['guidance_scale'] = get_float(p, 'guidance_scale')
+        p['timeout'] = get_float(p, 'timeout', 0)
+        if p['seed'] is not None:
+            p['seed'] = get_int(p, 'seed', 0, 2 ** 32 - 1)
+
+    def get_batch_key(self):
+        p = self.params
+        return p['model'], p['width'], p['height'], p['num_inference_steps'], p['sampler'], float(p['guidance_scale'])
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class MicroBatcher:
+    """
+    runs the queued requests on one worker thread, compatible requests are merged into one pipeline call
+    """
+    def __init__(self, wrapper, cache_dir=DEFAULT_CACHE_DIR, torch_dtype=None, max_batch_size=8, max_wait=0.05, output_encoder='PNG (fast)',
+                 run_batch=None):
+        """
+        :param run_batch: called with each batch of requests, it has to finish every one of them,
+        the pipeline of the wrapper is run if it is None
+        """
+        super(MicroBatcher, self).__init__()
+        self.__initVal(wrapper, cache_dir, torch_dtype, max_batch_size, max_wait, output_encoder, run_batch)
+
+    def __initVal(self, wrapper, cache_dir, torch_dtype, max_batch_size, max_wait, output_encoder, run_batch):
+        self.__wrapper = wrapper
+        self.__run_batch = run_batch or self.__run_pipeline
+        self.__cache_dir = cache_dir
+        self.__torch_dtype = torch_dtype
+        self.__max_batch_size = max_batch_size
+        self.__max_wait = max_wait
+        self.__encoder = get_encoder(output_encoder)
+
+        self.__queue = queue.Queue()
+        # requests which were taken from the queue but didn't fit in the batch being collected
+        self.__pending = deque()
+
+        self.__metrics_lock = threading.Lock()
+        self.__metrics = {
+            'requests': 0,
+            'batches': 0,
+            'images': 0,
+            'timeouts': 0,
+            'errors': 0,
+            'generation_time': 0.0,
+        }
+
+        self.__worker = threading.Thread(target=self.__work, daemon=True)
+        self.__worker.start()
+
+    def get_max_batch_size(self):
+        return self.__max_batch_size
+
+    def submit(self, request):
+        with self.__metrics_lock:
+            self.__metrics['requests'] += 1
+        self.__queue.put(request)
+
+    def __next_request(self, timeout=None):
+        if self.__pending:
+            return self.__pending.popleft()
+        return self.__queue.get(timeout=timeout)
+
+    def __collect_batch(self):
+        first = self.__next_request()
+        batch = [first]
+        image_count = first.params['count']
+        key = first.get_batch_key()
+        deadline = first.created + self.__max_wait
+        skipped = []
+
+        # the pending requests are looked at first, then the queue until the wait window is over
+        while image_count < self.__max_batch_size:
+            try:
+                request = self.__next_request(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if request.get_batch_key() == key and image_count + request.params['count'] <= self.__max_batch_size:
+                batch.append(request)
+                image_count += request.params['count']
+            else:
+                skipped.append(request)
+            if time.perf_counter() >= deadline and not self.__pending:
+                break
+
+        self.__pending.extendleft(reversed(skipped))
+        return batch
+
+    def __work(self):
+        while True:
+            batch = [request for request in self.__collect_batch() if not request.cancelled]
+            if len(batch) == 0:
+                continue
+            try:
+                self.__run_batch(batch)
+            except Exception as e:
+                with self.__metrics_lock:
+                    self.__metrics['errors'] += len(batch)
+                for request in batch:
+                    request.finish(error=str(e))
+
+    def __run_pipeline(self, batch):
+        import torch
+
+        p = batch[0].params
+        torch_dtype = self.__torch_dtype or (torch.float16 if torch.cuda.is_available() else torch.float32)
+        self.__wrapper.init_wrapper(p['model'], self.__cache_dir, torch_dtype, False, p['sampler'])
+        pipeline = self.__wrapper.get_pipeline()
+
+        prompt_embeds, negative_prompt_embeds = self.__wrapper.encode_prompts(
+            [request.params['prompt'] for request in batch], [request.params['negative_prompt'] for request in batch])
+        counts = torch.tensor([request.params['count'] for request in batch], device=prompt_embeds.device)
+        seeds = [request.params['seed'] + i for request in batch for i in range(request.params['count'])]
+
+        start = time.perf_counter()
+        images = generate_image(pipeline,
+                                as_array=True,
+                                prompt_embeds=prompt_embeds.repeat_interleave(counts, dim=0),
+                                negative_prompt_embeds=negative_prompt_embeds.repeat_interleave(counts, dim=0),
+                                width=p['width'],
+                                height=p['height'],
+                                num_inference_steps=p['num_inference_steps'],
+                                guidance_scale=p['guidance_scale'],
+                                generator=[torch.Generator(pipeline.device).manual_seed(seed) for seed in seeds])
+        elapsed = time.perf_counter() - start
+
+        with self.__metrics_lock:
+            self.__metrics['batches'] += 1
+            self.__metrics['images'] += len(images)
+            self.__metrics['generation_time'] += elapsed
+
+        i = 0
+        for request in batch:
+            count = request.params['count']
+            encoded = []
+            for img in images[i:i + count]:
+                f = io.BytesIO()
+                self.__encoder.encode(img, f)
+                encoded.append(base64.b64encode(f.getvalue()).decode('ascii'))
+            request.finish(result={
+                'images': encoded,
+                'format': self.__encoder.ext,
+                'seeds': seeds[i:i + count],
+                'batch_size': len(images),
+                'seconds': round(elapsed, 3),
+            })
+            i += count
+
+    def report_timeout(self):
+        with self.__metrics_lock:
+            self.__metrics['timeouts'] += 1
+
+    def get_metrics(self):
+        with self.__metrics_lock:
+            metrics = dict(self.__metrics)
+        metrics['queue'] = self.__queue.qsize() + len(self.__pending)
+        metrics['average_batch_size'] = round(metrics['images'] / metrics['batches'], 3) if metrics['batches'] else 0.0
+        metrics['images_per_sec'] = round(metrics['images'] / metrics['generation_time'], 3) if metrics['generation_time'] else 0.0
+        if self.__wrapper is not None:
+            metrics['pipeline_cache'] = {k: v for k, v in self.__wrapper.get_pipeline_cache_stats().items() if k != 'models'}
+        return metrics
+
+
+def make_handler(batcher):
+    class InferenceRequestHandler(BaseHTTPRequestHandler):
+        def __send_json(self, status, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.__send_json(200, {'status': 'ok', 'queue': batcher.get_metrics()['queue']})
+            elif self.path == '/metrics':
+                self.__send_json(200, batcher.get_metrics())
+            else:
+                self.__send_json(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            if self.path != '/generate':
+                self.__send_json(404, {'error': 'Not found'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = InferenceRequest(json.loads(self.rfile.read(length)), batcher.get_max_batch_size())
+            except (ValueError, TypeError) as e:
+                self.__send_json(400, {'error': str(e)})
+                return
+
+            batcher.submit(request)
+            if not request.done.wait(request.params['timeout']):
+                # the batcher drops it if it didn't start yet
+                request.cancelled = True
+                batcher.report_timeout()
+                self.__send_json(504, {'error': 'Timeout'})
+            elif request.error is not None:
+                self.__send_json(500, {'error': request.error})
+            else:
+                self.__send_json(200, request.result)
+
+        def log_message(self, format, *args):
+            pass
+
+    return InferenceRequestHandler
+
+
+def serve(host='127.0.0.1', port=7860, cache_dir=DEFAULT_CACHE_DIR, max_batch_size=8, max_wait=0.05, tiny=False):
+    """
+    :return: the server, call serve_forever() (or run it on a thread) and shutdown() on it
+    """
+    import torch
+
+    from stableDiffusionClass import StableDiffusionWrapper
+
+    os.makedirs(cache_dir, exist_ok=True)
+    wrapper = StableDiffusionWrapper(load_profile_filename=os.path.join(cache_dir, 'load_profile.jsonl'))
+    torch_dtype = None
+    if tiny:
+        from tinyPipeline import build_tiny_pipeline, TINY_MODEL_ID
+
+        torch_dtype = torch.float32
+        wrapper.register_pipeline(build_tiny_pipeline(), TINY_MODEL_ID, torch_dtype, False, cache_dir)
+
+    batcher = MicroBatcher(wrapper, cache_dir=cache_dir, torch_dtype=torch_dtype, max_batch_size=max_batch_size, max_wait=max_wait)
+    return ThreadingHTTPServer((host, port), make_handler(batcher))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stable Diffusion inference server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7860)
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--max-batch-size', type=int, default=8, help='max images in one pipeline call')
+    parser.add_argument('--max-wait', type=float, default=0.05, help='seconds to wait for compatible requests')
+    parser.add_argument('--tiny', action='store_true', help='serve a tiny random pipeline as the model "tiny"')
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.cache_dir, args.max_batch_size, args.max_wait, args.tiny)
+    print(f'Serving on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,173 @@
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from memoryGovernor import get_rss, get_cuda_memory
+
+
+def get_read_bytes():
+    """
+    (bytes read from the storage, bytes read by read calls including the page cache) of this process,
+    None if it can't be known
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            with open('/proc/self/io') as f:
+                io = dict(line.split(': ') for line in f.read().splitlines())
+            return int(io['read_bytes']), int(io['rchar'])
+        except (OSError, KeyError, ValueError):
+            pass
+    try:
+        import psutil
+        io = psutil.Process().io_counters()
+        return io.read_bytes, getattr(io, 'read_chars', io.read_bytes)
+    except (ImportError, AttributeError):
+        return None
+
+
+def get_machine_info():
+    info = {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+    }
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        info['torch'] = torch.__version__
+        if torch.cuda.is_available():
+            info['gpu'] = torch.cuda.get_device_name()
+    diffusers = sys.modules.get('diffusers')
+    if diffusers is not None:
+        info['diffusers'] = diffusers.__version__
+    return info
+
+
+class RssSampler:
+    """
+    samples RSS on a thread while a stage runs, loading a model allocates and frees in bursts which a
+    before/after comparison misses
+    """
+    def __init__(self, interval=0.005):
+        super(RssSampler, self).__init__()
+        self.__interval = interval
+        self.__stop_event = threading.Event()
+        self.__peak = get_rss()
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+
+    def __sample(self):
+        while not self.__stop_event.wait(self.__interval):
+            rss = get_rss()
+            if rss is not None and (self.__peak is None or rss > self.__peak):
+                self.__peak = rss
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        """
+        :return: peak RSS in bytes
+        """
+        self.__stop_event.set()
+        self.__thread.join()
+        rss = get_rss()
+        if rss is not None and (self.__peak is None or rss > self.__peak):
+            self.__peak = rss
+        return self.__peak
+
+
+class LoadProfiler:
+    """
+    wall time, bytes read and peak RSS of each stage of loading a model, one JSON line per load in log_filename
+    """
+    def __init__(self, log_filename='load_profile.jsonl', max_profiles=20):
+        super(LoadProfiler, self).__init__()
+        self.__initVal(log_filename, max_profiles)
+
+    def __initVal(self, log_filename, max_profiles):
+        self.__log_filename = log_filename
+        self.__max_profiles = max_profiles
+        self.__profiles = []
+        self.__current = None
+        self.__lock = threading.Lock()
+
+    def begin(self, event, **info):
+        """
+        :param event: what is loaded, e.g. "load", "lora", "memory_attrs"
+        :param info: e.g. model_id, torch_dtype, which goes in the log as it is
+        """
+        self.__current = {'time': time.time(), 'event': event, **info, 'stages': []}
+        self.__start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        if self.__current is None:
+            yield
+            return
+        read_bytes = get_read_bytes()
+        rss = get_rss()
+        sampler = RssSampler()
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peak_rss = sampler.stop()
+            record = {'name': name, 'seconds': round(elapsed, 4), 'peak_rss': peak_rss,
+                      'rss_delta': None if rss is None or peak_rss is None else get_rss() - rss}
+            if read_bytes is not None:
+                new_read_bytes = get_read_bytes()
+                record['read_bytes'] = new_read_bytes[0] - read_bytes[0]
+                record['read_chars'] = new_read_bytes[1] - read_bytes[1]
+            cuda_memory = get_cuda_memory()
+            if cuda_memory is not None:
+                record['cuda_allocated'] = cuda_memory[0]
+            self.__current['stages'].append(record)
+
+    def end(self):
+        """
+        write the profile to the log
+
+        :return: the profile
+        """
+        profile = self.__current
+        if profile is None:
+            return None
+        self.__current = None
+        profile['total_seconds'] = round(time.perf_counter() - self.__start, 4)
+        profile['peak_rss'] = max((s['peak_rss'] for s in profile['stages'] if s['peak_rss'] is not None), default=None)
+        profile['machine'] = get_machine_info()
+
+        with self.__lock:
+            self.__profiles.append(profile)
+            del self.__profiles[:-self.__max_profiles]
+            if self.__log_filename:
+                try:
+                    with open(self.__log_filename, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(profile) + '\n')
+                except OSError as e:
+                    print('load profile is not written:', e)
+        return profile
+
+    def get_profiles(self):
+        with self.__lock:
+            return list(self.__profiles)
+
+
+def format_profile(profile):
+    """
+    :return: lines of text for the GUI and the console
+    """
+    lines = [f"{profile['event']} {profile.get('model_id', '')}: {profile['total_seconds']:.2f} sec"]
+    for stage in profile['stages']:
+        line = f"  {stage['name']:<16} {stage['seconds']:>8.2f} sec"
+        if stage.get('read_bytes') is not None:
+            line += f" {stage['read_bytes'] / 1024 ** 2:>9.1f} MB read"
+        if stage['peak_rss'] is not None:
+            line += f" {stage['peak_rss'] / 1024 ** 3:>6.2f} GB peak RSS"
+        lines.append(line)
+    return lines
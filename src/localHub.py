@@ -0,0 +1,143 @@
+"""
+local HTTP stand-in for the HuggingFace hub, to try the model downloader without the network
+
+usage: python localHub.py <root> [--port 8900], then HF_ENDPOINT=http://127.0.0.1:8900
+
+<root>/<org>/<name>/... is served as the repo "org/name" at the revision "main"
+GET /api/models/<repo_id>/revision/<revision>?blobs=true and GET /<repo_id>/resolve/<revision>/<filename> (with Range)
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+# the hub stores bigger files (and weights) in lfs
+LFS_MIN_SIZE = 10 * 1024 ** 2
+LFS_EXTS = ('.safetensors', '.bin', '.ckpt')
+
+
+def get_git_blob_id(data):
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+def get_file_info(path, filename):
+    with open(path, 'rb') as f:
+        data = f.read()
+    info = {'rfilename': filename, 'size': len(data), 'blobId': get_git_blob_id(data)}
+    if len(data) >= LFS_MIN_SIZE or filename.endswith(LFS_EXTS):
+        info['lfs'] = {'sha256': hashlib.sha256(data).hexdigest(), 'size': len(data), 'pointerSize': 134}
+    return info
+
+
+def get_revision_info(repo_path):
+    siblings = []
+    for root, dirs, files in os.walk(repo_path):
+        for filename in files:
+            path = os.path.join(root, filename)
+            siblings.append(get_file_info(path, os.path.relpath(path, repo_path).replace(os.sep, '/')))
+    siblings.sort(key=lambda x: x['rfilename'])
+    # the commit hash of the revision is made of the contents, like git does
+    sha = hashlib.sha1(json.dumps(siblings).encode('utf-8')).hexdigest()
+    return {'sha': sha, 'siblings': siblings}
+
+
+def make_handler(root, fail_after=None):
+    """
+    :param fail_after: drop the connection after this many bytes of a file, once per file, to try resuming
+    """
+    failed = set()
+    lock = threading.Lock()
+
+    class LocalHubRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def __send_json(self, status, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parts = unquote(urlparse(self.path).path).strip('/').split('/')
+            if parts[:2] == ['api', 'models'] and len(parts) >= 6 and parts[4] == 'revision':
+                repo_path = os.path.join(root, parts[2], parts[3])
+                if not os.path.isdir(repo_path):
+                    self.__send_json(404, {'error': 'Repository not found'})
+                    return
+                self.__send_json(200, get_revision_info(repo_path))
+            elif len(parts) >= 5 and parts[2] == 'resolve':
+                path = os.path.join(root, parts[0], parts[1], *parts[4:])
+                if not os.path.isfile(path):
+                    self.__send_json(404, {'error': 'Entry not found'})
+                    return
+                self.__send_file(path)
+            else:
+                self.__send_json(404, {'error': 'Not found'})
+
+        def __send_file(self, path):
+            size = os.path.getsize(path)
+            start = 0
+            range_header = self.headers.get('Range')
+            if range_header and range_header.startswith('bytes='):
+                start = int(range_header[len('bytes='):].split('-')[0])
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{size - 1}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(size - start))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+
+            limit = size - start
+            with lock:
+                if fail_after is not None and path not in failed and limit > fail_after:
+                    failed.add(path)
+                    limit = fail_after
+                    # the client gets less than Content-Length, like a dropped connection
+                    self.close_connection = True
+            with open(path, 'rb') as f:
+                f.seek(start)
+                while limit > 0:
+                    chunk = f.read(min(1024 ** 2, limit))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    limit -= len(chunk)
+
+        def log_message(self, format, *args):
+            pass
+
+    return LocalHubRequestHandler
+
+
+def serve(root, host='127.0.0.1', port=8900, fail_after=None):
+    """
+    :return: the server, call serve_forever() (or run it on a thread) and shutdown() on it
+    """
+    return ThreadingHTTPServer((host, port), make_handler(root, fail_after))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local stand-in for the HuggingFace hub')
+    parser.add_argument('root')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--fail-after', type=int, default=None, help='drop each file once after this many bytes')
+    args = parser.parse_args()
+
+    server = serve(args.root, args.host, args.port, args.fail_after)
+    print(f'Serving {args.root} on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,253 @@
+import re
+from collections import OrderedDict
+from contextlib import nullcontext
+
+import torch
+
+from huggingface_gui.huggingFaceModelResolver import HuggingFaceModelResolver
+
+
+def get_adapter_name(lora_path):
+    """
+    peft adapter names can't have dots (they are module names), e.g. "org/name" -> "org_name"
+    """
+    return re.sub(r'[^0-9a-zA-Z_]', '_', lora_path.rstrip('/\\'))
+
+
+def resolve_lora_file(lora_path, cache_dir):
+    """
+    :param lora_path: local file, local directory or repo id of the hub
+    :return: path of the weight file, from the cache without asking the hub if it is there
+    """
+    return HuggingFaceModelResolver(cache_dir).resolve_lora(lora_path)
+
+
+def load_lora_state_dict(filename):
+    if filename.endswith('.safetensors'):
+        from safetensors.torch import load_file
+
+        return load_file(filename, device='cpu')
+    return torch.load(filename, map_location='cpu', weights_only=True)
+
+
+class LoraStateDictCache:
+    """
+    LRU cache of the LoRA state dicts as they are read from the file, on the CPU and limited by the size of the tensors
+    the raw state dict is kept (not the converted one) because load_lora_weights converts kohya keys and alphas itself
+    """
+    def __init__(self, max_size=1024 ** 3):
+        super(LoraStateDictCache, self).__init__()
+        self.__initVal(max_size)
+
+    def __initVal(self, max_size):
+        self.__max_size = max_size
+        self.__entries = OrderedDict()
+        self.__size = 0
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    def set_max_size(self, max_size):
+        self.__max_size = max_size
+        self.__evict()
+
+    def get(self, lora_path, cache_dir):
+        state_dict = self.__entries.get(lora_path)
+        if state_dict is not None:
+            self.__hits += 1
+            self.__entries.move_to_end(lora_path)
+            return state_dict
+
+        self.__misses += 1
+        state_dict = load_lora_state_dict(resolve_lora_file(lora_path, cache_dir))
+        self.__entries[lora_path] = state_dict
+        self.__size += self.__get_state_dict_size(state_dict)
+        self.__evict()
+        return state_dict
+
+    def __evict(self):
+        while self.__size > self.__max_size and len(self.__entries) > 1:
+            _, evicted = self.__entries.popitem(last=False)
+            self.__size -= self.__get_state_dict_size(evicted)
+            self.__evictions += 1
+
+    def __get_state_dict_size(self, state_dict):
+        return sum(v.numel() * v.element_size() for v in state_dict.values() if isinstance(v, torch.Tensor))
+
+    def clear(self):
+        self.__entries.clear()
+        self.__size = 0
+
+    def get_stats(self):
+        return {
+            'hits': self.__hits,
+            'misses': self.__misses,
+            'evictions': self.__evictions,
+            'entries': len(self.__entries),
+            'size': self.__size,
+            'max_size': self.__max_size
+        }
+
+
+class LoraManager:
+    """
+    LoRAs of one pipeline as named peft adapters, switching the active ones (and their scales) only
+    changes which adapters are applied, the base model is never reloaded
+
+    adapters which aren't active stay loaded up to max_loaded, the least recently used one is deleted first
+    """
+    def __init__(self, pipeline, state_dict_cache, max_loaded=8):
+        super(LoraManager, self).__init__()
+        self.__initVal(pipeline, state_dict_cache, max_loaded)
+
+    def __initVal(self, pipeline, state_dict_cache, max_loaded):
+        self.__pipeline = pipeline
+        self.__state_dict_cache = state_dict_cache
+        self.__max_loaded = max_loaded
+
+        # adapter name -> lora path, least recently used first
+        self.__loaded = OrderedDict()
+        # ((lora path, scale), ...)
+        self.__active = ()
+        self.__is_fused = False
+        # LoRAs which are in the weights for good (see bake), nothing else can be activated
+        self.__baked = None
+
+    def get_active(self):
+        return self.__active
+
+    def get_loaded(self):
+        return list(self.__loaded.values())
+
+    def is_fused(self):
+        return self.__is_fused
+
+    def is_baked(self):
+        return self.__baked is not None
+
+    def is_current(self, loras, fuse=False):
+        if self.__baked is not None:
+            return self.__baked == normalize_loras(loras)
+        return self.__active == normalize_loras(loras) and self.__is_fused == (fuse and len(self.__active) > 0)
+
+    def load(self, lora_path, cache_dir, profiler=None):
+        """
+        load the adapter without activating it
+
+        :return: adapter name
+        """
+        adapter_name = get_adapter_name(lora_path)
+        if adapter_name in self.__loaded:
+            self.__loaded.move_to_end(adapter_name)
+            return adapter_name
+
+        self.unfuse()
+        with stage(profiler, 'read'):
+            state_dict = self.__state_dict_cache.get(lora_path, cache_dir)
+        with stage(profiler, 'load adapter'):
+            # load_lora_weights pops keys out of the dict it is given
+            self.__pipeline.load_lora_weights(dict(state_dict), adapter_name=adapter_name)
+        self.__loaded[adapter_name] = lora_path
+        self.__delete_unused()
+        return adapter_name
+
+    def unload(self, lora_path):
+        adapter_name = get_adapter_name(lora_path)
+        if adapter_name not in self.__loaded:
+            return
+        active = tuple((path, scale) for path, scale in self.__active if path != lora_path)
+        if active != self.__active:
+            # the other LoRAs stay fused if they were
+            self.set_active(active, fuse=self.__is_fused)
+        self.__pipeline.delete_adapters(adapter_name)
+        del self.__loaded[adapter_name]
+
+    def set_active(self, loras, cache_dir='models', fuse=False, profiler=None):
+        """
+        :param loras: [lora_path or (lora_path, scale), ...], the LoRAs which aren't in it are deactivated
+        :param fuse: merge the active LoRAs into the weights, which makes the steps as fast as without a LoRA
+        """
+        loras = normalize_loras(loras)
+        if self.__baked is not None:
+            if self.__baked != loras:
+                raise ValueError(f'{", ".join(lora_path for lora_path, _ in self.__baked)} is fused into this model, '
+                                 f'it has to be loaded again for other LoRAs')
+            return
+        if self.__active != loras:
+            self.unfuse()
+            adapter_names = [self.load(lora_path, cache_dir, profiler) for lora_path, _ in loras]
+            with stage(profiler, 'set adapters'):
+                if adapter_names:
+                    self.__pipeline.enable_lora()
+                    self.__pipeline.set_adapters(adapter_names, adapter_weights=[scale for _, scale in loras])
+                elif self.__loaded:
+                    self.__pipeline.disable_lora()
+            self.__active = loras
+
+        if fuse and self.__active:
+            self.fuse(profiler)
+        else:
+            self.unfuse(profiler)
+
+    def bake(self, loras, cache_dir='models', profiler=None):
+        """
+        fuse the LoRAs and remove the adapters, the weights are like the ones of a model trained with them
+        """
+        self.set_active(loras, cache_dir, True, profiler)
+        with stage(profiler, 'unload adapters'):
+            self.__pipeline.unload_lora_weights()
+        self.__loaded.clear()
+        self.__is_fused = False
+        self.__baked = self.__active
+
+    def set_baked(self, loras):
+        """
+        the weights of the pipeline were loaded with these LoRAs fused in
+        """
+        self.__active = normalize_loras(loras)
+        self.__baked = self.__active
+
+    def fuse(self, profiler=None):
+        if self.__is_fused or not self.__active:
+            return
+        with stage(profiler, 'fuse'):
+            self.__pipeline.fuse_lora(adapter_names=[get_adapter_name(lora_path) for lora_path, _ in self.__active])
+        self.__is_fused = True
+
+    def unfuse(self, profiler=None):
+        if not self.__is_fused:
+            return
+        with stage(profiler, 'unfuse'):
+            self.__pipeline.unfuse_lora()
+        self.__is_fused = False
+
+    def __delete_unused(self):
+        active = {get_adapter_name(lora_path) for lora_path, _ in self.__active}
+        for adapter_name in list(self.__loaded.keys()):
+            if len(self.__loaded) <= self.__max_loaded:
+                break
+            if adapter_name not in active:
+                self.__pipeline.delete_adapters(adapter_name)
+                del self.__loaded[adapter_name]
+
+
+def normalize_loras(loras):
+    """
+    :param loras: [lora_path or (lora_path, scale), ...]
+    :return: ((lora_path, scale), ...) without duplicates, hashable
+    """
+    normalized = OrderedDict()
+    for lora in loras or []:
+        if isinstance(lora, str):
+            lora_path, scale = lora, 1.0
+        else:
+            lora_path, scale = lora
+        normalized[lora_path] = float(scale)
+    return tuple(normalized.items())
+
+
+def stage(profiler, name):
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name)
@@ -1,8 +1,9 @@
 import os
 import sys
 
+import threading
+
 from svgButton import SvgButton
-from transformers import TRANSFORMERS_CACHE
 
 from settingsWidget import SettingsWidget
 
@@ -15,14 +16,16 @@ project_root = os.path.dirname(os.path.dirname(script_path))
 sys.path.insert(0, project_root)
 sys.path.insert(0, os.getcwd())  # Add the current directory as well
 
-from qtpy.QtCore import QCoreApplication, Qt, QSettings
-from qtpy.QtGui import QGuiApplication, QFont, QIcon
+from qtpy.QtCore import QCoreApplication, Qt, QSettings, QTimer
+from qtpy.QtGui import QGuiApplication, QFont, QIcon, QPixmap
 
 from huggingface_gui.huggingFaceModelWidget import HuggingFaceModelWidget
+from huggingface_gui.huggingFaceModelResolver import set_allow_network
 from parameterWidget import ParameterScrollArea
+from memoryGovernor import get_memory_governor
+from loadProfiler import format_profile
 from script import generate_random_prompt, open_directory
-from stableDiffusionClass import StableDiffusionWrapper
-from thread import Thread
+from thread import Thread, PrewarmThread
 
 from qtpy.QtWidgets import QMainWindow, QApplication, QWidget, QVBoxLayout, \
     QPushButton, QAction, QMenu, QWidgetAction, QLabel, QToolBar, QSplitter, QScrollArea, QHBoxLayout, QSpinBox, \
@@ -50,7 +53,14 @@ class MainWindow(QMainWindow):
         self.__initUi()
 
     def __initVal(self):
-        self.__stable_diffusion_wrapper = StableDiffusionWrapper()
+        # torch and diffusers are imported when it is needed for the first time, see __getWrapper
+        self.__stable_diffusion_wrapper = None
+        # the prewarm thread may make the wrapper while the GUI thread asks for it
+        self.__stable_diffusion_wrapper_lock = threading.Lock()
+        self.__is_preloaded = False
+        # prewarms which were superseded keep running until they notice it, they are kept here until finished
+        self.__prewarm_threads = []
+        self.__t = None
         self.__current_model_lbl_prefix = 'Current Model:'
         self.__settings_ini = QSettings('config.ini', QSettings.IniFormat)
 
@@ -69,6 +79,12 @@ class MainWindow(QMainWindow):
         self.__currentModelLbl = QLabel()
         self.__generateBtn = QPushButton('Generate')
 
+        # the selected model is loaded when the selection stays the same for a moment
+        self.__prewarmTimer = QTimer(self)
+        self.__prewarmTimer.setSingleShot(True)
+        self.__prewarmTimer.setInterval(500)
+        self.__prewarmTimer.timeout.connect(self.__prewarm)
+
         ### huggingface model widget start ###
         self.__huggingFaceModelWidget = HuggingFaceModelWidget()
         self.__huggingFaceModelWidget.onModelAdded.connect(self.__onModelAdded)
@@ -89,7 +105,7 @@ class MainWindow(QMainWindow):
 
         self.__paramScrollArea = ParameterScrollArea()
 
-        self.__currentModelLbl.setText(f'{self.__current_model_lbl_prefix} {self.__current_model}')
+        self.__setCurrentModelLbl()
         self.__currentModelLbl.setContentsMargins(5, 5, 5, 5)
         self.__currentModelLbl.setAlignment(Qt.AlignCenter)
         self.__currentModelLbl.setStyleSheet('QLabel { background-color: #CCC;  border: 1px solid #888 }')
@@ -147,9 +163,16 @@ class MainWindow(QMainWindow):
         lbl.setContentsMargins(2, 2, 2, 2)
         lbl.setStyleSheet('QLabel { background-color: #BBB; border: 1px solid gray }')
 
+        # preview of the image being generated, filled in by the thread every n-th step
+        self.__previewLbl = QLabel()
+        self.__previewLbl.setAlignment(Qt.AlignCenter)
+        self.__previewLbl.setFixedHeight(256)
+        self.__previewLbl.setVisible(False)
+
         lay = QVBoxLayout()
         lay.addWidget(lbl)
         lay.addWidget(self.__paramScrollArea)
+        lay.addWidget(self.__previewLbl)
         lay.setContentsMargins(0, 0, 0, 0)
         lay.setSpacing(0)
 
@@ -179,6 +202,21 @@ class MainWindow(QMainWindow):
         self.__generateWidget = QWidget()
         self.__generateWidget.setLayout(lay)
         self.__generateWidget.setMaximumHeight(self.__generateWidget.sizeHint().height())
+
+        # outside of the generate widget, which is disabled while generating
+        self.__pauseBtn = QPushButton('Pause')
+        self.__pauseBtn.clicked.connect(self.__pauseResume)
+        self.__cancelBtn = QPushButton('Cancel')
+        self.__cancelBtn.clicked.connect(self.__cancel)
+
+        lay = QHBoxLayout()
+        lay.addWidget(self.__pauseBtn)
+        lay.addWidget(self.__cancelBtn)
+
+        self.__runControlWidget = QWidget()
+        self.__runControlWidget.setLayout(lay)
+        self.__runControlWidget.setMaximumHeight(self.__runControlWidget.sizeHint().height())
+        self.__toggleRunControls(False)
         ### generate widget end ###
 
         ### main widget ###
@@ -200,6 +238,7 @@ class MainWindow(QMainWindow):
         lay.addWidget(self.__currentModelLbl)
         lay.addWidget(mainSplitter)
         lay.addWidget(self.__generateWidget)
+        lay.addWidget(self.__runControlWidget)
         lay.setContentsMargins(0, 0, 0, 0)
         lay.setSpacing(0)
 
@@ -262,6 +301,28 @@ class MainWindow(QMainWindow):
         toolbar.setMovable(False)
         self.addToolBar(toolbar)
 
+    def showEvent(self, e):
+        # import the heavy modules in the background once the window is on the screen
+        if not self.__is_preloaded:
+            self.__is_preloaded = True
+            QTimer.singleShot(0, self.__preloadHeavyModules)
+            # the model which was selected last time
+            self.__prewarmTimer.start()
+        return super().showEvent(e)
+
+    def __preloadHeavyModules(self):
+        def preload():
+            import stableDiffusionClass
+        threading.Thread(target=preload, daemon=True).start()
+
+    def __getWrapper(self):
+        with self.__stable_diffusion_wrapper_lock:
+            if self.__stable_diffusion_wrapper is None:
+                # it doesn't import it again if the background preload already did
+                from stableDiffusionClass import StableDiffusionWrapper
+                self.__stable_diffusion_wrapper = StableDiffusionWrapper()
+            return self.__stable_diffusion_wrapper
+
     def __generationCountSpinBoxChanged(self, v):
         self.__generation_count = v
         self.__settings_ini.setValue('generation_count', self.__generation_count)
@@ -271,27 +332,87 @@ class MainWindow(QMainWindow):
         self.__generationCountSpinBox.setEnabled(not self.__is_infinite)
         self.__settings_ini.setValue('is_infinite', self.__is_infinite)
 
+    def __getSavingMemoryAttrs(self):
+        return (self.__settings_ini.value('enable_xformers_memory_efficient_attention', type=bool),
+                self.__settings_ini.value('enable_vae_slicing', type=bool),
+                self.__settings_ini.value('enable_attention_slicing', type=bool),
+                self.__settings_ini.value('enable_vae_tiling', type=bool),
+                self.__settings_ini.value('enable_sequential_cpu_offload', type=bool),
+                self.__settings_ini.value('enable_model_cpu_offload', type=bool))
+
+    def __getFusedLoras(self):
+        # the model is loaded with the LoRAs fused in, from cache_dir/fused when they were saved before
+        return self.__settingsWidget.getLoras() if self.__settingsWidget.getFusedLoraCache() else None
+
+    def __setCurrentModelLbl(self, status=''):
+        self.__currentModelLbl.setText(f'{self.__current_model_lbl_prefix} {self.__current_model}{status}')
+
+    def __prewarm(self):
+        for t in self.__prewarm_threads:
+            t.cancel()
+        if not self.__current_model:
+            return
+        try:
+            get_memory_governor().set_policy(self.__settingsWidget.getMemoryPolicy())
+            set_allow_network(self.__settingsWidget.getAllowNetwork())
+
+            # only plain settings here, torch and the wrapper are loaded in the thread
+            t = PrewarmThread(self.__getWrapper, self.__current_model, self.__settings_ini.value('CACHE_DIR'),
+                              self.__settings_ini.value('torch_dtype', type=str), self.__settingsWidget.getSafetyChecked(),
+                              self.__settings_ini.value('sampler', type=str), self.__getSavingMemoryAttrs(),
+                              self.__getFusedLoras(), self.__settingsWidget.getPipelineCacheSize())
+            t.prewarmFinished.connect(self.__prewarmFinished)
+            t.prewarmFailed.connect(self.__prewarmFailed)
+            t.finished.connect(self.__prewarmThreadFinished)
+            self.__prewarm_threads.append(t)
+            self.__setCurrentModelLbl(' (Loading...)')
+            t.start()
+        except Exception as e:
+            print(e)
+
+    def __prewarmFinished(self, model):
+        if model == self.__current_model:
+            self.__setCurrentModelLbl(' (Ready)')
+            self.__showLoadProfile()
+
+    def __showLoadProfile(self):
+        # the last load of the current model, stage by stage
+        profiles = [profile for profile in self.__getWrapper().get_load_profiles()
+                    if profile['event'] in ('load', 'switch') and profile.get('model_id') == self.__current_model]
+        if profiles:
+            lines = format_profile(profiles[-1])
+            self.__currentModelLbl.setToolTip('\n'.join(lines))
+            self.statusBar().showMessage(lines[0], 10000)
+
+    def __prewarmFailed(self, model, e):
+        if model == self.__current_model:
+            self.__setCurrentModelLbl(' (Failed to load)')
+            self.__currentModelLbl.setToolTip(e)
+
+    def __prewarmThreadFinished(self):
+        self.__prewarm_threads = [t for t in self.__prewarm_threads if not t.isFinished()]
+
     def __generate(self):
+        # the generation loads the model itself
+        self.__prewarmTimer.stop()
         try:
             # get parameters which are necessary to initialize the pipeline
             cache_dir = self.__settings_ini.value('CACHE_DIR')
-            torch_dtype = self.__settingsWidget.getTorchDtype()
+            torch_dtype = self.__settings_ini.value('torch_dtype', type=str)
             safety_checker = self.__settingsWidget.getSafetyChecked()
 
-            enable_xformers_memory_efficient_attention = self.__settings_ini.value('enable_xformers_memory_efficient_attention', type=bool)
-            enable_vae_slicing = self.__settings_ini.value('enable_vae_slicing', type=bool)
-            enable_attention_slicing = self.__settings_ini.value('enable_attention_slicing', type=bool)
-            enable_vae_tiling = self.__settings_ini.value('enable_vae_tiling', type=bool)
-            enable_sequential_cpu_offload = self.__settings_ini.value('enable_sequential_cpu_offload', type=bool)
-            enable_model_cpu_offload = self.__settings_ini.value('enable_model_cpu_offload', type=bool)
-
             sampler = self.__settings_ini.value('sampler', type=str)
 
-            self.__stable_diffusion_wrapper.init_wrapper(self.__current_model, cache_dir, torch_dtype, safety_checker, sampler)
+            get_memory_governor().set_policy(self.__settingsWidget.getMemoryPolicy())
+            set_allow_network(self.__settingsWidget.getAllowNetwork())
 
+            model_id = self.__current_model
+            pipeline_cache_size = self.__settingsWidget.getPipelineCacheSize()
+            fused_loras = self.__getFusedLoras()
+            loras = self.__settingsWidget.getLoras()
+            fuse_lora = self.__settingsWidget.getFuseLora()
             lora_paths = self.__settingsWidget.getLoraPaths()
-            for lora_path in lora_paths:
-                self.__stable_diffusion_wrapper.load_lora_weights(lora_path)
+            saving_memory_attrs = self.__getSavingMemoryAttrs()
 
             width = self.__settings_ini.value('width', type=int)
             height = self.__settings_ini.value('height', type=int)
@@ -313,27 +434,39 @@ class MainWindow(QMainWindow):
             }
 
             save_path = self.__settingsWidget.getSavedPath()
+            output_encoder = self.__settingsWidget.getOutputEncoder()
+            preview_interval = self.__settingsWidget.getPreviewInterval()
+            pack = self.__settingsWidget.getBatchPacking()
+            max_pack_size = self.__settingsWidget.getMaxPackSize()
 
-            self.__stable_diffusion_wrapper.set_saving_memory_attr(
-                enable_xformers_memory_efficient_attention,
-                enable_vae_slicing,
-                enable_attention_slicing,
-                enable_vae_tiling,
-                enable_sequential_cpu_offload,
-                enable_model_cpu_offload
-            )
+            def prepare(pipeline_args):
+                # runs on the generation thread, it may wait for a prewarm which holds the wrapper
+                import torch
 
-            pipeline_args = self.__stable_diffusion_wrapper.forward_embeddings_through_text_encoder(pipeline_args)
+                wrapper = self.__getWrapper()
+                wrapper.set_pipeline_cache_budget(pipeline_cache_size)
+                wrapper.init_wrapper(model_id, cache_dir, torch.float16 if torch_dtype == '16' else torch.float32,
+                                     safety_checker, sampler, fused_loras)
 
-            pipeline = self.__stable_diffusion_wrapper.get_pipeline()
+                # LoRAs which were unchecked are deactivated and the removed ones are unloaded, the model isn't reloaded
+                wrapper.set_loras(loras, fuse_lora)
+                for lora_path in wrapper.get_loaded_loras():
+                    if lora_path not in lora_paths:
+                        wrapper.unload_lora_weights(lora_path)
+
+                wrapper.set_saving_memory_attr(*saving_memory_attrs)
+                return wrapper.get_pipeline(), wrapper.forward_embeddings_through_text_encoder(pipeline_args)
 
             generation_count = -1 if self.__is_infinite else self.__generation_count
 
-            self.__t = Thread(pipeline=pipeline, generation_count=generation_count, model_id=self.__current_model, prompt_text_for_filename=prompt, save_path=save_path, rows=rows, cols=cols, **pipeline_args)
+            self.__t = Thread(pipeline=None, generation_count=generation_count, model_id=model_id, prompt_text_for_filename=prompt, save_path=save_path, rows=rows, cols=cols, output_encoder=output_encoder, preview_interval=preview_interval,
+                             pack=pack, max_pack_size=max_pack_size, prepare=prepare, **pipeline_args)
+            self.__t.pipelineReady.connect(self.__showLoadProfile)
             self.__t.started.connect(self.__started)
             self.__t.finished.connect(self.__t.deleteLater)
             self.__t.generateFinished.connect(self.__generateFinished)
             self.__t.generateFailed.connect(self.__generateFailed)
+            self.__t.previewGenerated.connect(self.__previewGenerated)
             self.__t.start()
         except Exception as e:
             print(e)
@@ -345,22 +478,65 @@ class MainWindow(QMainWindow):
         self.__paramScrollArea.setEnabled(f)
         self.__generateWidget.setEnabled(f)
 
+    def __toggleRunControls(self, f: bool):
+        self.__pauseBtn.setText('Pause')
+        self.__pauseBtn.setEnabled(f)
+        self.__cancelBtn.setEnabled(f)
+
+    def __isRunning(self):
+        return self.__t is not None and self.__t.isRunning()
+
+    def __pauseResume(self):
+        if not self.__isRunning():
+            return
+        if self.__t.isPaused():
+            self.__t.resume()
+            self.__pauseBtn.setText('Pause')
+        else:
+            self.__t.pause()
+            self.__pauseBtn.setText('Resume')
+
+    def __cancel(self):
+        if not self.__isRunning():
+            return
+        self.__t.cancel()
+        # the images made so far are still saved, generateFinished comes after the current step
+        self.__toggleRunControls(False)
+
     def __started(self):
         self.__toggleWidgetByRunning(False)
+        self.__toggleRunControls(True)
 
     def __generateFinished(self, filenames: list):
         print('\n'.join(filenames))
+        print('memory governor:', get_memory_governor().get_stats())
         self.__toggleWidgetByRunning(True)
+        self.__toggleRunControls(False)
+        # the thread deletes itself once it is finished
+        self.__t = None
+        # last used time of the model was updated
+        self.__huggingFaceModelWidget.refreshCacheUsage()
         save_path = self.__settingsWidget.getSavedPath()
         open_directory(save_path)
 
+    def __previewGenerated(self, image, step):
+        self.__previewLbl.setPixmap(QPixmap.fromImage(image).scaled(self.__previewLbl.height(), self.__previewLbl.height(),
+                                                                    Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        self.__previewLbl.setToolTip(f'Step {step + 1}')
+        self.__previewLbl.setVisible(True)
+
     def __generateFailed(self, e):
         QMessageBox.critical(self, "Error", str(e))
         self.__toggleWidgetByRunning(True)
+        self.__toggleRunControls(False)
+        self.__t = None
 
     def __onModelSelected(self, model):
         self.__current_model = model
-        self.__currentModelLbl.setText(f'{self.__current_model_lbl_prefix} {self.__current_model}')
+        self.__setCurrentModelLbl()
+        self.__currentModelLbl.setToolTip('')
+        # restarts the wait if the selection changes quickly
+        self.__prewarmTimer.start()
         self.__settings_ini.setValue('current_model', self.__current_model)
         self.__generateBtn.setEnabled(self.__huggingFaceModelWidget.getModelTable().rowCount() > 0)
 
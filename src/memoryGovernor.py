@@ -0,0 +1,120 @@
+import gc
+import os
+import sys
+import time
+
+# adaptive: collect only when the memory pressure goes over the threshold
+# always: collect before and after every generation (the old behavior)
+# never: leave it to python and the CUDA caching allocator
+POLICIES = ['adaptive', 'always', 'never']
+
+
+def get_rss():
+    """
+    resident set size of this process in bytes, None if it can't be known
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if sys.platform.startswith('linux'):
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return None
+
+
+def get_cuda_memory():
+    """
+    (allocated, reserved, total) bytes of the current CUDA device, None if CUDA isn't used
+    """
+    # torch is not imported just to find out there is nothing to release
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available() or not torch.cuda.is_initialized():
+        return None
+    device = torch.cuda.current_device()
+    return torch.cuda.memory_allocated(device), torch.cuda.memory_reserved(device), torch.cuda.get_device_properties(device).total_memory
+
+
+class MemoryGovernor:
+    """
+    runs gc.collect() and torch.cuda.empty_cache() only when they are worth it
+    """
+    def __init__(self, policy='adaptive', rss_growth_threshold=1024 ** 3, cuda_reserved_threshold=0.85):
+        """
+        :param rss_growth_threshold: collect when RSS grew more than this (bytes) since the last collection
+        :param cuda_reserved_threshold: collect when the CUDA caching allocator holds more than this ratio of the device memory
+        """
+        super(MemoryGovernor, self).__init__()
+        self.__initVal(policy, rss_growth_threshold, cuda_reserved_threshold)
+
+    def __initVal(self, policy, rss_growth_threshold, cuda_reserved_threshold):
+        self.set_policy(policy)
+        self.__rss_growth_threshold = rss_growth_threshold
+        self.__cuda_reserved_threshold = cuda_reserved_threshold
+
+        self.__last_rss = get_rss()
+        self.__checks = 0
+        self.__collections = 0
+        self.__collect_time = 0.0
+
+    def set_policy(self, policy):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown memory policy: {policy} (available: {", ".join(POLICIES)})')
+        self.__policy = policy
+
+    def get_policy(self):
+        return self.__policy
+
+    def set_thresholds(self, rss_growth_threshold=None, cuda_reserved_threshold=None):
+        if rss_growth_threshold is not None:
+            self.__rss_growth_threshold = rss_growth_threshold
+        if cuda_reserved_threshold is not None:
+            self.__cuda_reserved_threshold = cuda_reserved_threshold
+
+    def is_under_pressure(self):
+        rss = get_rss()
+        if rss is not None and self.__last_rss is not None and rss - self.__last_rss > self.__rss_growth_threshold:
+            return True
+        cuda_memory = get_cuda_memory()
+        if cuda_memory is not None:
+            allocated, reserved, total = cuda_memory
+            # only the cached blocks which aren't allocated can be given back
+            if reserved / total > self.__cuda_reserved_threshold and reserved > allocated:
+                return True
+        return False
+
+    def maybe_collect(self):
+        """
+        :return: True if it collected
+        """
+        self.__checks += 1
+        if self.__policy == 'always' or (self.__policy == 'adaptive' and self.is_under_pressure()):
+            self.collect()
+            return True
+        return False
+
+    def collect(self):
+        start = time.perf_counter()
+        gc.collect()
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        self.__collect_time += time.perf_counter() - start
+        self.__collections += 1
+        self.__last_rss = get_rss()
+
+    def get_stats(self):
+        return {
+            'policy': self.__policy,
+            'checks': self.__checks,
+            'collections': self.__collections,
+            'collect_time': round(self.__collect_time, 4)
+        }
+
+
+memory_governor = MemoryGovernor()
+
+
+def get_memory_governor():
+    return memory_governor
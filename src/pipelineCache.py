@@ -0,0 +1,110 @@
+from collections import OrderedDict
+
+
+def get_pipeline_size(pipeline):
+    """
+    size of the weights of the pipeline in bytes (parameters and buffers of every torch module in it)
+    """
+    size = 0
+    for component in pipeline.components.values():
+        if hasattr(component, 'parameters') and hasattr(component, 'buffers'):
+            for p in component.parameters():
+                size += p.numel() * p.element_size()
+            for b in component.buffers():
+                size += b.numel() * b.element_size()
+    return size
+
+
+class PipelineCache:
+    """
+    keeps loaded pipelines resident so switching between models doesn't pay a full cold load
+
+    eviction is LRU weighted by load cost (GreedyDual-Size),
+    a model which took long to load per byte survives longer than a cheap one which was used at the same time
+    """
+    def __init__(self, budget=8 * 1024 ** 3, on_evict=None):
+        super(PipelineCache, self).__init__()
+        self.__initVal(budget, on_evict)
+
+    def __initVal(self, budget, on_evict):
+        self.__budget = budget
+        self.__on_evict = on_evict
+
+        # key: {'pipeline', 'size', 'load_time', 'priority'}
+        self.__entries = OrderedDict()
+        self.__inflation = 0.0
+
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+
+    def __priority(self, size, load_time):
+        # seconds spent to load one GiB, added on top of the current inflation value
+        return self.__inflation + load_time / max(size / 1024 ** 3, 1e-3)
+
+    def get(self, key):
+        entry = self.__entries.get(key)
+        if entry is None:
+            self.__misses += 1
+            return None
+        self.__hits += 1
+        entry['priority'] = self.__priority(entry['size'], entry['load_time'])
+        self.__entries.move_to_end(key)
+        return entry['pipeline']
+
+    def put(self, key, pipeline, load_time):
+        size = get_pipeline_size(pipeline)
+        self.__entries[key] = {
+            'pipeline': pipeline,
+            'size': size,
+            'load_time': load_time,
+            'priority': self.__priority(size, load_time)
+        }
+        self.__entries.move_to_end(key)
+        self.__evict(keep=key)
+
+    def __evict(self, keep=None):
+        while self.get_size() > self.__budget:
+            candidates = [(entry['priority'], k) for k, entry in self.__entries.items() if k != keep]
+            if len(candidates) == 0:
+                # the pipeline in use is bigger than the budget by itself, keep it anyway
+                break
+            # min() returns the least recently used one between the entries of the same priority
+            priority, key = min(candidates, key=lambda x: x[0])
+            self.__inflation = priority
+            self.remove(key)
+            self.__evictions += 1
+
+    def remove(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is not None and self.__on_evict:
+            self.__on_evict(key, entry['pipeline'])
+
+    def clear(self):
+        for key in list(self.__entries.keys()):
+            self.remove(key)
+
+    def keys(self):
+        return list(self.__entries.keys())
+
+    def set_budget(self, budget, keep=None):
+        self.__budget = budget
+        self.__evict(keep=keep)
+
+    def get_budget(self):
+        return self.__budget
+
+    def get_size(self):
+        return sum(entry['size'] for entry in self.__entries.values())
+
+    def get_stats(self):
+        return {
+            'hits': self.__hits,
+            'misses': self.__misses,
+            'evictions': self.__evictions,
+            'entries': len(self.__entries),
+            'size': self.get_size(),
+            'budget': self.__budget,
+            'models': {str(k): {'size': v['size'], 'load_time': round(v['load_time'], 2)} for k, v in self.__entries.items()}
+        }
+
@@ -0,0 +1,69 @@
+import time
+
+# linear approximation of the Stable Diffusion 1.x/2.x VAE decoder, each latent channel to RGB
+# https://discuss.huggingface.co/t/decoding-latents-to-rgb-without-upscaling/23204
+LATENT_RGB_FACTORS = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+]
+
+
+def latents_to_rgb(latents):
+    """
+    project the first latent of the batch to RGB without the VAE
+
+    :param latents: tensor of (batch, 4, height / 8, width / 8)
+    :return: uint8 ndarray of (height / 8, width / 8, 3)
+    """
+    import torch
+
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32, device=latents.device)
+    rgb = torch.einsum('chw,cr->hwr', latents[0].float(), factors)
+    rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8)
+    return rgb.cpu().numpy()
+
+
+class StepPreviewer:
+    """
+    makes the preview of every n-th denoising step and measures how much of the step time it costs
+    """
+    def __init__(self, interval, on_preview):
+        super(StepPreviewer, self).__init__()
+        self.__initVal(interval, on_preview)
+
+    def __initVal(self, interval, on_preview):
+        self.__interval = interval
+        self.__on_preview = on_preview
+
+        self.__last_time = None
+        self.__step_time = 0.0
+        self.__preview_time = 0.0
+        self.__preview_count = 0
+
+    def reset(self):
+        """
+        call it before every pipeline call, so the time between the calls is not counted as step time
+        """
+        self.__last_time = time.perf_counter()
+
+    def __call__(self, step, latents):
+        now = time.perf_counter()
+        if self.__last_time is not None:
+            self.__step_time += now - self.__last_time
+
+        if self.__interval > 0 and (step + 1) % self.__interval == 0 and latents.shape[1] == len(LATENT_RGB_FACTORS):
+            self.__on_preview(latents_to_rgb(latents), step)
+            self.__preview_count += 1
+            self.__preview_time += time.perf_counter() - now
+
+        self.__last_time = time.perf_counter()
+
+    def get_stats(self):
+        return {
+            'preview_count': self.__preview_count,
+            'preview_time': round(self.__preview_time, 4),
+            'step_time': round(self.__step_time, 4),
+            'overhead': round(self.__preview_time / self.__step_time, 4) if self.__step_time else 0.0
+        }
@@ -0,0 +1,46 @@
+import torch
+
+
+def tokenize_chunks(tokenizer, text):
+    """
+    tokenize the text without the token limit and split it into the chunks of model_max_length tokens
+
+    :return: LongTensor of (chunk_count, model_max_length)
+    """
+    max_length = tokenizer.model_max_length
+    length = len(tokenizer(text).input_ids)
+    chunk_count = max(1, -(-length // max_length))
+    input_ids = tokenizer(text, truncation=False, padding="max_length",
+                          max_length=chunk_count * max_length, return_tensors="pt").input_ids
+    return input_ids.view(chunk_count, max_length)
+
+
+def get_padding_chunk(tokenizer):
+    """
+    the chunk which only consists of padding tokens,
+    it is what the padded tail of a shorter prompt turns into after splitting
+    """
+    return torch.full((1, tokenizer.model_max_length), tokenizer.pad_token_id, dtype=torch.long)
+
+
+def encode_chunks(text_encoder, chunks_list, device):
+    """
+    run the text encoder once for the chunks of every text
+
+    :param chunks_list: list of LongTensor of (chunk_count, model_max_length)
+    :return: list of embeddings of (1, chunk_count * model_max_length, hidden_size), one per text
+    """
+    if len(chunks_list) == 0:
+        return []
+    chunk_counts = [chunks.shape[0] for chunks in chunks_list]
+    input_ids = torch.cat(chunks_list, dim=0).to(device)
+    with torch.inference_mode():
+        hidden_states = text_encoder(input_ids)[0]
+    return [embeds.reshape(1, -1, embeds.shape[-1]) for embeds in torch.split(hidden_states, chunk_counts, dim=0)]
+
+
+def pad_embeds(embeds, length, padding_chunk_embeds):
+    if embeds.shape[1] < length:
+        chunk_count = (length - embeds.shape[1]) // padding_chunk_embeds.shape[1]
+        embeds = torch.cat([embeds] + [padding_chunk_embeds] * chunk_count, dim=1)
+    return embeds
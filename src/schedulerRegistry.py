@@ -0,0 +1,72 @@
+import copy
+
+from diffusers import DPMSolverMultistepScheduler, DPMSolverSinglestepScheduler, EulerAncestralDiscreteScheduler, \
+    EulerDiscreteScheduler, HeunDiscreteScheduler, LMSDiscreteScheduler, PNDMScheduler
+
+SCHEDULERS = {
+    'PNDMScheduler': PNDMScheduler,
+    'DPMSolverMultistepScheduler': DPMSolverMultistepScheduler,
+    'DPMSolverSinglestepScheduler': DPMSolverSinglestepScheduler,
+    'LMSDiscreteScheduler': LMSDiscreteScheduler,
+    'HeunDiscreteScheduler': HeunDiscreteScheduler,
+    'EulerDiscreteScheduler': EulerDiscreteScheduler,
+    'EulerAncestralDiscreteScheduler': EulerAncestralDiscreteScheduler,
+}
+
+
+def check_sampler(sampler):
+    if sampler not in SCHEDULERS:
+        raise ValueError(f'Unknown sampler: {sampler} (available: {", ".join(SCHEDULERS.keys())})')
+
+
+def cache_timesteps(scheduler):
+    """
+    replace scheduler.set_timesteps with the one which computes the timestep/sigma tables only once per
+    (num_inference_steps, device) and restores the scheduler state from the snapshot after that
+    """
+    set_timesteps = scheduler.set_timesteps
+    tables = {}
+
+    def restore(snapshot):
+        # lists (e.g. model_outputs, ets) are filled in during denoising, so each run needs its own copy
+        scheduler.__dict__.update({k: copy.copy(v) if isinstance(v, (list, dict)) else v for k, v in snapshot.items()})
+
+    def cached_set_timesteps(num_inference_steps=None, device=None, **kwargs):
+        # custom timesteps/sigmas are not cached
+        if num_inference_steps is None or kwargs:
+            return set_timesteps(num_inference_steps, device=device, **kwargs)
+        key = (num_inference_steps, str(device))
+        snapshot = tables.get(key)
+        if snapshot is None:
+            set_timesteps(num_inference_steps, device=device)
+            tables[key] = {k: v for k, v in scheduler.__dict__.items() if k != 'set_timesteps'}
+            restore(tables[key])
+        else:
+            restore(snapshot)
+
+    scheduler.set_timesteps = cached_set_timesteps
+    return scheduler
+
+
+class SchedulerRegistry:
+    """
+    builds each scheduler once per pipeline from the original scheduler config of it
+    """
+    def __init__(self, base_config):
+        super(SchedulerRegistry, self).__init__()
+        self.__initVal(base_config)
+
+    def __initVal(self, base_config):
+        self.__base_config = base_config
+        self.__schedulers = {}
+
+    def get(self, sampler):
+        check_sampler(sampler)
+        scheduler = self.__schedulers.get(sampler)
+        if scheduler is None:
+            scheduler = SCHEDULERS[sampler].from_config(self.__base_config, use_karras_sigmas=True)
+            self.__schedulers[sampler] = cache_timesteps(scheduler)
+        return scheduler
+
+    def precompute(self, sampler, num_inference_steps, device=None):
+        self.get(sampler).set_timesteps(num_inference_steps, device=device)
@@ -1,12 +1,12 @@
-import gc
 import os
 import random
 import string
 import sys
 
-import torch
 from PIL import Image
-from huggingface_hub import list_files_info
+
+from imageEncoder import to_pil_image
+from memoryGovernor import get_memory_governor
 
 
 def generate_random_prompt(arr):
@@ -34,28 +34,85 @@ def get_filename(prompt, cnt, ext, width, height, model_id, suffix=''):
     return replace_invalid_characters(f"{'_'.join(map(lambda x: x.replace(',', ''), prompt.split()[:cnt]))}({width}x{height})-{model_id}_{suffix}{ext}")
 
 def image_to_grid(images, rows, cols):
-    assert len(images) == rows * cols
-
-    w, h = images[0].size
-    grid = Image.new('RGB', size=(cols * w, rows * h))
-
-    for i, img in enumerate(images):
-        grid.paste(img, box=(i % cols * w, i // cols * h))
-    return grid
-
-def generate_image(pipeline, **args):
-    # clear cache to avoid OutOfMemoryError (before image generation)
-    gc.collect()
-    torch.cuda.empty_cache()
-
+    """
+    one reshape of the whole batch instead of pasting the images one by one
+
+    :param images: uint8 ndarray of (batch, height, width, 3), or a list of PIL images
+    :return: (rows * height, cols * width, 3) ndarray, or a PIL image for a list of PIL images,
+    fewer images than rows * cols leave the rest of the last row black and the empty rows out
+    """
+    import numpy as np
+
+    is_pil = isinstance(images, (list, tuple)) and len(images) > 0 and isinstance(images[0], Image.Image)
+    batch = np.stack([np.asarray(img.convert('RGB')) for img in images]) if is_pil else np.asarray(images)
+    n, h, w, c = batch.shape
+    if n > rows * cols:
+        raise ValueError(f'{n} images don\'t fit in a {rows}x{cols} grid')
+
+    rows = min(rows, -(-n // cols))
+    if n < rows * cols:
+        batch = np.concatenate([batch, np.zeros((rows * cols - n, h, w, c), dtype=batch.dtype)])
+    grid = batch.reshape(rows, cols, h, w, c).swapaxes(1, 2).reshape(rows * h, cols * w, c)
+    return Image.fromarray(grid) if is_pil else grid
+
+def to_uint8_array(images):
+    """
+    :param images: float tensor of (batch, 3, height, width) in [0, 1], output_type='pt' of the pipeline
+    :return: uint8 ndarray of (batch, height, width, 3), converted on the device the images are on
+    """
+    import torch
+
+    return images.mul(255).round_().clamp_(0, 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+
+def generate_image(pipeline, as_array=False, **args):
+    """
+    :param as_array: return one uint8 ndarray of (batch, height, width, 3) instead of PIL images,
+    PIL is used only when the images are encoded
+    """
+    # clear cache to avoid OutOfMemoryError (before image generation) if memory is tight
+    get_memory_governor().maybe_collect()
+
+    if as_array:
+        args['output_type'] = 'pt'
     images = pipeline(**args).images
+    if as_array:
+        images = to_uint8_array(images)
 
-    # clear cache to avoid OutOfMemoryError (after image generation)
-    gc.collect()
-    torch.cuda.empty_cache()
+    # clear cache to avoid OutOfMemoryError (after image generation) if memory is tight
+    get_memory_governor().maybe_collect()
     return images
 
-def save_image(images, prompt, model_id, ext='.png', save_path='.', suffix=''):
+def get_image_size(img):
+    """
+    :return: width, height of a PIL image or of an ndarray of (height, width, 3)
+    """
+    if isinstance(img, Image.Image):
+        return img.size
+    return img.shape[1], img.shape[0]
+
+def get_image_filename(img, prompt, model_id, ext='.png', save_path='.', suffix=''):
+    width, height = get_image_size(img)
+    return os.path.join(save_path, get_filename(prompt, 10, ext, width=width, height=height, model_id=model_id,
+                                                suffix=(suffix if suffix == '' else suffix+'_')+generate_random_string(10)))
+
+def write_image(img, filename, encoder=None):
+    # fsync so the file is durable by the time the caller is told it is written
+    with open(filename, 'wb') as f:
+        if encoder:
+            encoder.encode(img, f)
+        else:
+            to_pil_image(img).save(f, format=Image.registered_extensions()[os.path.splitext(filename)[1].lower()])
+        f.flush()
+        os.fsync(f.fileno())
+
+def save_image(images, prompt, model_id, ext='.png', save_path='.', suffix='', writer=None, encoder=None):
+    """
+    :param writer: ImageWriterPool, the image is written in the background if it is given
+    :param encoder: ImageEncoder, ext is taken from it if it is given (the writer should use the same encoder)
+    """
+    if encoder:
+        ext = encoder.ext
+
     # Create the directory if it doesn't exist
     os.makedirs(save_path, exist_ok=True)
 
@@ -63,9 +120,11 @@ def save_image(images, prompt, model_id, ext='.png', save_path='.', suffix=''):
 
     if len(images) > 0:
         img = images[0]
-        filename = os.path.join(save_path, get_filename(prompt, 10, ext, width=img.width, height=img.height, model_id=model_id,
-                                                        suffix=(suffix if suffix == '' else suffix+'_')+generate_random_string(10)))
-        img.save(filename)
+        filename = get_image_filename(img, prompt, model_id, ext=ext, save_path=save_path, suffix=suffix)
+        if writer:
+            writer.submit(img, filename)
+        else:
+            write_image(img, filename, encoder)
 
     return filename
 
@@ -78,6 +137,3 @@ def open_directory(path):
         os.system('xdg-open "{}"'.format(path))
     else:
         print("Unsupported operating system.")
-
-def get_info(lora_path):
-    return [info.rfilename for info in list_files_info(lora_path) if info.lfs is not None]
\ No newline at end of file
@@ -1,15 +1,16 @@
 import subprocess
 
 import os
-import torch
 from qtpy.QtWidgets import QFrame, QLabel, QSpacerItem, QSizePolicy, QTableWidget, QHeaderView, QAbstractItemView, \
-    QDialog, QMessageBox, QListWidget
+    QDialog, QMessageBox, QListWidget, QListWidgetItem, QSpinBox, QDoubleSpinBox
 from qtpy.QtCore import Qt, QSettings, Signal
 from qtpy.QtWidgets import QLineEdit, QMenu, QAction
 from qtpy.QtWidgets import QWidget, QFormLayout, QCheckBox, QGroupBox, QVBoxLayout, \
     QRadioButton, QHBoxLayout, QScrollArea, QPushButton, QFileDialog
 
+from imageEncoder import ENCODERS, DEFAULT_ENCODER
 from inputDialog import InputDialog
+from memoryGovernor import POLICIES
 from twoColCmbBox import TwoColComboBox
 from disableWheelComboBox import DisableWheelComboBox
 
@@ -109,6 +110,14 @@ class SettingsWidget(QScrollArea):
             self.__settings_ini.setValue("torch_dtype", 16)
         if not self.__settings_ini.contains('safety_checker'):
             self.__settings_ini.setValue("safety_checker", False)
+        if not self.__settings_ini.contains('pipeline_cache_size'):
+            self.__settings_ini.setValue("pipeline_cache_size", 8)
+        if not self.__settings_ini.contains('output_encoder'):
+            self.__settings_ini.setValue("output_encoder", DEFAULT_ENCODER)
+        if not self.__settings_ini.contains('preview_interval'):
+            self.__settings_ini.setValue("preview_interval", 5)
+        if not self.__settings_ini.contains('allow_network'):
+            self.__settings_ini.setValue("allow_network", True)
 
         if not self.__settings_ini.contains('enable_xformers_memory_efficient_attention'):
             self.__settings_ini.setValue("enable_xformers_memory_efficient_attention", False)
@@ -123,13 +132,29 @@ class SettingsWidget(QScrollArea):
         if not self.__settings_ini.contains('enable_model_cpu_offload'):
             self.__settings_ini.setValue("enable_model_cpu_offload", False)
 
+        if not self.__settings_ini.contains('memory_policy'):
+            self.__settings_ini.setValue('memory_policy', 'adaptive')
+        if not self.__settings_ini.contains('batch_packing'):
+            self.__settings_ini.setValue('batch_packing', False)
+        if not self.__settings_ini.contains('max_pack_size'):
+            self.__settings_ini.setValue('max_pack_size', 8)
+
         if not self.__settings_ini.contains('sampler'):
             self.__settings_ini.setValue('sampler', 'DPMSolverMultistepScheduler')
 
+        if not self.__settings_ini.contains('fuse_lora'):
+            self.__settings_ini.setValue('fuse_lora', False)
+        if not self.__settings_ini.contains('fused_lora_cache'):
+            self.__settings_ini.setValue('fused_lora_cache', False)
+
         # Read configuration values
         self.__save_path = self.__settings_ini.value('save_path', type=str)
         self.__torch_dtype = self.__settings_ini.value('torch_dtype', type=str)
         self.__safety_checker = self.__settings_ini.value("safety_checker", type=bool)
+        self.__pipeline_cache_size = self.__settings_ini.value("pipeline_cache_size", type=int)
+        self.__output_encoder = self.__settings_ini.value("output_encoder", type=str)
+        self.__preview_interval = self.__settings_ini.value("preview_interval", type=int)
+        self.__allow_network = self.__settings_ini.value("allow_network", type=bool)
 
         self.__enable_xformers_memory_efficient_attention = self.__settings_ini.value('enable_xformers_memory_efficient_attention', type=bool)
         self.__enable_vae_slicing = self.__settings_ini.value('enable_vae_slicing', type=bool)
@@ -138,8 +163,15 @@ class SettingsWidget(QScrollArea):
         self.__enable_sequential_cpu_offload = self.__settings_ini.value('enable_sequential_cpu_offload', type=bool)
         self.__enable_model_cpu_offload = self.__settings_ini.value('enable_model_cpu_offload', type=bool)
 
+        self.__memory_policy = self.__settings_ini.value('memory_policy', type=str)
+        self.__batch_packing = self.__settings_ini.value('batch_packing', type=bool)
+        self.__max_pack_size = self.__settings_ini.value('max_pack_size', type=int)
+
         self.__sampler = self.__settings_ini.value('sampler', type=str)
 
+        self.__fuse_lora = self.__settings_ini.value('fuse_lora', type=bool)
+        self.__fused_lora_cache = self.__settings_ini.value('fused_lora_cache', type=bool)
+
     def __initUi(self):
         basicSettingsGrpBox = QGroupBox('General')
 
@@ -155,10 +187,37 @@ class SettingsWidget(QScrollArea):
         safetyCheckedChkBox.setChecked(self.__safety_checker)
         safetyCheckedChkBox.toggled.connect(self.__safetyCheckerChanged)
 
+        pipelineCacheSizeSpinBox = QSpinBox()
+        pipelineCacheSizeSpinBox.setRange(1, 1024)
+        pipelineCacheSizeSpinBox.setSuffix(' GiB')
+        pipelineCacheSizeSpinBox.setValue(self.__pipeline_cache_size)
+        pipelineCacheSizeSpinBox.valueChanged.connect(self.__pipelineCacheSizeChanged)
+
+        outputEncoderCmbBox = DisableWheelComboBox()
+        outputEncoderCmbBox.addItems(ENCODERS.keys())
+        outputEncoderCmbBox.setCurrentText(self.__output_encoder)
+        outputEncoderCmbBox.currentTextChanged.connect(self.__outputEncoderChanged)
+
+        # 0 turns the preview off
+        previewIntervalSpinBox = QSpinBox()
+        previewIntervalSpinBox.setRange(0, 100)
+        previewIntervalSpinBox.setSpecialValueText('Off')
+        previewIntervalSpinBox.setValue(self.__preview_interval)
+        previewIntervalSpinBox.valueChanged.connect(self.__previewIntervalChanged)
+
+        # off: models and LoRAs which aren't in the cache directory fail instead of being downloaded
+        allowNetworkChkBox = QCheckBox()
+        allowNetworkChkBox.setChecked(self.__allow_network)
+        allowNetworkChkBox.toggled.connect(self.__allowNetworkChanged)
+
         lay = QFormLayout()
         lay.addRow('Saved Path', findPathLineEdit)
+        lay.addRow('Output Format', outputEncoderCmbBox)
+        lay.addRow('Preview Every N Steps', previewIntervalSpinBox)
         lay.addRow('Torch DType', torchDtypeCmbBox)
         lay.addRow('Safety Checked', safetyCheckedChkBox)
+        lay.addRow('Pipeline Cache Size', pipelineCacheSizeSpinBox)
+        lay.addRow('Download Missing Models', allowNetworkChkBox)
 
         basicSettingsGrpBox.setLayout(lay)
 
@@ -201,7 +260,26 @@ class SettingsWidget(QScrollArea):
         cpuOffloadGrpBox = QGroupBox('CPU Offload Policy')
         cpuOffloadGrpBox.setLayout(lay)
 
+        # when to run gc.collect() and torch.cuda.empty_cache()
+        memoryPolicyCmbBox = DisableWheelComboBox()
+        memoryPolicyCmbBox.addItems(POLICIES)
+        memoryPolicyCmbBox.setCurrentText(self.__memory_policy)
+        memoryPolicyCmbBox.currentTextChanged.connect(self.__memoryPolicyChanged)
+
+        # generations are merged into bigger pipeline calls up to max_pack_size images
+        batchPackingChkBox = QCheckBox()
+        batchPackingChkBox.setChecked(self.__batch_packing)
+        batchPackingChkBox.toggled.connect(self.__batchPackingChanged)
+
+        maxPackSizeSpinBox = QSpinBox()
+        maxPackSizeSpinBox.setRange(1, 64)
+        maxPackSizeSpinBox.setValue(self.__max_pack_size)
+        maxPackSizeSpinBox.valueChanged.connect(self.__maxPackSizeChanged)
+
         lay = QFormLayout()
+        lay.addRow('Memory Cleanup', memoryPolicyCmbBox)
+        lay.addRow('Batch Packing', batchPackingChkBox)
+        lay.addRow('Max Images per Batch', maxPackSizeSpinBox)
         lay.addRow('enable_xformers_memory_efficient_attention', enable_xformers_memory_efficient_attentionChkBox)
         lay.addRow('enable_vae_slicing', enable_vae_slicingChkBox)
         lay.addRow('enable_attention_slicing', enable_attention_slicingChkBox)
@@ -248,11 +326,40 @@ class SettingsWidget(QScrollArea):
         loraMenuWidget = QWidget()
         loraMenuWidget.setLayout(lay)
 
+        # unchecked LoRAs stay loaded in the pipeline but aren't applied
         self.__loraList = QListWidget()
+        self.__loraList.currentItemChanged.connect(self.__loraCurrentItemChanged)
+
+        self.__loraScaleSpinBox = QDoubleSpinBox()
+        self.__loraScaleSpinBox.setRange(-2.0, 2.0)
+        self.__loraScaleSpinBox.setSingleStep(0.05)
+        self.__loraScaleSpinBox.setValue(1.0)
+        self.__loraScaleSpinBox.setEnabled(False)
+        self.__loraScaleSpinBox.valueChanged.connect(self.__loraScaleChanged)
+
+        # merged into the weights, steps are as fast as without a LoRA but changing them takes longer
+        fuseLoraChkBox = QCheckBox()
+        fuseLoraChkBox.setChecked(self.__fuse_lora)
+        fuseLoraChkBox.toggled.connect(self.__fuseLoraChanged)
+
+        # for LoRA sets which don't change, the model is saved with them fused in and loaded like that next time
+        fusedLoraCacheChkBox = QCheckBox()
+        fusedLoraCacheChkBox.setChecked(self.__fused_lora_cache)
+        fusedLoraCacheChkBox.toggled.connect(self.__fusedLoraCacheChanged)
+
+        formLay = QFormLayout()
+        formLay.addRow('Scale', self.__loraScaleSpinBox)
+        formLay.addRow('Fuse', fuseLoraChkBox)
+        formLay.addRow('Save Fused Model', fusedLoraCacheChkBox)
+        formLay.setContentsMargins(0, 0, 0, 0)
+
+        loraOptionWidget = QWidget()
+        loraOptionWidget.setLayout(formLay)
 
         lay = QVBoxLayout()
         lay.addWidget(loraMenuWidget)
         lay.addWidget(self.__loraList)
+        lay.addWidget(loraOptionWidget)
 
         loraWidget = QWidget()
         loraWidget.setLayout(lay)
@@ -276,13 +383,44 @@ class SettingsWidget(QScrollArea):
             try:
                 lora_text = dialog.getText()
                 # add model in the table
-                self.__loraList.addItem(lora_text)
+                item = QListWidgetItem(lora_text)
+                item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+                item.setCheckState(Qt.Checked)
+                item.setData(Qt.UserRole, 1.0)
+                item.setToolTip('Scale: 1.0')
+                self.__loraList.addItem(item)
+                self.__loraList.setCurrentItem(item)
             except Exception as e:
                 QMessageBox.critical(self, "Error", str(e))
 
     def __deleteClicked(self):
         self.__loraList.takeItem(self.__loraList.currentRow())
 
+    def __loraCurrentItemChanged(self, item, _):
+        self.__loraScaleSpinBox.setEnabled(item is not None)
+        if item is not None:
+            self.__loraScaleSpinBox.setValue(item.data(Qt.UserRole))
+
+    def __loraScaleChanged(self, v):
+        item = self.__loraList.currentItem()
+        if item is not None:
+            item.setData(Qt.UserRole, v)
+            item.setToolTip(f'Scale: {v}')
+
+    def __fuseLoraChanged(self, f):
+        self.__settings_ini.setValue('fuse_lora', f)
+        self.__fuse_lora = f
+
+    def getFuseLora(self):
+        return self.__fuse_lora
+
+    def __fusedLoraCacheChanged(self, f):
+        self.__settings_ini.setValue('fused_lora_cache', f)
+        self.__fused_lora_cache = f
+
+    def getFusedLoraCache(self):
+        return self.__fused_lora_cache
+
     def __pathChanged(self, save_path):
         self.__settings_ini.setValue("save_path", save_path)
         self.__save_path = save_path
@@ -295,6 +433,24 @@ class SettingsWidget(QScrollArea):
         self.__settings_ini.setValue("safety_checker", f)
         self.__safety_checker = f
 
+    def __pipelineCacheSizeChanged(self, v):
+        self.__settings_ini.setValue("pipeline_cache_size", v)
+        self.__pipeline_cache_size = v
+
+    def __outputEncoderChanged(self, output_encoder):
+        self.__settings_ini.setValue("output_encoder", output_encoder)
+        self.__output_encoder = output_encoder
+
+    def getOutputEncoder(self):
+        return self.__output_encoder
+
+    def __previewIntervalChanged(self, v):
+        self.__settings_ini.setValue("preview_interval", v)
+        self.__preview_interval = v
+
+    def getPreviewInterval(self):
+        return self.__preview_interval
+
     def getSavedPath(self):
         return self.__save_path
 
@@ -303,6 +459,9 @@ class SettingsWidget(QScrollArea):
         self.__sampler = sampler
 
     def getTorchDtype(self):
+        # torch is imported here, not at the top, to keep it out of the startup
+        import torch
+
         if self.__torch_dtype == '16':
             return torch.float16
         elif self.__torch_dtype == '32':
@@ -311,6 +470,16 @@ class SettingsWidget(QScrollArea):
     def getSafetyChecked(self):
         return self.__safety_checker
 
+    def getPipelineCacheSize(self):
+        return self.__pipeline_cache_size
+
+    def __allowNetworkChanged(self, f):
+        self.__settings_ini.setValue("allow_network", f)
+        self.__allow_network = f
+
+    def getAllowNetwork(self):
+        return self.__allow_network
+
     def __enable_xformers_memory_efficient_attentionChkBoxChanged(self, f):
         self.__settings_ini.setValue('enable_xformers_memory_efficient_attention', f)
         self.__enable_xformers_memory_efficient_attention = f
@@ -340,9 +509,37 @@ class SettingsWidget(QScrollArea):
         self.__settings_ini.setValue('enable_model_cpu_offload', f)
         self.__enable_model_cpu_offload = f
 
+    def __memoryPolicyChanged(self, policy):
+        self.__settings_ini.setValue('memory_policy', policy)
+        self.__memory_policy = policy
+
+    def getMemoryPolicy(self):
+        return self.__memory_policy
+
+    def __batchPackingChanged(self, f):
+        self.__settings_ini.setValue('batch_packing', f)
+        self.__batch_packing = f
+
+    def __maxPackSizeChanged(self, v):
+        self.__settings_ini.setValue('max_pack_size', v)
+        self.__max_pack_size = v
+
+    def getBatchPacking(self):
+        return self.__batch_packing
+
+    def getMaxPackSize(self):
+        return self.__max_pack_size
+
     def getLoraPaths(self):
         file_lst = [self.__loraList.item(i).text() for i in range(self.__loraList.count())]
         if len(file_lst) > 0:
             return file_lst
         else:
-            return ''
\ No newline at end of file
+            return ''
+
+    def getLoras(self):
+        """
+        :return: [(lora_path, scale), ...] of the checked LoRAs
+        """
+        items = [self.__loraList.item(i) for i in range(self.__loraList.count())]
+        return [(item.text(), item.data(Qt.UserRole)) for item in items if item.checkState() == Qt.Checked]
\ No newline at end of file
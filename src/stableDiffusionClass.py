@@ -1,22 +1,45 @@
-import gc
+import importlib
+import json
 import os.path
+import threading
+import time
 
 import torch
-import torch.nn.functional as F
 
-from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler, DPMSolverSinglestepScheduler, \
-    EulerAncestralDiscreteScheduler, EulerDiscreteScheduler, HeunDiscreteScheduler, LMSDiscreteScheduler, PNDMScheduler
-from transformers import TRANSFORMERS_CACHE
+from diffusers import StableDiffusionPipeline
 
-from script import get_info
+from embeddingCache import EmbeddingCache
+from fusedModelCache import FusedModelCache
+from huggingface_gui.huggingFaceCacheIndex import get_cache_index
+from huggingface_gui.huggingFaceModelResolver import HuggingFaceModelResolver
+from loadProfiler import LoadProfiler, format_profile
+from loraManager import LoraManager, LoraStateDictCache, normalize_loras
+from memoryGovernor import get_memory_governor
+from pipelineCache import PipelineCache
+from promptEncoder import tokenize_chunks, get_padding_chunk, encode_chunks, pad_embeds
+from schedulerRegistry import SchedulerRegistry, check_sampler
+
+
+def get_component_class(library, class_name):
+    """
+    the class of a model_index.json entry like diffusers finds it, e.g. ["stable_diffusion", "StableDiffusionSafetyChecker"]
+    is in diffusers.pipelines.stable_diffusion, ["transformers", "CLIPTextModel"] is in the library itself
+    """
+    import diffusers.pipelines
+
+    if hasattr(diffusers.pipelines, library):
+        module = getattr(diffusers.pipelines, library)
+    else:
+        module = importlib.import_module(library)
+    return getattr(module, class_name)
 
 
 class StableDiffusionWrapper:
-    def __init__(self):
+    def __init__(self, load_profile_filename='load_profile.jsonl'):
         super(StableDiffusionWrapper, self).__init__()
-        self.__initVal()
+        self.__initVal(load_profile_filename)
 
-    def __initVal(self):
+    def __initVal(self, load_profile_filename):
         self.__device = 'cuda' if torch.cuda.is_available() else 'cpu'
         if self.__device == 'cuda':
             # https://huggingface.co/docs/diffusers/optimization/fp16#use-tf32-instead-of-fp32-on-ampere-and-later-cuda-devices
@@ -27,6 +50,8 @@ class StableDiffusionWrapper:
         self.__cache_dir = 'models'
         self.__torch_dtype = torch.float16
         self.__is_safety_checker = True
+        # LoRAs which are fused into the weights when the model is loaded, see init_wrapper
+        self.__fused_loras = ()
 
         self.__pipeline = None
         self.__sampler = None
@@ -38,61 +63,261 @@ class StableDiffusionWrapper:
         self.__enable_sequential_cpu_offload = False
         self.__enable_model_cpu_offload = False
 
-        self.__lora_path = []
+        # LoRA adapters of the current pipeline, the state dicts read from the files are shared by every pipeline
+        self.__lora_manager = None
+        self.__lora_state_dict_cache = LoraStateDictCache()
+
+        # pipelines which were loaded before stay resident, keyed by (model_id, torch_dtype, is_safety_checker, fused_loras, cache_dir)
+        self.__pipeline_key = None
+        self.__pipeline_cache = PipelineCache(on_evict=self.__onPipelineEvicted)
+        # sampler, LoRA and memory attributes which were applied to each cached pipeline
+        self.__pipeline_states = {}
+
+        # time, bytes read and peak RSS of each step of loading a model, see load_profile.jsonl
+        self.__load_profiler = LoadProfiler(load_profile_filename)
+
+        # the pipeline can be loaded by the prewarm thread while the GUI thread wants it for generating
+        self.__lock = threading.RLock()
+
+        # prompt/negative prompt embeddings keyed by (model, tokenizer, LoRA set, text)
+        self.__embedding_cache = EmbeddingCache(disk_dir=os.path.join(self.__cache_dir, 'embeddings'))
+
+    def init_wrapper(self, model_id, cache_dir='models', torch_dtype=torch.float16, is_safety_checker=True, sampler='PNDMScheduler',
+                     fused_loras=None):
+        """
+        :param fused_loras: [lora_path or (lora_path, scale), ...] fused into the weights for good, the fused UNet and
+        text encoder are saved in cache_dir/fused and loaded from there next time instead of applying the LoRAs again
+        """
+        with self.__lock:
+            # clear cache to avoid OutOfMemoryError if memory is tight
+            get_memory_governor().maybe_collect()
+
+            # fail before loading anything if config.ini has a sampler which doesn't exist
+            check_sampler(sampler)
+
+            # the same model id can be another model in another cache directory
+            key = (model_id, torch_dtype, is_safety_checker, normalize_loras(fused_loras), cache_dir)
+            if self.__pipeline_key != key:
+                self.__switch_pipeline(key)
+
+            if self.__pipeline and self.__sampler != sampler:
+                self.__set_sampler(sampler)
+
+            # the model table and the quota eviction go by this
+            get_cache_index(self.__cache_dir).record_use(model_id)
+
+    def __switch_pipeline(self, key):
+        old_key = self.__model_id, self.__torch_dtype, self.__is_safety_checker, self.__fused_loras, self.__cache_dir
+        if self.__pipeline_key is not None:
+            self.__save_pipeline_state()
+            # parked first so the new pipeline has the VRAM, it is moved back if the new one can't be loaded
+            self.__park_pipeline(self.__pipeline)
+
+        self.__model_id, self.__torch_dtype, self.__is_safety_checker, self.__fused_loras, self.__cache_dir = key
+        self.__embedding_cache.set_disk_dir(os.path.join(self.__cache_dir, 'embeddings'))
+
+        pipeline = self.__pipeline_cache.get(key)
+        is_cached = pipeline is not None
+        self.__load_profiler.begin('switch' if is_cached else 'load', model_id=self.__model_id,
+                                   torch_dtype=str(self.__torch_dtype), device=self.__device)
+        try:
+            if not is_cached:
+                start = time.perf_counter()
+                pipeline, fused = self.__load_pipeline()
+                with self.__load_profiler.stage('device move'):
+                    pipeline.to(self.__device)
+                state = self.__new_pipeline_state(pipeline)
+                if fused is not None:
+                    self.__fuse_loras(pipeline, state['lora_manager'], *fused)
+                load_time = time.perf_counter() - start
+
+                self.__pipeline_cache.put(key, pipeline, load_time)
+                self.__pipeline_states[key] = state
+            else:
+                state = self.__pipeline_states[key]
+                # offloaded pipelines are moved by accelerate hooks, they must not be moved manually
+                if not state['memory_attrs'][-2] and not state['memory_attrs'][-1]:
+                    with self.__load_profiler.stage('device move'):
+                        pipeline.to(self.__device)
+        except Exception:
+            # the old pipeline stays the current one, its memory attrs weren't replaced yet
+            self.__model_id, self.__torch_dtype, self.__is_safety_checker, self.__fused_loras, self.__cache_dir = old_key
+            self.__embedding_cache.set_disk_dir(os.path.join(self.__cache_dir, 'embeddings'))
+            memory_attrs = self.__pipeline_states[key]['memory_attrs'] if key in self.__pipeline_states else ()
+            if is_cached and self.__device == 'cuda' and not any(memory_attrs[-2:]):
+                pipeline.to('cpu')
+            if self.__pipeline_key is not None and not self.__enable_sequential_cpu_offload and not self.__enable_model_cpu_offload:
+                self.__pipeline.to(self.__device)
+            raise
+        finally:
+            self.__print_load_profile(self.__load_profiler.end())
+
+        self.__pipeline = pipeline
+        self.__pipeline_key = key
+        self.__load_pipeline_state()
+
+        print('pipeline cache:', self.__pipeline_cache.get_stats())
+
+    def __load_pipeline(self):
+        """
+        from_pretrained, but each component is loaded on its own so the time of each one is known
+        the safety checker isn't loaded at all when it is off
+
+        :return: pipeline, (fused key, manifest, fused path or None) if LoRAs are fused into it else None
+        """
+        with self.__load_profiler.stage('resolve'):
+            # the snapshot in the cache without asking the hub, downloaded only if it isn't there and the network is allowed
+            model_path = HuggingFaceModelResolver(self.__cache_dir).resolve_model(self.__model_id)
+            with open(os.path.join(model_path, 'model_index.json'), encoding='utf-8') as f:
+                model_index = json.load(f)
+
+        fused = None
+        fused_path = None
+        fused_components = []
+        if self.__fused_loras:
+            with self.__load_profiler.stage('fused cache'):
+                fused_model_cache = FusedModelCache(self.__cache_dir)
+                fused_key, manifest = fused_model_cache.get_manifest(self.__model_id, model_path, self.__fused_loras,
+                                                                     self.__torch_dtype)
+                fused_path = fused_model_cache.get_path(fused_key)
+                if fused_path is not None:
+                    fused_components = fused_model_cache.load_manifest(fused_key)['components']
+            fused = (fused_key, manifest, fused_path)
+
+        components = {}
+        for name, value in model_index.items():
+            if name.startswith('_') or not isinstance(value, list) or len(value) != 2 or value[0] is None:
+                continue
+            if not self.__is_safety_checker and name in ('safety_checker', 'feature_extractor'):
+                components[name] = None
+                continue
+            library, class_name = value
+            with self.__load_profiler.stage(name.replace('_', ' ')):
+                cls = get_component_class(library, class_name)
+                kwargs = {'torch_dtype': self.__torch_dtype} if issubclass(cls, torch.nn.Module) else {}
+                folder = fused_path if name in fused_components else model_path
+                components[name] = cls.from_pretrained(folder, subfolder=name, **kwargs)
+
+        with self.__load_profiler.stage('assemble'):
+            # every component is given, so from_pretrained doesn't load anything itself
+            pipeline = StableDiffusionPipeline.from_pretrained(model_path, torch_dtype=self.__torch_dtype,
+                                                               requires_safety_checker=self.__is_safety_checker, **components)
+        return pipeline, fused
+
+    def __fuse_loras(self, pipeline, lora_manager, fused_key, manifest, fused_path):
+        if fused_path is not None:
+            # the weights which were loaded have them already
+            lora_manager.set_baked(self.__fused_loras)
+            return
+        lora_manager.bake(self.__fused_loras, self.__cache_dir, self.__load_profiler)
+        with self.__load_profiler.stage('save fused'):
+            fused_path = FusedModelCache(self.__cache_dir).save(fused_key, manifest, pipeline)
+        print('fused model saved:', fused_path)
+
+    def __print_load_profile(self, profile):
+        if profile is not None:
+            print('\n'.join(format_profile(profile)))
+
+    def get_load_profiles(self):
+        """
+        :return: the latest load profiles, the newest last
+        """
+        return self.__load_profiler.get_profiles()
 
-    def init_wrapper(self, model_id, cache_dir='models', torch_dtype=torch.float16, is_safety_checker=True, sampler='PNDMScheduler'):
-        # clear cache to avoid OutOfMemoryError
-        gc.collect()
-        torch.cuda.empty_cache()
+    def register_pipeline(self, pipeline, model_id, torch_dtype=torch.float16, is_safety_checker=True, cache_dir='models'):
+        """
+        put a pipeline which was built somewhere else (e.g. a tiny one for testing) in the pipeline cache,
+        init_wrapper with the same model_id, torch_dtype, is_safety_checker and cache_dir uses it
+        """
+        key = (model_id, torch_dtype, is_safety_checker, (), cache_dir)
+        self.__pipeline_cache.put(key, pipeline.to(self.__device), 0.0)
+        self.__pipeline_states[key] = self.__new_pipeline_state(pipeline)
 
-        if self.__model_id != model_id or self.__cache_dir != cache_dir or self.__torch_dtype != torch_dtype or self.__is_safety_checker != is_safety_checker:
-            self.__model_id = model_id if self.__model_id != model_id else model_id
-            self.__cache_dir = cache_dir if self.__cache_dir != cache_dir else cache_dir
-            self.__torch_dtype = torch_dtype if self.__torch_dtype != torch_dtype else torch_dtype
-            self.__is_safety_checker = is_safety_checker if self.__is_safety_checker != is_safety_checker else self.__is_safety_checker
+    def __park_pipeline(self, pipeline):
+        # keep the idle pipeline in RAM instead of VRAM
+        if self.__device == 'cuda' and not self.__enable_sequential_cpu_offload and not self.__enable_model_cpu_offload:
+            pipeline.to('cpu')
 
-            self.__pipeline = StableDiffusionPipeline.from_pretrained(
-                self.__model_id, cache_dir=self.__cache_dir, torch_dtype=self.__torch_dtype).to(self.__device)
+    def __onPipelineEvicted(self, key, pipeline):
+        print('pipeline evicted:', key)
+        self.__pipeline_states.pop(key, None)
 
-            if not self.__is_safety_checker:
-                self.__pipeline.safety_checker = None
+    def __new_pipeline_state(self, pipeline):
+        return {
+            'scheduler_registry': SchedulerRegistry(pipeline.scheduler.config),
+            'sampler': None,
+            'lora_manager': LoraManager(pipeline, self.__lora_state_dict_cache),
+            'memory_attrs': (False, False, False, False, False, False),
+            'is_warm': False
+        }
 
-        if self.__pipeline and self.__sampler != sampler:
-            self.__set_sampler(sampler)
+    def __save_pipeline_state(self):
+        self.__pipeline_states[self.__pipeline_key] = {
+            'scheduler_registry': self.__pipeline_states[self.__pipeline_key]['scheduler_registry'],
+            'sampler': self.__sampler,
+            'lora_manager': self.__lora_manager,
+            'memory_attrs': (self.__enable_xformers_memory_efficient_attention,
+                             self.__enable_vae_slicing,
+                             self.__enable_attention_slicing,
+                             self.__enable_vae_tiling,
+                             self.__enable_sequential_cpu_offload,
+                             self.__enable_model_cpu_offload),
+            'is_warm': self.__pipeline_states[self.__pipeline_key]['is_warm']
+        }
+
+    def __load_pipeline_state(self):
+        state = self.__pipeline_states[self.__pipeline_key]
+        self.__sampler = state['sampler']
+        self.__lora_manager = state['lora_manager']
+        (self.__enable_xformers_memory_efficient_attention,
+         self.__enable_vae_slicing,
+         self.__enable_attention_slicing,
+         self.__enable_vae_tiling,
+         self.__enable_sequential_cpu_offload,
+         self.__enable_model_cpu_offload) = state['memory_attrs']
+
+    def prewarm(self, model_id, cache_dir, torch_dtype, is_safety_checker, sampler, saving_memory_attrs, is_cancelled=lambda: False,
+                fused_loras=None):
+        """
+        load the pipeline and run one tiny denoising step with it, so the first real generation doesn't pay
+        for the one-time kernel selection and memory allocation
+
+        :param saving_memory_attrs: arguments of set_saving_memory_attr
+        :param is_cancelled: checked between the stages, the stage being run is finished anyway
+        :return: False if it was cancelled
+        """
+        with self.__lock:
+            if is_cancelled():
+                return False
+            self.init_wrapper(model_id, cache_dir, torch_dtype, is_safety_checker, sampler, fused_loras)
+            self.set_saving_memory_attr(*saving_memory_attrs)
+
+            state = self.__pipeline_states[self.__pipeline_key]
+            if state['is_warm']:
+                return True
+            if is_cancelled():
+                return False
+
+            start = time.perf_counter()
+            prompt_embeds, negative_prompt_embeds = self.encode_prompts([''], [''])
+            # 64x64 is the smallest size the VAE and the UNet of every Stable Diffusion model can take
+            self.__pipeline(prompt_embeds=prompt_embeds, negative_prompt_embeds=negative_prompt_embeds,
+                            width=64, height=64, num_inference_steps=1)
+            state['is_warm'] = True
+            print(f'warm-up: {time.perf_counter() - start:.3f} sec')
+            return True
+
+    def set_pipeline_cache_budget(self, budget_gb):
+        # it may evict pipelines, which must not happen while one is being switched to
+        with self.__lock:
+            self.__pipeline_cache.set_budget(int(budget_gb * 1024 ** 3), keep=self.__pipeline_key)
+
+    def get_pipeline_cache_stats(self):
+        return self.__pipeline_cache.get_stats()
 
     def __set_sampler(self, sampler):
-        for i, v in enumerate(self.__pipeline.scheduler.compatibles):
-            print(i, v.__name__)
-
-        if sampler == 'PNDMScheduler':
-            self.__pipeline.scheduler = PNDMScheduler.from_config(
-                self.__pipeline.scheduler.config, use_karras_sigmas=True
-            )
-        elif sampler == 'DPMSolverMultistepScheduler':
-            self.__pipeline.scheduler = DPMSolverMultistepScheduler.from_config(
-                self.__pipeline.scheduler.config, use_karras_sigmas=True
-            )
-        elif sampler == 'DPMSolverSinglestepScheduler':
-            self.__pipeline.scheduler = DPMSolverSinglestepScheduler.from_config(
-                self.__pipeline.scheduler.config, use_karras_sigmas=True
-            )
-        elif sampler == 'LMSDiscreteScheduler':
-            self.__pipeline.scheduler = LMSDiscreteScheduler.from_config(
-                self.__pipeline.scheduler.config, use_karras_sigmas=True
-            )
-        elif sampler == 'HeunDiscreteScheduler':
-            self.__pipeline.scheduler = HeunDiscreteScheduler.from_config(
-                self.__pipeline.scheduler.config, use_karras_sigmas=True
-            )
-        elif sampler == 'EulerDiscreteScheduler':
-            self.__pipeline.scheduler = EulerDiscreteScheduler.from_config(
-                self.__pipeline.scheduler.config, use_karras_sigmas=True
-            )
-        elif sampler == 'EulerAncestralDiscreteScheduler':
-            self.__pipeline.scheduler = EulerAncestralDiscreteScheduler.from_config(
-                self.__pipeline.scheduler.config, use_karras_sigmas=True
-            )
-        print('current scheduler:', self.__pipeline.scheduler)
+        self.__pipeline.scheduler = self.__pipeline_states[self.__pipeline_key]['scheduler_registry'].get(sampler)
+        print('current scheduler:', self.__pipeline.scheduler.__class__.__name__)
 
         self.__sampler = sampler
 
@@ -102,6 +327,26 @@ class StableDiffusionWrapper:
                                         enable_vae_tiling,
                                         enable_sequential_cpu_offload,
                                         enable_model_cpu_offload):
+        with self.__lock:
+            attrs = (enable_xformers_memory_efficient_attention, enable_vae_slicing, enable_attention_slicing,
+                     enable_vae_tiling, enable_sequential_cpu_offload, enable_model_cpu_offload)
+            if attrs == (self.__enable_xformers_memory_efficient_attention, self.__enable_vae_slicing,
+                         self.__enable_attention_slicing, self.__enable_vae_tiling,
+                         self.__enable_sequential_cpu_offload, self.__enable_model_cpu_offload):
+                return
+            self.__load_profiler.begin('memory_attrs', model_id=self.__model_id, attrs=attrs)
+            try:
+                with self.__load_profiler.stage('memory attrs'):
+                    self.__set_saving_memory_attr(*attrs)
+            finally:
+                self.__print_load_profile(self.__load_profiler.end())
+
+    def __set_saving_memory_attr(self, enable_xformers_memory_efficient_attention,
+                                        enable_vae_slicing,
+                                        enable_attention_slicing,
+                                        enable_vae_tiling,
+                                        enable_sequential_cpu_offload,
+                                        enable_model_cpu_offload):
         if self.__enable_xformers_memory_efficient_attention != enable_xformers_memory_efficient_attention:
             self.__enable_xformers_memory_efficient_attention = enable_xformers_memory_efficient_attention
             if self.__enable_xformers_memory_efficient_attention:
@@ -135,50 +380,114 @@ class StableDiffusionWrapper:
             if self.__enable_model_cpu_offload:
                 self.__pipeline.enable_model_cpu_offload()
 
-    def load_lora_weights(self, lora_path):
-        if lora_path in self.__lora_path:
-            print('LoRA already exists:', self.__lora_path)
-            pass
-        else:
-            self.__lora_path.append(lora_path)
-            weight_name = get_info(lora_path)[0]
-            self.__pipeline.load_lora_weights(lora_path, cache_dir=self.__cache_dir, weight_name=weight_name)
-            print('LoRA saved:', self.__lora_path)
+    def set_loras(self, loras, fuse=False):
+        """
+        activate these LoRAs and deactivate the others, without reloading the model
 
-    def forward_embeddings_through_text_encoder(self, common_args):
-        max_length = self.__pipeline.tokenizer.model_max_length
+        :param loras: [lora_path or (lora_path, scale), ...]
+        :param fuse: merge them into the weights, the steps are faster but changing a scale has to unfuse first
+        """
+        with self.__lock:
+            if self.__lora_manager.is_current(loras, fuse):
+                return
+            self.__load_profiler.begin('lora', model_id=self.__model_id, loras=normalize_loras(loras), fuse=fuse)
+            try:
+                self.__lora_manager.set_active(loras, self.__cache_dir, fuse, self.__load_profiler)
+            finally:
+                self.__print_load_profile(self.__load_profiler.end())
+            print('LoRA:', self.__lora_manager.get_active(), 'fused' if self.__lora_manager.is_fused() else '')
+            print('LoRA state dict cache:', self.__lora_state_dict_cache.get_stats())
+
+    def load_lora_weights(self, lora_path, scale=1.0):
+        """
+        activate one more LoRA on top of the active ones
+        """
+        with self.__lock:
+            active = [lora for lora in self.__lora_manager.get_active() if lora[0] != lora_path]
+            self.set_loras(active + [(lora_path, scale)], self.__lora_manager.is_fused())
+
+    def unload_lora_weights(self, lora_path):
+        """
+        deactivate the LoRA and delete its adapter from the pipeline
+        """
+        with self.__lock:
+            self.__lora_manager.unload(lora_path)
+
+    def get_loras(self):
+        """
+        :return: ((lora_path, scale), ...) which are active
+        """
+        return self.__lora_manager.get_active() if self.__lora_manager else ()
 
-        input_ids = self.__pipeline.tokenizer(common_args['prompt'], return_tensors="pt").input_ids
-        input_ids = input_ids.to("cuda")
+    def get_loaded_loras(self):
+        """
+        :return: lora paths which are loaded as adapters in the current pipeline, active or not
+        """
+        return self.__lora_manager.get_loaded() if self.__lora_manager else []
 
-        if input_ids.shape[1] > max_length:
-            negative_ids = self.__pipeline.tokenizer(common_args['negative_prompt'], truncation=False, padding="max_length",
-                                              max_length=input_ids.shape[-1], return_tensors="pt").input_ids
-            negative_ids = negative_ids.to("cuda")
+    def set_lora_cache_size(self, max_size_mb):
+        self.__lora_state_dict_cache.set_max_size(int(max_size_mb * 1024 ** 2))
 
-            concat_embeds = []
-            neg_embeds = []
-            for i in range(0, input_ids.shape[-1], max_length):
-                concat_embeds.append(self.__pipeline.text_encoder(input_ids[:, i: i + max_length])[0])
-                neg_embeds.append(self.__pipeline.text_encoder(negative_ids[:, i: i + max_length])[0])
+    def __get_embedding_key(self, text):
+        tokenizer = self.__pipeline.tokenizer
+        return (self.__model_id, str(self.__torch_dtype), tokenizer.name_or_path, len(tokenizer),
+                self.__lora_manager.get_active(), text)
 
-            prompt_embeds = torch.cat(concat_embeds, dim=1)
-            negative_prompt_embeds = torch.cat(neg_embeds, dim=1)
+    def encode_prompts(self, prompts, negative_prompts):
+        """
+        encode every prompt and negative prompt in one batched forward of the text encoder,
+        texts which were encoded before come from the embedding cache
 
-            if prompt_embeds.shape[1] < negative_prompt_embeds.shape[1]:
-                padding = (0, 0, 0, negative_prompt_embeds.shape[1] - prompt_embeds.shape[1], 0, 0)
-                prompt_embeds = F.pad(prompt_embeds, padding)
+        :return: prompt_embeds, negative_prompt_embeds padded to the same number of chunks
+        """
+        with self.__lock:
+            tokenizer = self.__pipeline.tokenizer
 
-            del common_args['prompt']
-            del common_args['negative_prompt']
+            # None stands for the chunk of padding tokens
+            texts = [None] + list(prompts) + list(negative_prompts)
+            keys = [self.__get_embedding_key(text) for text in texts]
+            embeds = [self.__embedding_cache.get(key, device=self.__device) for key in keys]
 
-            common_args['prompt_embeds'] = prompt_embeds
-            common_args['negative_prompt_embeds'] = negative_prompt_embeds
+            # the same text may show up more than once (e.g. several requests with the same negative prompt)
+            misses = {}
+            for i, v in enumerate(embeds):
+                if v is None:
+                    misses.setdefault(keys[i], []).append(i)
 
-            print('prompt_embeds:', prompt_embeds)
-            print('negative_prompt_embeds:', negative_prompt_embeds)
+            miss_indexes = [indexes[0] for indexes in misses.values()]
+            chunks_list = [get_padding_chunk(tokenizer) if texts[i] is None else tokenize_chunks(tokenizer, texts[i]) for i in miss_indexes]
+            for indexes, v in zip(misses.values(), encode_chunks(self.__pipeline.text_encoder, chunks_list, self.__device)):
+                for i in indexes:
+                    embeds[i] = v
+                # negative prompts are usually the same between sessions, keep them on disk as well
+                self.__embedding_cache.put(keys[indexes[0]], v, persist=any(i > len(prompts) for i in indexes))
+
+            padding_chunk_embeds = embeds[0]
+            length = max(v.shape[1] for v in embeds[1:])
+            embeds = [pad_embeds(v, length, padding_chunk_embeds) for v in embeds[1:]]
+
+            prompt_embeds = torch.cat(embeds[:len(prompts)], dim=0)
+            negative_prompt_embeds = torch.cat(embeds[len(prompts):], dim=0)
+            return prompt_embeds, negative_prompt_embeds
+
+    def forward_embeddings_through_text_encoder(self, common_args):
+        prompt_embeds, negative_prompt_embeds = self.encode_prompts([common_args['prompt']], [common_args['negative_prompt']])
+
+        del common_args['prompt']
+        del common_args['negative_prompt']
+
+        common_args['prompt_embeds'] = prompt_embeds
+        common_args['negative_prompt_embeds'] = negative_prompt_embeds
+
+        print('embedding cache:', self.__embedding_cache.get_stats())
 
         return common_args
 
+    def set_embedding_cache_size(self, max_size_mb):
+        self.__embedding_cache.set_max_size(int(max_size_mb * 1024 ** 2))
+
+    def get_embedding_cache_stats(self):
+        return self.__embedding_cache.get_stats()
+
     def get_pipeline(self):
         return self.__pipeline
\ No newline at end of file
@@ -1,15 +1,38 @@
+import threading
+import time
+from functools import partial
+
 from qtpy.QtCore import QThread, Signal
+from qtpy.QtGui import QImage
+
+from src.batchSizer import BatchSizer
+from src.gridGenerator import generate_grid
+from src.imageEncoder import get_encoder, DEFAULT_ENCODER
+from src.imageWriter import ImageWriterPool
+from src.preview import StepPreviewer
+from src.script import generate_image, image_to_grid, save_image, write_image
+
 
-from src.script import generate_image, image_to_grid, save_image
+class GenerationCancelled(Exception):
+    pass
 
 
 class Thread(QThread):
     generateFinished = Signal(list)
     generateFailed = Signal(str)
+    previewGenerated = Signal(QImage, int)
+    # the model is loaded, see prepare
+    pipelineReady = Signal()
 
-    def __init__(self, pipeline, generation_count, model_id, prompt_text_for_filename, save_path, rows, cols, **pipeline_args):
+    def __init__(self, pipeline, generation_count, model_id, prompt_text_for_filename, save_path, rows, cols, output_encoder=DEFAULT_ENCODER, preview_interval=0,
+                 pack=False, max_pack_size=1, prepare=None, **pipeline_args):
+        """
+        :param prepare: called with pipeline_args on this thread before generating, returns (pipeline, pipeline_args),
+        so loading the model doesn't block the GUI, pipeline can be None with it
+        """
         super(Thread, self).__init__()
         self.__pipeline = pipeline
+        self.__prepare = prepare
         self.__generation_count = generation_count
         self.__model_id = model_id
         self.__prompt_text_for_filename = prompt_text_for_filename
@@ -17,33 +40,199 @@ class Thread(QThread):
         self.__rows = rows
         self.__cols = cols
         self.__pipeline_args = pipeline_args
+        self.__encoder = get_encoder(output_encoder)
+        self.__writer = None
 
-    def __generate_save_image(self):
-        try:
-            images = generate_image(self.__pipeline, **self.__pipeline_args)
-            filename = ''
-            if len(images) > 1:
-                grid = image_to_grid(images, rows=self.__rows, cols=self.__cols)
-                suffix = f'({self.__rows}x{self.__cols} grid)'
-                filename = save_image([grid], prompt=self.__prompt_text_for_filename, model_id=self.__model_id, save_path=self.__save_path, suffix=suffix)
-                # have to put upscale code, i can't test it because of OutOfMemoryError
-            else:
-                filename = save_image(images, prompt=self.__prompt_text_for_filename, save_path=self.__save_path, model_id=self.__model_id)
-            return filename
-        except Exception as e:
-            raise Exception(e)
+        # pack several generations into one pipeline call, max_pack_size is the limit of images in it
+        self.__pack = pack
+        self.__batch_sizer = BatchSizer(max(1, max_pack_size // (rows * cols)))
+        # a grid bigger than that is denoised in sub-batches of max_pack_size images streamed into the grid
+        self.__max_pack_size = max_pack_size
+        self.__chunk_grid = rows * cols > max(1, max_pack_size)
+        self.__image_count = 0
+        self.__generation_time = 0.0
+
+        # checked by the step callback, so cancel/pause takes effect within one denoising step
+        self.__cancel_event = threading.Event()
+        self.__resume_event = threading.Event()
+        self.__resume_event.set()
+
+        self.__previewer = StepPreviewer(preview_interval, self.__emitPreview)
+        self.__setStepCallback()
+
+    def __setStepCallback(self):
+        self.__pipeline_args['callback_on_step_end'] = self.__onStepEnd
+        self.__pipeline_args['callback_on_step_end_tensor_inputs'] = ['latents']
+
+    def __onStepEnd(self, pipeline, step, timestep, callback_kwargs):
+        self.__previewer(step, callback_kwargs['latents'])
+        self.__resume_event.wait()
+        if self.__cancel_event.is_set():
+            # unwinds the pipeline call, the pipeline itself stays loaded for the next job
+            raise GenerationCancelled()
+        # the time being paused is not step time
+        self.__previewer.reset()
+        return callback_kwargs
+
+    def cancel(self):
+        self.__cancel_event.set()
+        self.__resume_event.set()
+
+    def pause(self):
+        self.__resume_event.clear()
+
+    def resume(self):
+        self.__resume_event.set()
+
+    def isPaused(self):
+        return not self.__resume_event.is_set()
+
+    def __emitPreview(self, rgb, step):
+        h, w, _ = rgb.shape
+        # copy() detaches the image from the ndarray buffer before it goes to the GUI thread
+        image = QImage(rgb.tobytes(), w, h, w * 3, QImage.Format_RGB888).copy()
+        self.previewGenerated.emit(image, step)
+
+    def __save_images(self, images):
+        filename = ''
+        if len(images) > 1:
+            grid = image_to_grid(images, rows=self.__rows, cols=self.__cols)
+            suffix = f'({self.__rows}x{self.__cols} grid)'
+            filename = save_image([grid], prompt=self.__prompt_text_for_filename, model_id=self.__model_id, save_path=self.__save_path, suffix=suffix, writer=self.__writer, encoder=self.__encoder)
+            # have to put upscale code, i can't test it because of OutOfMemoryError
+        else:
+            filename = save_image(images, prompt=self.__prompt_text_for_filename, save_path=self.__save_path, model_id=self.__model_id, writer=self.__writer, encoder=self.__encoder)
+        return filename
+
+    def __generate_save_grid(self):
+        pipeline_args = {k: v for k, v in self.__pipeline_args.items() if k != 'num_images_per_prompt'}
+
+        self.__previewer.reset()
+        canvas, seed, stats = generate_grid(self.__pipeline, self.__rows, self.__cols, self.__max_pack_size, **pipeline_args)
+        self.__image_count += self.__rows * self.__cols
+        self.__generation_time += stats['seconds']
+        print(f'grid seed: {seed} (tile i has seed {seed} + i),', stats)
+
+        suffix = f'({self.__rows}x{self.__cols} grid)'
+        return save_image([canvas.get_array()], prompt=self.__prompt_text_for_filename, model_id=self.__model_id,
+                          save_path=self.__save_path, suffix=suffix, writer=self.__writer, encoder=self.__encoder)
+
+    def __generate_save_images(self, count):
+        """
+        generate the images of "count" generations in one pipeline call, each generation is saved under its own filename
+        """
+        if self.__chunk_grid:
+            return [self.__generate_save_grid() for _ in range(count)]
+
+        images_per_generation = self.__rows * self.__cols
+        pipeline_args = dict(self.__pipeline_args)
+        pipeline_args['num_images_per_prompt'] = images_per_generation * count
+
+        self.__previewer.reset()
+        start = time.perf_counter()
+        # one uint8 ndarray for the whole batch, the grids are cut out of it without PIL
+        images = generate_image(self.__pipeline, as_array=True, **pipeline_args)
+        elapsed = time.perf_counter() - start
+
+        self.__batch_sizer.report(count, len(images), elapsed)
+        self.__image_count += len(images)
+        self.__generation_time += elapsed
+
+        return [self.__save_images(images[i * images_per_generation:(i + 1) * images_per_generation]) for i in range(count)]
+
+    def __get_pack_count(self, remaining):
+        count = self.__batch_sizer.get_size() if self.__pack and not self.__chunk_grid else 1
+        return count if remaining == -1 else min(count, remaining)
 
     def run(self):
+        # png compression and disk writes overlap with the next denoising pass
+        self.__writer = ImageWriterPool(partial(write_image, encoder=self.__encoder))
         try:
+            if self.__prepare is not None:
+                self.__pipeline, self.__pipeline_args = self.__prepare(self.__pipeline_args)
+                self.__setStepCallback()
+                self.pipelineReady.emit()
             filenames = []
-            if self.__generation_count == -1:
-                while True:
-                    filename = self.__generate_save_image()
-                    filenames.append(filename)
-            else:
-                for i in range(self.__generation_count):
-                    filename = self.__generate_save_image()
-                    filenames.append(filename)
+            # -1 means generating endlessly
+            remaining = self.__generation_count
+            while remaining != 0 and not self.__cancel_event.is_set():
+                count = self.__get_pack_count(remaining)
+                try:
+                    filenames.extend(self.__generate_save_images(count))
+                except GenerationCancelled:
+                    print('generation cancelled')
+                    break
+                except Exception as e:
+                    # torch.cuda.OutOfMemoryError, the packed batch is too big for this machine
+                    if type(e).__name__ == 'OutOfMemoryError' and count > 1:
+                        print('out of memory with', count, 'packed generations')
+                        self.__batch_sizer.report_out_of_memory(count)
+                        continue
+                    raise
+                if remaining > 0:
+                    remaining -= count
+            # every file has to be on disk before it is reported (the ones made before cancel as well)
+            self.__writer.close()
+            print('preview:', self.__previewer.get_stats())
+            print(f'{self.__image_count / self.__generation_time if self.__generation_time else 0.0:.3f} images/sec,',
+                  'packing:', self.__batch_sizer.get_stats() if self.__pack else 'off')
             self.generateFinished.emit(filenames)
         except Exception as e:
+            try:
+                self.__writer.close()
+            except Exception as write_e:
+                print(write_e)
             self.generateFailed.emit(str(e))
+
+
+class PrewarmThread(QThread):
+    """
+    loads the selected model and warms it up in the background, so Generate doesn't wait for it
+    importing torch and making the wrapper are done here too, the GUI thread only passes the settings
+    """
+    prewarmFinished = Signal(str)
+    prewarmFailed = Signal(str, str)
+
+    def __init__(self, get_wrapper, model_id, cache_dir, torch_dtype, is_safety_checker, sampler, saving_memory_attrs, fused_loras=None,
+                 pipeline_cache_budget=None):
+        """
+        :param get_wrapper: returns the wrapper, making it the first time, it must be thread-safe
+        :param torch_dtype: '16' or '32' like the setting
+        """
+        super(PrewarmThread, self).__init__()
+        self.__get_wrapper = get_wrapper
+        self.__model_id = model_id
+        self.__cache_dir = cache_dir
+        self.__torch_dtype = torch_dtype
+        self.__is_safety_checker = is_safety_checker
+        self.__sampler = sampler
+        self.__saving_memory_attrs = saving_memory_attrs
+        self.__fused_loras = fused_loras
+        self.__pipeline_cache_budget = pipeline_cache_budget
+
+        self.__cancel_event = threading.Event()
+
+    def cancel(self):
+        # a selection which is already superseded doesn't need to be loaded
+        self.__cancel_event.set()
+
+    def isCancelled(self):
+        return self.__cancel_event.is_set()
+
+    def run(self):
+        try:
+            import torch
+
+            torch_dtype = torch.float16 if str(self.__torch_dtype) == '16' else torch.float32
+            wrapper = self.__get_wrapper()
+            if self.__pipeline_cache_budget is not None:
+                wrapper.set_pipeline_cache_budget(self.__pipeline_cache_budget)
+            if self.isCancelled():
+                return
+            if wrapper.prewarm(self.__model_id, self.__cache_dir, torch_dtype, self.__is_safety_checker,
+                               self.__sampler, self.__saving_memory_attrs, is_cancelled=self.isCancelled,
+                               fused_loras=self.__fused_loras):
+                self.prewarmFinished.emit(self.__model_id)
+        except Exception as e:
+            print(e)
+            self.prewarmFailed.emit(self.__model_id, str(e))
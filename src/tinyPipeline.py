@@ -0,0 +1,72 @@
+import json
+import os
+import string
+import tempfile
+
+TINY_MODEL_ID = 'tiny'
+
+
+def build_tiny_tokenizer():
+    """
+    character level CLIP tokenizer which is made locally, without downloading anything
+    """
+    from transformers import CLIPTokenizer
+
+    vocab = {'<|startoftext|>': 0, '<|endoftext|>': 1}
+    for c in string.ascii_lowercase + string.digits + string.punctuation:
+        vocab[c] = len(vocab)
+        vocab[c + '</w>'] = len(vocab)
+
+    tmp_dir = tempfile.mkdtemp()
+    vocab_file = os.path.join(tmp_dir, 'vocab.json')
+    merges_file = os.path.join(tmp_dir, 'merges.txt')
+    with open(vocab_file, 'w', encoding='utf-8') as f:
+        json.dump(vocab, f)
+    with open(merges_file, 'w', encoding='utf-8') as f:
+        f.write('#version: 0.2\n')
+    return CLIPTokenizer(vocab_file, merges_file, model_max_length=77)
+
+
+def build_tiny_pipeline(seed=0):
+    """
+    StableDiffusionPipeline with randomly initialized, very small components
+    it produces noise, but it goes through every step of the real pipeline in a fraction of a second on CPU
+    """
+    import torch
+    from diffusers import AutoencoderKL, PNDMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    torch.manual_seed(seed)
+    tokenizer = build_tiny_tokenizer()
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=('DownBlock2D', 'CrossAttnDownBlock2D'),
+        up_block_types=('CrossAttnUpBlock2D', 'UpBlock2D'),
+        cross_attention_dim=32,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=['DownEncoderBlock2D', 'DownEncoderBlock2D'],
+        up_block_types=['UpDecoderBlock2D', 'UpDecoderBlock2D'],
+        latent_channels=4,
+    )
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0,
+        eos_token_id=1,
+        pad_token_id=1,
+        hidden_size=32,
+        intermediate_size=37,
+        layer_norm_eps=1e-05,
+        num_attention_heads=4,
+        num_hidden_layers=2,
+        vocab_size=len(tokenizer),
+    ))
+    return StableDiffusionPipeline(vae=vae, text_encoder=text_encoder, tokenizer=tokenizer, unet=unet,
+                                   scheduler=PNDMScheduler(skip_prk_steps=True), safety_checker=None,
+                                   feature_extractor=None, requires_safety_checker=False)
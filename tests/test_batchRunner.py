@@ -0,0 +1,48 @@
+import io
+import json
+
+from batchRunner import get_group_key, group_jobs, read_jobs
+
+
+def make_jobs(*jobs):
+    return read_jobs(io.StringIO('\n'.join(json.dumps(job) for job in jobs)))
+
+
+def test_group_key_normalizes_loras():
+    jobs = [job for _, job in make_jobs({'prompt': 'a', 'loras': ['a/lora']},
+                                        {'prompt': 'b', 'loras': [['a/lora', 1]]},
+                                        {'prompt': 'c', 'loras': [['a/lora', '1.0']]})]
+    keys = {get_group_key(job) for job in jobs}
+    assert len(keys) == 1
+    assert keys.pop()[3] == (('a/lora', 1.0),)
+
+
+def test_group_jobs_with_mixed_lora_forms():
+    jobs = make_jobs({'prompt': 'a', 'loras': ['a/lora']},
+                     {'prompt': 'b', 'loras': [['b/lora', 0.5]]},
+                     {'prompt': 'c', 'loras': [['a/lora', 1.0]]},
+                     {'prompt': 'd', 'loras': ['b/lora', ['a/lora', 0.8]]},
+                     {'prompt': 'e'})
+    groups = [[job['prompt'] for _, job in group] for _, group in group_jobs(jobs)]
+    assert sorted(groups) == [['a', 'c'], ['b'], ['d'], ['e']]
+
+
+def test_read_jobs_skips_bad_lines(tmp_path, capsys):
+    filename = tmp_path / 'jobs.jsonl'
+    filename.write_text('\n'.join([
+        '{"prompt": "a cat"}',
+        '[1, 2]',
+        '"x"',
+        '',
+        '{"prompt": ',
+        '{"width": 256}',
+        '{"prompt": "a dog", "count": 2}',
+    ]), encoding='utf-8')
+    with open(filename, encoding='utf-8') as f:
+        jobs = list(read_jobs(f))
+    assert [(i, job['prompt']) for i, job in jobs] == [(1, 'a cat'), (7, 'a dog')]
+    assert jobs[1][1]['count'] == 2
+    assert jobs[0][1]['width'] == 512
+    err = capsys.readouterr().err
+    for i in (2, 3, 5, 6):
+        assert f'Line {i} is skipped' in err
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import threading
+
+import pytest
+
+from huggingface_gui.huggingFaceDownloader import HuggingFaceDownloader
+from localHub import serve
+
+WEIGHTS = os.urandom(3 * 1024 ** 2 + 17)
+HUB_FILES = {
+    'org/model/model_index.json': b'{"_class_name": "StableDiffusionPipeline"}',
+    'org/model/unet/config.json': b'{"sample_size": 64}',
+    'org/model/unet/diffusion_pytorch_model.safetensors': WEIGHTS,
+    'org/model/vae/config.json': b'{"latent_channels": 4}',
+    'org/model/vae/diffusion_pytorch_model.safetensors': os.urandom(2 * 1024 ** 2),
+    'org/model/text_encoder/config.json': b'{"hidden_size": 32}',
+    'org/model/text_encoder/model.safetensors': os.urandom(1024 ** 2),
+    # same content as the unet, one blob
+    'org/model/safety_checker/model.safetensors': WEIGHTS,
+}
+WEIGHTS_BLOB = hashlib.sha256(WEIGHTS).hexdigest()
+
+
+@pytest.fixture(scope='module')
+def hub_root(tmp_path_factory):
+    root = tmp_path_factory.mktemp('hub')
+    for filename, data in HUB_FILES.items():
+        path = root.joinpath(*filename.split('/'))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    return str(root)
+
+
+def start(hub_root, fail_after=None):
+    server = serve(hub_root, port=0, fail_after=fail_after)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def check_snapshot(snapshot_path):
+    for filename, data in HUB_FILES.items():
+        with open(os.path.join(snapshot_path, *filename.split('/')[2:]), 'rb') as f:
+            assert f.read() == data, filename
+
+
+def get_blob_path(cache_dir, blob_name):
+    return os.path.join(cache_dir, 'models--org--model', 'blobs', blob_name)
+
+
+def test_parallel_download(hub_root, tmp_path):
+    server, endpoint = start(hub_root)
+    try:
+        progress = []
+        snapshot_path = HuggingFaceDownloader(str(tmp_path), endpoint=endpoint, max_workers=4).download(
+            'org/model', progress_callback=lambda downloaded, total: progress.append((downloaded, total)))
+    finally:
+        server.shutdown()
+        server.server_close()
+    check_snapshot(snapshot_path)
+    # the shared blob is downloaded once
+    total = sum(len(data) for filename, data in HUB_FILES.items() if filename != 'org/model/safety_checker/model.safetensors')
+    assert progress[-1] == (total, total)
+    assert not [name for name in os.listdir(os.path.dirname(get_blob_path(str(tmp_path), WEIGHTS_BLOB))) if name.endswith('.incomplete')]
+
+
+def test_resume_from_incomplete_blob(hub_root, tmp_path):
+    blob_path = get_blob_path(str(tmp_path), WEIGHTS_BLOB)
+    os.makedirs(os.path.dirname(blob_path))
+    with open(blob_path + '.incomplete', 'wb') as f:
+        f.write(WEIGHTS[:1024 ** 2])
+
+    server, endpoint = start(hub_root)
+    try:
+        progress = []
+        snapshot_path = HuggingFaceDownloader(str(tmp_path), endpoint=endpoint).download(
+            'org/model', progress_callback=lambda downloaded, total: progress.append(downloaded))
+    finally:
+        server.shutdown()
+        server.server_close()
+    check_snapshot(snapshot_path)
+    # the part which was there counts as downloaded from the start
+    assert progress[0] == 1024 ** 2
+
+
+def test_resume_after_dropped_connection(hub_root, tmp_path):
+    server, endpoint = start(hub_root, fail_after=512 * 1024)
+    try:
+        downloader = HuggingFaceDownloader(str(tmp_path), endpoint=endpoint)
+        with pytest.raises(Exception):
+            downloader.download('org/model')
+        assert any(name.endswith('.incomplete') for name in os.listdir(os.path.dirname(get_blob_path(str(tmp_path), WEIGHTS_BLOB))))
+        # each file is dropped once, the files which didn't start before the first failure may fail the next try,
+        # the dropped ones get the rest with a Range request
+        for _ in HUB_FILES:
+            try:
+                snapshot_path = downloader.download('org/model')
+                break
+            except Exception as e:
+                print(e)
+    finally:
+        server.shutdown()
+        server.server_close()
+    check_snapshot(snapshot_path)
+
+
+def test_corrupted_incomplete_blob_is_rejected(hub_root, tmp_path):
+    blob_path = get_blob_path(str(tmp_path), WEIGHTS_BLOB)
+    os.makedirs(os.path.dirname(blob_path))
+    with open(blob_path + '.incomplete', 'wb') as f:
+        f.write(b'\0' * 1024 ** 2)
+
+    server, endpoint = start(hub_root)
+    try:
+        downloader = HuggingFaceDownloader(str(tmp_path), endpoint=endpoint)
+        # the size is right after the resume, the hash isn't
+        with pytest.raises(Exception, match='corrupted'):
+            downloader.download('org/model')
+        assert not os.path.exists(blob_path)
+        assert not os.path.exists(blob_path + '.incomplete')
+        snapshot_path = downloader.download('org/model')
+    finally:
+        server.shutdown()
+        server.server_close()
+    check_snapshot(snapshot_path)
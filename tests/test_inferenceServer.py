@@ -0,0 +1,139 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from inferenceServer import InferenceRequest, MicroBatcher, make_handler, serve
+
+
+class EchoRunner:
+    """
+    finishes the requests of each batch with their params instead of running a pipeline
+    """
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, batch):
+        self.batches.append([request.params['prompt'] for request in batch])
+        for request in batch:
+            request.finish(result={'params': request.params, 'batch_size': sum(r.params['count'] for r in batch)})
+
+
+def start_echo_server(max_wait=0.0):
+    runner = EchoRunner()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(MicroBatcher(None, max_wait=max_wait, run_batch=runner)))
+    return server, start(server), runner
+
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def post(url, body):
+    data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url + '/generate', data=data, method='POST'), timeout=60) as r:
+            return r.status, json.loads(r.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+@pytest.fixture
+def echo_url():
+    server, url, _ = start_echo_server()
+    yield url
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('body', [
+    [1, 2],
+    'a cat',
+    {},
+    {'prompt': 1},
+    {'prompt': 'a cat', 'count': 0},
+    {'prompt': 'a cat', 'count': '2'},
+    {'prompt': 'a cat', 'count': 1000},
+    # more than max batch size
+    {'prompt': 'a cat', 'count': 9},
+    {'prompt': 'a cat', 'width': 500},
+    {'prompt': 'a cat', 'height': -512},
+    {'prompt': 'a cat', 'num_inference_steps': 0},
+    {'prompt': 'a cat', 'num_inference_steps': 2.5},
+    {'prompt': 'a cat', 'guidance_scale': None},
+    {'prompt': 'a cat', 'timeout': 0},
+    {'prompt': 'a cat', 'timeout': 'soon'},
+    {'prompt': 'a cat', 'seed': -1},
+])
+def test_invalid_request_is_400(echo_url, body):
+    status, result = post(echo_url, body)
+    assert status == 400
+    assert 'error' in result
+
+
+def test_invalid_json_is_400(echo_url):
+    assert post(echo_url, b'{"prompt": ')[0] == 400
+
+
+def test_valid_request(echo_url):
+    status, result = post(echo_url, {'prompt': 'a cat', 'count': 2, 'width': 256.0, 'seed': 3})
+    assert status == 200
+    assert result['params']['count'] == 2
+    assert result['params']['width'] == 256
+    assert result['params']['seed'] == 3
+
+
+def test_compatible_requests_are_merged():
+    server, url, runner = start_echo_server(max_wait=1.0)
+    try:
+        results = []
+        threads = [threading.Thread(target=lambda prompt=prompt: results.append(post(url, {'prompt': prompt, 'seed': 1})))
+                   for prompt in ('a cat', 'a dog')]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert [status for status, _ in results] == [200, 200]
+        assert [result['batch_size'] for _, result in results] == [2, 2]
+        assert len(runner.batches) == 1
+        assert sorted(runner.batches[0]) == ['a cat', 'a dog']
+
+        # another resolution isn't merged with them
+        post(url, {'prompt': 'a bird', 'width': 256})
+        assert runner.batches[-1] == ['a bird']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_request_defaults():
+    params = InferenceRequest({'prompt': 'a cat'}).params
+    assert params['count'] == 1
+    assert isinstance(params['seed'], int)
+
+
+def test_tiny_end_to_end(tmp_path):
+    pytest.importorskip('torch')
+    pytest.importorskip('diffusers')
+    from tinyPipeline import TINY_MODEL_ID
+
+    server = serve(port=0, cache_dir=str(tmp_path), max_batch_size=4, max_wait=0.2, tiny=True)
+    url = start(server)
+    try:
+        body = {'prompt': 'a cat', 'model': TINY_MODEL_ID, 'width': 64, 'height': 64, 'num_inference_steps': 2,
+                'sampler': 'PNDMScheduler', 'count': 2, 'seed': 1}
+        status, result = post(url, body)
+        assert status == 200
+        assert len(result['images']) == 2
+        assert result['seeds'] == [1, 2]
+
+        assert post(url, {**body, 'count': 0})[0] == 400
+        with urllib.request.urlopen(url + '/metrics', timeout=10) as r:
+            assert json.loads(r.read())['images'] == 2
+    finally:
+        server.shutdown()
+        server.server_close()
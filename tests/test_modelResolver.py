@@ -0,0 +1,92 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from huggingface_gui.huggingFaceCacheIndex import get_cache_index
+from huggingface_gui.huggingFaceDownloader import HuggingFaceDownloader
+from huggingface_gui.huggingFaceModelResolver import HuggingFaceModelResolver, ModelNotFoundOffline, set_allow_network
+from localHub import serve
+
+HUB_FILES = {
+    'org/model/model_index.json': b'{"_class_name": "StableDiffusionPipeline", "unet": ["diffusers", "UNet2DConditionModel"]}',
+    'org/model/unet/config.json': b'{}',
+    'org/model/unet/diffusion_pytorch_model.safetensors': b'unet',
+    'org/lora/pytorch_lora_weights.safetensors': b'lora',
+    'org/lora/README.md': b'lora',
+}
+
+
+@pytest.fixture(scope='module')
+def cache_dir(tmp_path_factory):
+    """
+    cache directory with a model and a LoRA repo, downloaded from the local hub stand-in
+    """
+    tmp_path = tmp_path_factory.mktemp('hub')
+    hub_root = tmp_path / 'hub'
+    for filename, data in HUB_FILES.items():
+        path = hub_root.joinpath(*filename.split('/'))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+    cache_dir = str(tmp_path / 'cache')
+    server = serve(str(hub_root), port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        downloader = HuggingFaceDownloader(cache_dir, endpoint=f'http://127.0.0.1:{server.server_address[1]}')
+        for repo_id in ('org/model', 'org/lora'):
+            downloader.download(repo_id)
+            get_cache_index(cache_dir).update_repo(repo_id)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return cache_dir
+
+
+@pytest.fixture
+def offline(monkeypatch):
+    def no_network(*args, **kwargs):
+        raise OSError('network access while offline')
+
+    monkeypatch.setenv('HF_HUB_OFFLINE', '1')
+    monkeypatch.setattr(socket, 'create_connection', no_network)
+    monkeypatch.setattr(socket.socket, 'connect', no_network)
+    set_allow_network(False)
+    yield
+    set_allow_network(True)
+
+
+def test_model_resolves_from_cache(cache_dir, offline):
+    path = HuggingFaceModelResolver(cache_dir).resolve_model('org/model')
+    assert os.path.isfile(os.path.join(path, 'model_index.json'))
+    assert os.path.isfile(os.path.join(path, 'unet', 'diffusion_pytorch_model.safetensors'))
+
+
+def test_lora_repo_resolves_from_cache(cache_dir, offline):
+    filename = HuggingFaceModelResolver(cache_dir).resolve_lora('org/lora')
+    assert os.path.basename(filename) == 'pytorch_lora_weights.safetensors'
+    with open(filename, 'rb') as f:
+        assert f.read() == b'lora'
+
+
+def test_local_lora_file(cache_dir, offline, tmp_path):
+    filename = tmp_path / 'local.safetensors'
+    filename.write_bytes(b'local')
+    assert HuggingFaceModelResolver(cache_dir).resolve_lora(str(filename)) == str(filename)
+
+
+def test_missing_model_fails_offline(cache_dir, offline):
+    resolver = HuggingFaceModelResolver(cache_dir)
+    with pytest.raises(ModelNotFoundOffline):
+        resolver.resolve_model('org/missing')
+    with pytest.raises(ModelNotFoundOffline):
+        resolver.resolve_lora('org/missing-lora')
+
+
+def test_hf_hub_offline_alone_blocks_the_network(cache_dir, monkeypatch):
+    # allowed by the setting, but the environment variable wins
+    monkeypatch.setenv('HF_HUB_OFFLINE', '1')
+    set_allow_network(True)
+    with pytest.raises(ModelNotFoundOffline):
+        HuggingFaceModelResolver(cache_dir).resolve_model('org/missing')
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('diffusers')
+pytest.importorskip('transformers')
+
+from stableDiffusionClass import StableDiffusionWrapper, get_component_class
+from tinyPipeline import build_tiny_pipeline
+
+
+def build_safety_checker():
+    from diffusers.pipelines.stable_diffusion.safety_checker import StableDiffusionSafetyChecker
+    from transformers import CLIPConfig, CLIPImageProcessor
+
+    layers = {'hidden_size': 32, 'intermediate_size': 37, 'num_attention_heads': 4, 'num_hidden_layers': 2}
+    config = CLIPConfig(text_config=layers, vision_config={**layers, 'image_size': 32, 'patch_size': 4}, projection_dim=32)
+    return StableDiffusionSafetyChecker(config), CLIPImageProcessor(size=32, crop_size=32)
+
+
+def test_component_class():
+    assert get_component_class('stable_diffusion', 'StableDiffusionSafetyChecker').__name__ == 'StableDiffusionSafetyChecker'
+    assert get_component_class('transformers', 'CLIPTextModel').__name__ == 'CLIPTextModel'
+    assert get_component_class('diffusers', 'UNet2DConditionModel').__name__ == 'UNet2DConditionModel'
+
+
+def test_load_pipeline_with_safety_checker(tmp_path):
+    pipeline = build_tiny_pipeline()
+    safety_checker, feature_extractor = build_safety_checker()
+    pipeline.register_modules(safety_checker=safety_checker, feature_extractor=feature_extractor)
+    model_path = tmp_path / 'tiny'
+    pipeline.save_pretrained(str(model_path), safe_serialization=True)
+    model_index = json.loads((model_path / 'model_index.json').read_text())
+    assert model_index['safety_checker'] == ['stable_diffusion', 'StableDiffusionSafetyChecker']
+
+    wrapper = StableDiffusionWrapper(load_profile_filename=str(tmp_path / 'load_profile.jsonl'))
+    wrapper.init_wrapper(str(model_path), str(tmp_path / 'cache'), torch.float32, True)
+    loaded = wrapper.get_pipeline()
+    assert type(loaded.safety_checker).__name__ == 'StableDiffusionSafetyChecker'
+    assert loaded.feature_extractor is not None
+
+    # without the safety checker it isn't loaded at all
+    wrapper.init_wrapper(str(model_path), str(tmp_path / 'cache'), torch.float32, False)
+    assert wrapper.get_pipeline().safety_checker is None
+
+
+def test_same_model_id_in_another_cache_dir(tmp_path):
+    # a local diffusers directory in the cache directory is found by its relative id
+    for name, seed in (('a', 0), ('b', 1)):
+        build_tiny_pipeline(seed).save_pretrained(str(tmp_path / name / 'local' / 'tiny'), safe_serialization=True)
+
+    wrapper = StableDiffusionWrapper(load_profile_filename=str(tmp_path / 'load_profile.jsonl'))
+    wrapper.init_wrapper('local/tiny', str(tmp_path / 'a'), torch.float32, False)
+    pipeline_a = wrapper.get_pipeline()
+    wrapper.init_wrapper('local/tiny', str(tmp_path / 'b'), torch.float32, False)
+    pipeline_b = wrapper.get_pipeline()
+    assert pipeline_a is not pipeline_b
+    assert not torch.equal(next(pipeline_a.unet.parameters()), next(pipeline_b.unet.parameters()))
+
+    # both stay cached under their own directory
+    wrapper.init_wrapper('local/tiny', str(tmp_path / 'a'), torch.float32, False)
+    assert wrapper.get_pipeline() is pipeline_a